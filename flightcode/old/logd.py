@@ -1,19 +1,83 @@
 #!/usr/bin/env python
 
+# Packet logger.
+#
+# Processes that want packets logged (stm32, pixrc) send them to logd's
+# named socket, one record per datagram, and logd appends the records to its
+# log file as they are. A record is a header:
+#   type        8 bits
+#   time_us     64 bits, CLOCK_MONOTONIC usec when the record was made
+#   length      16 bits, payload bytes
+# (little-endian) followed by the type's payload:
+#   TYPE_TIME_SYNC      CLOCK_REALTIME usec at time_us (64 bits)
+#   TYPE_STM32_PACKET   CLOCK_REALTIME usec the packet was received (64 bits),
+#                       then the packet
+#   TYPE_PIXIN_PACKET   the packet
+#   TYPE_PIXOUT_PACKET  the packet
+# logd writes a TYPE_TIME_SYNC record at the start of each file and every
+# SYNC_INTERVAL_US after that, so the monotonic times can be turned back into
+# wall clock time (which may be set from GPS after logging starts).
+#
+# The log file is kept open and flushed every FLUSH_INTERVAL_US, so the flash
+# is written in blocks rather than a record at a time. logd_csv.py converts
+# logs to CSV.
+#
+# The [logd] section of sololink.conf can thin out high-rate records and
+# turn on compression:
+#   stm32_dsm=10    log one of every 10 DSM packets from the STM32
+#   pixout=0        don't log packets to the Pixhawk
+#   compress=True   zlib each log file (as a stream, ".z" added to its name)
+# Records are named by type (record_types), and packets from the STM32 by
+# type and packet ID (stm32_dsm, stm32_sysinfo, ...); anything not named in
+# the config is all logged.
+
 import os
-import cPickle
+import clock
+import collections
 import datetime
+import select
 import socket
+import stm32_defs
 import struct
 import sys
-
-from stm32_defs import *
+import zlib
 
 # Log record types.
+TYPE_TIME_SYNC = 0
 TYPE_STM32_PACKET = 1
 TYPE_PIXIN_PACKET = 2
 TYPE_PIXOUT_PACKET = 3
 
+# type, time_us, length
+RECORD_HEADER = struct.Struct("<BQH")
+
+RECORD_MAX = RECORD_HEADER.size + 65535
+
+# TYPE_TIME_SYNC and TYPE_STM32_PACKET payload
+TIME_US = struct.Struct("<Q")
+
+# Record types, by type ID: (name, payload offset of a byte that tells the
+# type's records apart or None, {byte: subtype name})
+record_types = { }
+
+def register_type(typeId, name, subtype_offset=None, subtype_names=None):
+    record_types[typeId] = (name, subtype_offset, subtype_names or { })
+
+# STM32 packet names by packet ID, e.g. PKT_ID_SYSINFO -> "sysinfo"
+stm32_packet_names = dict([ (v, k[len("PKT_ID_"):].lower())
+                            for k, v in stm32_defs.__dict__.items()
+                            if k.startswith("PKT_ID_") ])
+
+register_type(TYPE_TIME_SYNC, "sync")
+register_type(TYPE_STM32_PACKET, "stm32", TIME_US.size, stm32_packet_names)
+register_type(TYPE_PIXIN_PACKET, "pixin")
+register_type(TYPE_PIXOUT_PACKET, "pixout")
+
+CONF_NAME_DEFAULT = "/etc/sololink.conf"
+
+# logd wrote CSV before the binary format
+LEGACY_FILE_EXT = "csv"
+
 PIPE_NAME_DEFAULT = "/var/run/logd"
 
 # log to LOG_DIR_0_DEFAULT if it exists, else LOG_DIR_1_DEFAULT
@@ -22,12 +86,21 @@ LOG_DIR_1_DEFAULT = "/var/local"
 
 debug = False
 
+epoch = datetime.datetime(1970, 1, 1)
 
-class Stm32Logger(object):
 
-    def __init__(self, pipe_name=PIPE_NAME_DEFAULT):
+def datetime_us(t):
+    """datetime to usec since the epoch"""
+    t = t - epoch # timedelta
+    return (t.days * 86400 + t.seconds) * 1000000 + t.microseconds
+
+
+class PacketLogger(object):
+    """sends records to logd from the named socket 'local_name'"""
+
+    def __init__(self, local_name, pipe_name=PIPE_NAME_DEFAULT):
         self.log_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.local_name = "/tmp/logd-stm32"
+        self.local_name = local_name
         self.pipe_name = pipe_name
         # delete it if there's an old one still there
         try:
@@ -39,69 +112,90 @@ class Stm32Logger(object):
     def uninit(self):
         os.remove(self.local_name)
 
-    def log_packet(self, pktTime, pkt):
-        data = (TYPE_STM32_PACKET, datetime.datetime.now(), pktTime, pkt)
-        pick = cPickle.dumps(data)
+    def log_record(self, typeId, payload):
+        now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+        data = RECORD_HEADER.pack(typeId, now_us, len(payload)) + payload
         try:
-            self.log_sock.sendto(pick, self.pipe_name)
+            self.log_sock.sendto(data, self.pipe_name)
         except:
             pass # logger is dead
 
 
-class PixInLogger(object):
+class Stm32Logger(PacketLogger):
 
     def __init__(self, pipe_name=PIPE_NAME_DEFAULT):
-        self.log_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.local_name = "/tmp/logd-pixin"
-        self.pipe_name = pipe_name
-        # delete it if there's an old one still there
-        try:
-            os.remove(self.local_name)
-        except:
-            pass # wasn't there, okay
-        self.log_sock.bind(self.local_name)
+        PacketLogger.__init__(self, "/tmp/logd-stm32", pipe_name)
 
-    def uninit(self):
-        os.remove(self.local_name)
+    # pktTime is datetime
+    def log_packet(self, pktTime, pkt):
+        self.log_record(TYPE_STM32_PACKET,
+                        TIME_US.pack(datetime_us(pktTime)) + pkt)
+
+
+class PixInLogger(PacketLogger):
+
+    def __init__(self, pipe_name=PIPE_NAME_DEFAULT):
+        PacketLogger.__init__(self, "/tmp/logd-pixin", pipe_name)
 
     def log_packet(self, pkt):
-        data = (TYPE_PIXIN_PACKET, datetime.datetime.now(), pkt)
-        pick = cPickle.dumps(data)
-        try:
-            self.log_sock.sendto(pick, self.pipe_name)
-        except:
-            pass # logger is dead
+        self.log_record(TYPE_PIXIN_PACKET, pkt)
 
 
-class PixOutLogger(object):
+class PixOutLogger(PacketLogger):
 
     def __init__(self, pipe_name=PIPE_NAME_DEFAULT):
-        self.log_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        self.local_name = "/tmp/logd-pixout"
-        self.pipe_name = pipe_name
-        # delete it if there's an old one still there
-        try:
-            os.remove(self.local_name)
-        except:
-            pass # wasn't there, okay
-        self.log_sock.bind(self.local_name)
-
-    def uninit(self):
-        os.remove(self.local_name)
+        PacketLogger.__init__(self, "/tmp/logd-pixout", pipe_name)
 
     def log_packet(self, pkt):
-        data = (TYPE_PIXOUT_PACKET, datetime.datetime.now(), pkt)
-        pick = cPickle.dumps(data)
-        try:
-            self.log_sock.sendto(pick, self.pipe_name)
-        except:
-            pass # logger is dead
+        self.log_record(TYPE_PIXOUT_PACKET, pkt)
+
+
+class Decimator(object):
+    """keeps one of every 'every' records (none if 'every' is 0)"""
+
+    def __init__(self, every):
+        self.every = every
+        self.count = 0
+        self.kept = 0
+        self.skipped = 0
+
+    def keep(self):
+        self.count += 1
+        if self.every > 0 and self.count >= self.every:
+            self.count = 0
+            self.kept += 1
+            return True
+        self.skipped += 1
+        return False
+
+
+def load_config(conf_name=CONF_NAME_DEFAULT):
+    """read the [logd] section; returns ({kind: every}, compress)"""
+    import ConfigParser
+    config = ConfigParser.SafeConfigParser()
+    config.read(conf_name)
+    policies = { }
+    compress = False
+    if not config.has_section("logd"):
+        return policies, compress
+    for option in config.options("logd"):
+        if option == "compress":
+            compress = config.getboolean("logd", option)
+        else:
+            policies[option] = config.getint("logd", option)
+    return policies, compress
 
 
 class Logger(object):
 
     # XXX get from config file
 
+    # Log files are numbered in the order they are started (the highest is
+    # the current one), and the sizes of the others are kept in a ledger,
+    # oldest first. Rolling starts the next number; nothing is renamed, and
+    # only the oldest files are deleted. The ledger is made from the log
+    # directory once, at startup.
+
     # If we roll the log and have more than MAX_FILES, old files are deleted
     # to get down to MAX_FILES.
     MAX_FILES = 50
@@ -113,12 +207,39 @@ class Logger(object):
     # deleted to get down to MAX_BYTES.
     MAX_BYTES = 75000000 # 90% of a 100 MB partition (~85 MB usable)
 
-    def __init__(self, pipe_name, file_root, file_ext):
+    # Buffered records are written to the log file this often
+    FLUSH_INTERVAL_US = 5000000
+    FILE_BUFFER_BYTES = 65536
+
+    # A TYPE_TIME_SYNC record is written at least this often
+    SYNC_INTERVAL_US = 60000000
+
+    def __init__(self, pipe_name, file_root, file_ext, policies=None,
+                 compress=False):
+        # (file number, name, bytes) for each log file but the current one,
+        # oldest first; total_bytes is all of them and the current one
+        self.ledger = collections.deque()
         self.total_bytes = 0
-        self.epoch = datetime.datetime(1970, 1, 1)
+        self.file_num = -1
+        # current log file, its size, and when it must next be flushed (None
+        # if nothing is waiting)
+        self.logfile = None
+        self.file_bytes = 0
+        self.flush_us = None
+        self.sync_us = None
+        self.records = 0
+        self.bad_records = 0
         self.pipe_name = pipe_name
         self.file_root = file_root
         self.file_ext = file_ext
+        # zlib stream for the current file, if compressing
+        self.compress = compress
+        self.compressor = None
+        # Decimator by type ID, or by (type ID, subtype)
+        self.policies = { }
+        self.subtype_offsets = { }
+        for kind, every in (policies or { }).items():
+            self.add_policy(kind, every)
         # delete named socket if left over from a previous run
         try:
             os.remove(self.pipe_name)
@@ -131,261 +252,200 @@ class Logger(object):
         except:
             print "ERROR creating pipe %s" % (self.pipe_name,)
             raise
+        self.load_ledger()
         # always start with a new log file
         self.roll()
 
     def file_name(self, n):
-        return "%s.%03d.%s" % (self.file_root, n, self.file_ext)
-
-    # RC packets as received from STM32 serial port on Artoo
-    def format_stm32(self, data_tuple):
-        # data_tuple is:
-        #   integer  typeId
-        #   datetime logTime
-        #   datetime pktTime
-        #   string   packet
-
-        typeId = data_tuple[0]
-        logTime = data_tuple[1]
-        pktTime = data_tuple[2]
-        pkt = data_tuple[3]
-
-        logTime = logTime - self.epoch # timedelta
-        pktTime = pktTime - self.epoch # timedelta
-        pktLen = len(pkt)
-
-        if pktLen > 0:
-            pktId = ord(pkt[0])
-        else:
-            pktId = -1
-
-        s1 = "%d,%d,%d,%d,%d,%d,%d" % (typeId,
-                                       logTime.days * 86400 + logTime.seconds,
-                                       logTime.microseconds,
-                                       pktTime.days * 86400 + pktTime.seconds,
-                                       pktTime.microseconds,
-                                       pktLen,
-                                       pktId)
-
-        if pktId == 0:
-            s2 = ",%s\n" % (pkt[1:],)
-        elif pktId == PKT_ID_DSM:
-            if pktLen == 17:
-                s2 = ",%d,%d,%d,%d,%d,%d,%d,%d\n" % (ord(pkt[2]) * 256 + ord(pkt[1]),
-                                                     ord(pkt[4]) * 256 + ord(pkt[3]),
-                                                     ord(pkt[6]) * 256 + ord(pkt[5]),
-                                                     ord(pkt[8]) * 256 + ord(pkt[7]),
-                                                     ord(pkt[10]) * 256 + ord(pkt[9]),
-                                                     ord(pkt[12]) * 256 + ord(pkt[11]),
-                                                     ord(pkt[14]) * 256 + ord(pkt[13]),
-                                                     ord(pkt[16]) * 256 + ord(pkt[15]))
-            else:
-                s2 = "\n"
-        elif pktId == PKT_ID_SYSINFO:
-            # 12 bytes unique_id
-            # 2 bytes hw_version
-            # string sw_version
-            if pktLen >= 13:
-                # unique_id
-                s2 = ",%02x:%02x:%02x:%02x:%02x:%02x:%02x:%02x:%02x:%02x:%02x:%02x" % \
-                    (ord(pkt[1]), ord(pkt[2]), ord(pkt[3]), ord(pkt[4]),
-                     ord(pkt[5]), ord(pkt[6]), ord(pkt[7]), ord(pkt[8]),
-                     ord(pkt[9]), ord(pkt[10]), ord(pkt[11]), ord(pkt[12]))
-                if pktLen >= 15:
-                    # hw_version
-                    s2 += ",%02x:%02x" % (ord(pkt[13]), ord(pkt[14]))
-                    if pktLen >= 16:
-                        # sw_version
-                        s2 += ",%s" % ("".join(pkt[15:]),)
-                s2 += "\n"
+        name = "%s.%06d.%s" % (self.file_root, n, self.file_ext)
+        if self.compress:
+            name += ".z"
+        return name
+
+    def add_policy(self, kind, every):
+        """log one of every 'every' records of 'kind', a type name or
+        type_subtype (e.g. stm32_dsm)"""
+        for typeId, (name, offset, subtype_names) in record_types.items():
+            if typeId == TYPE_TIME_SYNC:
+                continue
+            if kind == name:
+                self.policies[typeId] = Decimator(every)
+                return
+            for subtype, subtype_name in subtype_names.items():
+                if kind == (name + "_" + subtype_name):
+                    self.policies[(typeId, subtype)] = Decimator(every)
+                    self.subtype_offsets[typeId] = \
+                        RECORD_HEADER.size + offset
+                    return
+        print "unknown record kind %s" % (kind,)
+
+    def policy(self, typeId, data):
+        """the Decimator for a record, or None to log it"""
+        offset = self.subtype_offsets.get(typeId)
+        if offset is not None and len(data) > offset:
+            policy = self.policies.get((typeId, ord(data[offset])))
+            if policy is not None:
+                return policy
+        return self.policies.get(typeId)
+
+    def load_ledger(self):
+        """find the log files there are already, and their sizes"""
+        log_dir, prefix = os.path.split(self.file_root)
+        prefix += "."
+        files = [ ]
+        # CSV logs from before the binary format, where .000 was the newest;
+        # they are older than any binary log, so they are pruned first
+        legacy = [ ]
+        legacy_suffix = "." + LEGACY_FILE_EXT
+        for name in os.listdir(log_dir or "."):
+            if not name.startswith(prefix):
+                continue
+            # either compressed or not, whatever this run does
+            for suffix in ("." + self.file_ext, "." + self.file_ext + ".z",
+                           legacy_suffix):
+                if name.endswith(suffix):
+                    num = name[len(prefix):-len(suffix)]
+                    break
             else:
-                s2 = "\n"
-        else:
-            s2 = "\n"
-
-        return s1 + s2
-
-    # RC packets as received from UDP port on Solo
-    def format_pixin(self, data_tuple):
-        # data_tuple is:
-        #   integer  typeId
-        #   datetime logTime
-        #   string   packet
-
-        typeId = data_tuple[0]
-        logTime = data_tuple[1]
-        pkt = data_tuple[2]
-
-        logTime = logTime - self.epoch # timedelta
-        pktLen = len(pkt)
-
-        if pktLen != 26:
-            s = "%d,%d,%d\n" % (typeId,
-                                logTime.days * 86400 + logTime.seconds,
-                                logTime.microseconds)
-            return s
-
-        # packet is:
-        #   pktTime.usec    32 bits
-        #   pktTime.sec     32 bits
-        #   sequence        16 bits
-        #   channel 1       16 bits
-        #   :
-        #   channel 8       16 bits
-        (usec, sec, seq, ch1, ch2, ch3, ch4, ch5, ch6, ch7, ch8) = \
-            struct.unpack("<IIHHHHHHHHH", pkt)
-
-        s = "%d,%d,%d,%d,%d,%d,%d,%d,%d,%d,%d,%d,%d,%d\n" % \
-            (typeId,
-             logTime.days * 86400 + logTime.seconds, logTime.microseconds,
-             sec, usec, seq, ch1, ch2, ch3, ch4, ch5, ch6, ch7, ch8)
-
-        return s
-
-    # RC packets as sent over serial port to Pixhawk
-    def format_pixout(self, data_tuple):
-        # data_tuple is:
-        #   integer  typeId
-        #   datetime logTime
-        #   string   packet
-
-        typeId = data_tuple[0]
-        logTime = data_tuple[1]
-        pkt = data_tuple[2]
-
-        logTime = logTime - self.epoch # timedelta
-        pktLen = len(pkt)
-
-        s = "%d,%d,%d" % (typeId,
-                          logTime.days * 86400 + logTime.seconds,
-                          logTime.microseconds)
-
-        # packet is BIG endian:
-        #   magic           16 bits
-        #   channel 1       16 bits
-        #   :
-        #   channel 7       16 bits
-        # and if 32 bytes:
-        #   magic           16 bits
-        #   channel 8       16 bits
-        #   :
-        #   channel 14      16 bits
-        # and each channel is (one-based channel numbers):
-        #   (chNum-1 << 11) | (chDat & 0x07ff)
-
-        if pktLen != 16 and pktLen != 32:
-            return s + "\n"
-
-        pktIdx = 0
-        while pktIdx < pktLen:
-            # magic
-            s += ",%d" % struct.unpack(">H", pkt[pktIdx:pktIdx+2])
-            pktIdx += 2
-            # channels
-            for chIdx in range(1, 8):
-                (chRaw,) = struct.unpack(">H", pkt[pktIdx:pktIdx+2])
-                pktIdx += 2
-                chNum = (chRaw >> 11) & 0xf
-                chVal = chRaw & 0x7ff
-                s += ",%d,%d" % (chNum, chVal)
-
-        return s + "\n"
-
-    def roll(self):
-        # If there is not a log file, do nothing.
-        # Otherwise, rename it to
-        #     file_root.001.file_ext
-        # bumping all old ones up. We keep up to MAX_FILES.
-        #
-        # The end result is:
-        #     file_root.000.file_ext   current
-        #     file_root.001.file_ext      |
-        #     file_root.002.file_ext      v
-        #     file_root.003.file_ext    oldest
-        # where ".003" goes up to MAX_FILES-1.
-
-        self.total_bytes = 0
-
-        try:
-            stat_info = os.stat(self.file_name(0))
-        except:
-            return # "current" file not there, nothing to do
-
-        # Rename files, starting from high numbers and working down. This takes
-        # care of the MAX_FILES limit (the highest-numbered file is just
-        # overwritten).
-        for file_num in range(self.MAX_FILES-1, 0, -1):
-            src = self.file_name(file_num-1)
+                continue
+            if not num.isdigit():
+                continue
+            path = os.path.join(log_dir, name)
             try:
-                stat_info = os.stat(src)
+                stat_info = os.stat(path)
             except:
-                # file does not exist
                 continue
-            # file exists
-            self.total_bytes += stat_info.st_size
-            dst = self.file_name(file_num)
+            if suffix == legacy_suffix:
+                legacy.append((int(num), path, stat_info.st_size))
+            else:
+                files.append((int(num), path, stat_info.st_size))
+        files.sort()
+        legacy.sort(reverse=True)
+        self.ledger = collections.deque(legacy + files)
+        self.total_bytes = sum([ size for num, path, size in self.ledger ])
+        if files:
+            self.file_num = files[-1][0]
+
+    def roll(self):
+        """close the current log file (if any) and start the next one"""
+        if self.logfile is not None:
+            self.close()
+            self.ledger.append((self.file_num, self.file_name(self.file_num),
+                                self.file_bytes))
+        self.file_num += 1
+        self.open()
+        self.prune()
+
+    def prune(self):
+        """delete the oldest log files until within MAX_FILES and MAX_BYTES"""
+        ledger = self.ledger
+        while ledger and (len(ledger) >= self.MAX_FILES or
+                          self.total_bytes > self.MAX_BYTES):
+            file_num, src, size = ledger.popleft()
+            if debug:
+                print "delete %s" % (src,)
             try:
-                os.rename(src, dst)
-                if debug:
-                    print "rename %s to %s" % (src, dst)
+                os.remove(src)
             except:
-                pass # error renaming file?
-        ### end for file_num
-
-    def check_size(self):
-        """check total size of logs and delete log files as necessary"""
+                pass # already gone
+            self.total_bytes -= size
 
-        # if current log file is over 10% of the total, do a roll
+    def open(self):
+        """start a new current log file"""
         try:
-            stat_info = os.stat(self.file_name(0))
+            self.logfile = open(self.file_name(self.file_num), "ab",
+                                self.FILE_BUFFER_BYTES)
         except:
-            return # "current" file not there, nothing to do
+            print "ERROR opening log file %s for writing" % \
+                (self.file_name(self.file_num),)
+            raise
+        self.file_bytes = 0
+        self.sync_us = None
+        if self.compress:
+            self.compressor = zlib.compressobj()
+
+    def close(self):
+        if self.logfile is not None:
+            if self.compressor is not None:
+                self.write_file(self.compressor.flush())
+                self.compressor = None
+            self.logfile.close()
+            self.logfile = None
+            self.flush_us = None
+
+    def flush(self):
+        if self.logfile is not None:
+            if self.compressor is not None:
+                # everything so far can be decompressed even if we stop here
+                self.write_file(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.logfile.flush()
+        self.flush_us = None
+
+    def write_file(self, data):
+        self.logfile.write(data)
+        self.file_bytes += len(data)
+        self.total_bytes += len(data)
+
+    def write(self, data, now_us):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.write_file(data)
+        if self.flush_us is None:
+            self.flush_us = now_us + self.FLUSH_INTERVAL_US
+
+    def write_sync(self, now_us):
+        real_us = clock.gettime_us(clock.CLOCK_REALTIME)
+        self.write(RECORD_HEADER.pack(TYPE_TIME_SYNC, now_us, TIME_US.size) +
+                   TIME_US.pack(real_us), now_us)
+        self.sync_us = now_us
+
+    def log(self, data, now_us):
+        """log one record as received from a sender"""
+        if len(data) < RECORD_HEADER.size:
+            self.bad_records += 1
+            return
+        typeId, time_us, length = RECORD_HEADER.unpack_from(data)
+        if length != (len(data) - RECORD_HEADER.size):
+            self.bad_records += 1
+            return
+        if self.policies:
+            policy = self.policy(typeId, data)
+            if policy is not None and not policy.keep():
+                return
+        if self.sync_us is None or \
+           (now_us - self.sync_us) >= self.SYNC_INTERVAL_US:
+            self.write_sync(now_us)
+        self.write(data, now_us)
+        self.records += 1
+        self.check_size()
 
-        if stat_info.st_size >= self.MAX_FILE_BYTES:
-            self.roll()
+    def check_size(self):
+        """roll the log, or delete old log files, as necessary"""
 
-        # delete files until the total number of bytes is less that the max
-        for file_num in range(self.MAX_FILES-1, 0, -1):
-            if self.total_bytes <= self.MAX_BYTES:
-                break
-            src = self.file_name(file_num)
-            try:
-                stat_info = os.stat(src)
-                if debug:
-                    print "delete %s" % (src,)
-                os.remove(src)
-                self.total_bytes -= stat_info.st_size
-            except:
-                pass # does not exist
+        # if current log file is over 10% of the total, do a roll (what has
+        # been written is counted, since some of it may not be in the file
+        # yet)
+        if self.file_bytes >= self.MAX_FILE_BYTES:
+            self.roll()
+        elif self.total_bytes > self.MAX_BYTES:
+            self.prune()
 
     def run(self):
+        # Wait for records, waking up to flush if there is anything waiting
+        # to be written
         while True:
-            data = self.sock.recv(1024)
-            # data is pickled python, consisting of an integer type indicator
-            # followed by type-specific data.
-            try:
-                data_tuple = cPickle.loads(data)
-            except:
-                pickle_error += 1
-                continue
-            typeId = data_tuple[0]
-            if typeId == TYPE_STM32_PACKET:
-                s = self.format_stm32(data_tuple)
-            elif typeId == TYPE_PIXIN_PACKET:
-                s = self.format_pixin(data_tuple)
-            elif typeId == TYPE_PIXOUT_PACKET:
-                s = self.format_pixout(data_tuple)
+            if self.flush_us is None:
+                timeout = None
             else:
-                s = "%d" % (typeId,)
-            try:
-                logfile = open(self.file_name(0), "a")
-            except:
-                print "ERROR opening log file %s for writing" % (self.file_name(0),)
-                raise
-            logfile.write(s)
-            logfile.close()
-            self.total_bytes += len(s)
-            self.check_size()
+                now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+                timeout = max(self.flush_us - now_us, 0) / 1000000.0
+            ready, w, x = select.select([self.sock], [], [], timeout)
+            now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+            if ready:
+                data = self.sock.recv(RECORD_MAX)
+                self.log(data, now_us)
+            if self.flush_us is not None and now_us >= self.flush_us:
+                self.flush()
 
 
 def is_dir(path):
@@ -410,6 +470,10 @@ if __name__ == "__main__":
     parser.add_option("--file", dest="file_root", type="string", default=None,
                       help="log file name root")
 
+    parser.add_option("--conf", dest="conf_name", type="string",
+                      default=CONF_NAME_DEFAULT,
+                      help="config file ([logd] section)")
+
     (opts, args) = parser.parse_args()
 
     pipe_name = PIPE_NAME_DEFAULT
@@ -427,9 +491,11 @@ if __name__ == "__main__":
     if opts.file_root is not None:
         file_root = opts.file_root
 
-    file_ext = "csv"
+    file_ext = "bin"
+
+    policies, compress = load_config(opts.conf_name)
 
-    logger = Logger(pipe_name, file_root, file_ext)
+    logger = Logger(pipe_name, file_root, file_ext, policies, compress)
 
     os.nice(19)
 
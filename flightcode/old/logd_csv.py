@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+# Convert logd logs (see logd.py) to CSV, one line per record, the same as
+# logd used to write:
+#
+#   logd_csv.py [--out file.csv] 3dr-logd.000041.bin 3dr-logd.000042.bin.z
+#
+# (logs are numbered oldest first; ".z" logs are compressed).
+#
+# Times in the CSV are wall clock (seconds, usec), from each record's
+# monotonic time and the last TYPE_TIME_SYNC record before it.
+
+import struct
+import sys
+import zlib
+
+import logd
+from stm32_defs import *
+
+
+# RC packets as received from STM32 serial port on Artoo
+def format_stm32(typeId, logTime_us, payload):
+    # payload is:
+    #   pktTime usec    64 bits
+    #   packet
+
+    (pktTime_us, ) = logd.TIME_US.unpack_from(payload)
+    pkt = payload[logd.TIME_US.size:]
+    pktLen = len(pkt)
+
+    if pktLen > 0:
+        pktId = ord(pkt[0])
+    else:
+        pktId = -1
+
+    s1 = "%d,%d,%d,%d,%d,%d,%d" % ((typeId, ) +
+                                   divmod(logTime_us, 1000000) +
+                                   divmod(pktTime_us, 1000000) +
+                                   (pktLen, pktId))
+
+    if pktId == 0:
+        s2 = ",%s\n" % (pkt[1:],)
+    elif pktId == PKT_ID_DSM:
+        if pktLen == 17:
+            s2 = ",%d,%d,%d,%d,%d,%d,%d,%d\n" % struct.unpack("<8H", pkt[1:])
+        else:
+            s2 = "\n"
+    elif pktId == PKT_ID_SYSINFO:
+        # 12 bytes unique_id
+        # 2 bytes hw_version
+        # string sw_version
+        if pktLen >= 13:
+            # unique_id
+            s2 = "," + ":".join([ "%02x" % ord(c) for c in pkt[1:13] ])
+            if pktLen >= 15:
+                # hw_version
+                s2 += ",%02x:%02x" % (ord(pkt[13]), ord(pkt[14]))
+                if pktLen >= 16:
+                    # sw_version
+                    s2 += ",%s" % (pkt[15:],)
+            s2 += "\n"
+        else:
+            s2 = "\n"
+    else:
+        s2 = "\n"
+
+    return s1 + s2
+
+
+# RC packets as received from UDP port on Solo
+def format_pixin(typeId, logTime_us, pkt):
+    logTime_s, logTime_us = divmod(logTime_us, 1000000)
+
+    if len(pkt) != 26:
+        return "%d,%d,%d\n" % (typeId, logTime_s, logTime_us)
+
+    # packet is:
+    #   pktTime.usec    32 bits
+    #   pktTime.sec     32 bits
+    #   sequence        16 bits
+    #   channel 1       16 bits
+    #   :
+    #   channel 8       16 bits
+    (usec, sec, seq, ch1, ch2, ch3, ch4, ch5, ch6, ch7, ch8) = \
+        struct.unpack("<IIHHHHHHHHH", pkt)
+
+    return "%d,%d,%d,%d,%d,%d,%d,%d,%d,%d,%d,%d,%d,%d\n" % \
+        (typeId, logTime_s, logTime_us,
+         sec, usec, seq, ch1, ch2, ch3, ch4, ch5, ch6, ch7, ch8)
+
+
+# RC packets as sent over serial port to Pixhawk
+def format_pixout(typeId, logTime_us, pkt):
+    pktLen = len(pkt)
+
+    s = "%d,%d,%d" % ((typeId, ) + divmod(logTime_us, 1000000))
+
+    # packet is BIG endian:
+    #   magic           16 bits
+    #   channel 1       16 bits
+    #   :
+    #   channel 7       16 bits
+    # and if 32 bytes:
+    #   magic           16 bits
+    #   channel 8       16 bits
+    #   :
+    #   channel 14      16 bits
+    # and each channel is (one-based channel numbers):
+    #   (chNum-1 << 11) | (chDat & 0x07ff)
+
+    if pktLen != 16 and pktLen != 32:
+        return s + "\n"
+
+    words = struct.unpack(">%dH" % (pktLen / 2), pkt)
+    for i in range(0, len(words), 8):
+        # magic
+        s += ",%d" % (words[i], )
+        # channels
+        for chRaw in words[i+1:i+8]:
+            s += ",%d,%d" % ((chRaw >> 11) & 0xf, chRaw & 0x7ff)
+
+    return s + "\n"
+
+
+# CSV line for each record type, by type ID, as decoder(typeId, logTime_us,
+# payload)
+decoders = { }
+
+def register_decoder(typeId, decoder):
+    decoders[typeId] = decoder
+
+register_decoder(logd.TYPE_STM32_PACKET, format_stm32)
+register_decoder(logd.TYPE_PIXIN_PACKET, format_pixin)
+register_decoder(logd.TYPE_PIXOUT_PACKET, format_pixout)
+
+
+def format_unknown(typeId, logTime_us, payload):
+    return "%d\n" % (typeId,)
+
+
+def records(data):
+    """(type, monotonic usec, payload) for each record in a log; a record
+    cut short (e.g. by a power loss) ends it"""
+    offset = 0
+    while offset + logd.RECORD_HEADER.size <= len(data):
+        typeId, time_us, length = \
+            logd.RECORD_HEADER.unpack_from(data, offset)
+        offset += logd.RECORD_HEADER.size
+        if offset + length > len(data):
+            break
+        yield typeId, time_us, data[offset:offset + length]
+        offset += length
+
+
+def convert(data, out):
+    """write the CSV for one log's records to file 'out'"""
+    # wall clock usec = monotonic usec + offset_us
+    offset_us = None
+    for typeId, time_us, payload in records(data):
+        if typeId == logd.TYPE_TIME_SYNC:
+            (real_us, ) = logd.TIME_US.unpack(payload)
+            offset_us = real_us - time_us
+            continue
+        if offset_us is None:
+            # every log starts with a sync record
+            continue
+        decoder = decoders.get(typeId, format_unknown)
+        out.write(decoder(typeId, time_us + offset_us, payload))
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser("logd_csv.py [options] log ...")
+
+    parser.add_option("--out", dest="out_name", type="string", default=None,
+                      help="CSV file to write (default stdout)")
+
+    (opts, args) = parser.parse_args()
+
+    if len(args) == 0:
+        parser.error("no logs")
+
+    if opts.out_name is not None:
+        out = open(opts.out_name, "w")
+    else:
+        out = sys.stdout
+
+    for log_name in args:
+        f = open(log_name, "rb")
+        data = f.read()
+        f.close()
+        if log_name.endswith(".z"):
+            # the current log may not be finished; take what is there
+            data = zlib.decompressobj().decompress(data)
+        convert(data, out)
+
+    out.close()
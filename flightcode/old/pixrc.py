@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import clock
 import ConfigParser
 import datetime
 import errno
@@ -8,11 +9,14 @@ import logging
 import logging.config
 import optparse
 import os
+import rc_link_quality
+import rc_pack
+import select
 import serial
 import simple_stats
 import socket
-import struct
 import sys
+import telem_metrics
 import threading
 import time
 
@@ -34,12 +38,15 @@ rcSourceIps = config.get("solo", "rcSourceIps").split(",")
 # RC packets arrive on this port
 rcDestPort = config.getint("solo", "rcDestPort")
 
+# RC link quality is available on this socket (rc_link_quality.py)
+try:
+    rcLinkSock = config.get("solo", "rcLinkSock")
+except ConfigParser.Error:
+    rcLinkSock = rc_link_quality.DEFAULT_SOCK_NAME
+
 logger.info("accept RC packets from %s on port %d",
             rcSourceIps.__str__(), rcDestPort)
 
-CHANNEL_BITS = 11
-CHANNEL_MASK = 0x7ff
-
 SOCKET_TIMEOUT = 0.4
 DSM_INTERVAL = 0.020
 
@@ -49,7 +56,15 @@ rcBeat = 0
 # Debug only; enable/disable sending packets to Pixhawk
 DSM_SEND_ENABLE = True
 
-rcChansOut = None
+# Latest RC for dsmSend, as (sequence, DSM packet). rcReceive replaces the
+# whole tuple with one assignment, which is atomic in python, so dsmSend
+# always gets a packet and its sequence number together, without a lock; the
+# sequence number tells it whether the packet is new since the last send.
+rcOut = (0, None)
+
+# RC link statistics; updated by rcReceive, and linkServe answers requests
+# with its snapshot
+link = rc_link_quality.LinkQuality()
 
 # What we send Pixhawk if we stop receiving RC packets
 # PWM values: [ throttle, roll, pitch, yaw ]
@@ -95,56 +110,128 @@ logger.info("RC failsafe packet is %s", rcFailsafeChans.__str__())
 def rcUnpack(packedData):
     """Unpack RC packet.
 
-    Returns a tuple (timestamp, sequence, channels[]).
+    Returns a tuple (timestamp, sequence, channels[]), or None if the packet
+    is malformed (wrong length, or not 4..14 channels).
+    """
+    rc = rc_pack.rcUnpack(packedData)
+    if rc is None:
+        logger.warn("rcUnpack: malformed packet received (length = %d)",
+                    len(packedData))
+    return rc
+
+
+# Pack channels into DSM packet (rc_pack.py)
+dsmPack = rc_pack.dsmPack
+
+
+class JitterHistogram():
+    """DSM send intervals, counted by how far they are from DSM_INTERVAL"""
+
+    BUCKET_US = 250
+    # buckets cover +/- this much; anything further is in the end buckets
+    RANGE_US = 5000
+
+    def __init__(self, interval_us):
+        self._interval_us = interval_us
+        self._stats = simple_stats.SimpleStats()
+        self.reset()
+
+    def reset(self):
+        self._buckets = [ 0 ] * (2 * JitterHistogram.RANGE_US /
+                                 JitterHistogram.BUCKET_US + 1)
+        self._stats.reset()
+
+    def add(self, interval_us):
+        self._stats.update(interval_us)
+        bucket_us = JitterHistogram.BUCKET_US
+        range_us = JitterHistogram.RANGE_US
+        error_us = interval_us - self._interval_us
+        error_us = min(max(error_us, -range_us), range_us)
+        # nearest bucket; bucket 0 is -range_us
+        self._buckets[(error_us + range_us + bucket_us / 2) / bucket_us] += 1
+
+    def summary(self):
+        stats = self._stats
+        if stats.count() == 0:
+            return "n=0"
+        return "n=%d avg=%0.0f min=%0.0f max=%0.0f stdev=%0.1f" % \
+            (stats.count(), stats.average(), stats.min(), stats.max(),
+             stats.stdev())
+
+    def buckets(self):
+        """nonempty buckets, as a list of (msec from DSM_INTERVAL, count)"""
+        offset = JitterHistogram.RANGE_US / JitterHistogram.BUCKET_US
+        return [ ((b - offset) * JitterHistogram.BUCKET_US / 1000.0,
+                  self._buckets[b])
+                 for b in range(len(self._buckets)) if self._buckets[b] != 0 ]
+
+
+class DeadlineTimer():
+    """Wake up every interval_us on CLOCK_MONOTONIC.
+
+    Each deadline is the previous one plus the interval, and we sleep until
+    it (absolute time), so time spent working or oversleeping doesn't add
+    up. If we fall more than an interval behind, the missed deadlines are
+    skipped (counted in 'late') rather than sent as a burst.
     """
-    # Length of received packet determines how many channels there
-    # are: packet is 8 + 2 + (2 * numChans) bytes
-    # Sanity-check received packet
-    dataLen = len(packedData)
-    if dataLen < 10 or (dataLen & 1) != 0:
-        logger.warn("rcUnpack: malformed packet received (length = %d)", dataLen)
-        return None
-    # require 4..14 channels
-    numChans = (dataLen - 10) / 2
-    if numChans < 4 or numChans > 14:
-        logger.warn("rcUnpack: malformed packet received (%d channels)", numChans)
-        return None
-    timestamp, sequence = struct.unpack("<QH", packedData[:10])
-    channels = [ ]
-    for i in range(10, dataLen, 2):
-        channels.extend(struct.unpack("<H", packedData[i:i+2]))
-    return timestamp, sequence, channels
-
-
-def dsmPack(channels):
-    """Pack channels into DSM packet."""
-    if channels is None:
-        return None
-    dsmPacket = ""
-    channelsLeft = len(channels)
-    channelNum = 0
-    while channelsLeft > 0:
-        dsmPacket += struct.pack(">H", 171)
-        # pack 7 channels before needing another magic
-        for c in range(0, 7):
-            if channelsLeft > 0:
-                # channel value is 1000...2000
-                # needs to be 174...1874
-                value = channels[channelNum]   # 1000...2000
-
-                value = value * 1700 / 1000 - 1526
-                if(value < 0):
-                    value = 0
-                if(value > 2000):
-                    value = 2000;
-
-                chan = (channelNum << CHANNEL_BITS) | (value & CHANNEL_MASK)
-                dsmPacket += struct.pack(">H", chan)
-                channelsLeft -= 1
-                channelNum += 1
-            else:
-                dsmPacket += struct.pack(">H", 65535)
-    return dsmPacket
+
+    def __init__(self, interval_us):
+        self._interval_us = interval_us
+        self._next_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+        self.late = 0
+
+    def wait(self):
+        """sleep until the next deadline; returns the time we woke"""
+        clock.sleep_until_us(clock.CLOCK_MONOTONIC, self._next_us)
+        now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+        self._next_us += self._interval_us
+        if self._next_us <= now_us:
+            missed = (now_us - self._next_us) / self._interval_us + 1
+            self.late += missed
+            self._next_us += missed * self._interval_us
+        return now_us
+
+
+class _SleepTimer():
+    """the way dsmSend used to wait, sleeping DSM_INTERVAL after each send
+    (for jitterTest)"""
+
+    def __init__(self, interval_us):
+        self._interval = interval_us / 1000000.0
+        self._first = True
+        self.late = 0
+
+    def wait(self):
+        if not self._first:
+            time.sleep(self._interval)
+        self._first = False
+        return clock.gettime_us(clock.CLOCK_MONOTONIC)
+
+
+def jitterTest(seconds):
+    """Print a histogram of send intervals with each timer, with
+    dsmPack as the work done between sends, and nothing sent."""
+    interval_us = int(DSM_INTERVAL * 1000000)
+    channels = [ 1500 ] * 8
+    for timerClass in (_SleepTimer, DeadlineTimer):
+        timer = timerClass(interval_us)
+        histogram = JitterHistogram(interval_us)
+        start_us = timer.wait()
+        last_us = start_us
+        sends = 0
+        while (last_us - start_us) < (seconds * 1000000):
+            dsmPack(channels)
+            now_us = timer.wait()
+            histogram.add(now_us - last_us)
+            last_us = now_us
+            sends += 1
+        expected = (last_us - start_us) / interval_us
+        print "%s: %d sends in %0.3f sec (%d expected), %d late" % \
+            (timerClass.__name__, sends, (last_us - start_us) / 1000000.0,
+             expected, timer.late)
+        print "  " + histogram.summary()
+        for msec, count in histogram.buckets():
+            print "  %+6.2f msec %6d" % (msec, count)
 
 
 def dsmSend(devName, baudRate):
@@ -165,12 +252,24 @@ def dsmSend(devName, baudRate):
     pixOutLogger = None
     #pixOutLogger = logd.PixOutLogger()
 
+    interval_us = int(DSM_INTERVAL * 1000000)
+    timer = DeadlineTimer(interval_us)
+    jitter = JitterHistogram(interval_us)
+    # sends that repeated the previous packet (no new RC in between)
+    stale = 0
+    sequenceLast = None
+    sendLast_us = None
+
+    # Log the send intervals periodically
+    logInterval_us = 10000000
+    logNext_us = clock.gettime_us(clock.CLOCK_MONOTONIC) + logInterval_us
+
     while True:
         dsmBeat += 1
 
-        rcDsmLock.acquire()
-        dsmBytes = dsmPack(rcChansOut)
-        rcDsmLock.release()
+        now_us = timer.wait()
+
+        sequence, dsmBytes = rcOut
 
         if dsmBytes is None:
             logger.debug("dsmSend: None")
@@ -183,12 +282,25 @@ def dsmSend(devName, baudRate):
                 pixOutLogger.log_packet(dsmBytes)
             serialPort.write(dsmBytes)
 
-        time.sleep(DSM_INTERVAL)
+        if sendLast_us is not None:
+            jitter.add(now_us - sendLast_us)
+        sendLast_us = now_us
+        if sequence == sequenceLast:
+            stale += 1
+        sequenceLast = sequence
+
+        if now_us >= logNext_us:
+            logger.info("dsm: stale=%d late=%d interval %s",
+                        stale, timer.late, jitter.summary())
+            logger.info("dsm: interval error (msec): %s",
+                        " ".join([ "%+.2f:%d" % b for b in jitter.buckets() ]))
+            jitter.reset()
+            logNext_us += logInterval_us
 
 
 def rcReceive(udpPortNum):
     global rcBeat
-    global rcChansOut
+    global rcOut
 
     logger.info("rcReceive running")
 
@@ -213,15 +325,9 @@ def rcReceive(udpPortNum):
     nextWarnTime = None
     warnInterval = datetime.timedelta(seconds = 5)
 
-    # The sequence number is used to detect and count dropped packets. We
-    # increment dropCnt for "small" gaps in the sequence (incrementing it by
-    # the number of packets dropped), and increment discCnt for "large" gaps
-    # (discontinuities). goodCnt is incremented for packets receive in sequence.
-    rcSeqPrev = None
-    dropCnt = 0
-    goodCnt = 0
-    discCnt = 0
-    discGap = 5
+    # The sequence number is used to detect and count dropped packets, and
+    # the arrival times for packet gaps and bursts; link (rc_link_quality)
+    # keeps the counts and histograms.
 
     # Packets received less than this much time after the previous one are
     # discarded, under the assumption that it is part of a burst. The last
@@ -253,6 +359,7 @@ def rcReceive(udpPortNum):
         try:
             rcBytes, addr = sock.recvfrom(256)
         except socket.timeout:
+            link.timeout(clock.gettime_us(clock.CLOCK_MONOTONIC))
             now = datetime.datetime.now()
             if nextWarnTime is None or now >= nextWarnTime:
                 logger.warn("socket timeout: sending failsafe packet")
@@ -262,6 +369,7 @@ def rcReceive(udpPortNum):
             rcChans = rcFailsafeChans
             rcTimePrev = rcTime
         else:
+            now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
             nowDsmLast = nowDsm
             nowDsm = datetime.datetime.now()
             now = nowDsm
@@ -277,7 +385,10 @@ def rcReceive(udpPortNum):
             if not addr[0] in rcSourceIps:
                 logger.warn("packet from %s ignored", addr[0])
                 continue
-            rcTime, rcSeq, rcChans = rcUnpack(rcBytes)
+            rc = rcUnpack(rcBytes)
+            if rc is None:
+                continue
+            rcTime, rcSeq, rcChans = rc
             # Check sequence - just require that the timestamp is increasing.
             # But... if we see enough "old" packets in a row (oldPktRestart),
             # we assume the timestamp has started over and start accepting
@@ -294,33 +405,17 @@ def rcReceive(udpPortNum):
 
             # The packet is later than the previous one; look for missed
             # packets (diagnostic).
-            # 64K packets wraps after about 21m 50s; test with wrap at 256 (5s)
-            rcSeqMax = 65536
-            #rcSeqMax = 256
-            #rcSeq = rcSeq & (rcSeqMax - 1)
-            if rcSeqPrev is None:
-                rcSeqPrev = rcSeq
-            else:
-                # mod-64K subtract
-                gap = rcSeq - rcSeqPrev
-                if gap < 0:
-                    gap += rcSeqMax
-                if gap == 1:
-                    goodCnt += 1
-                else:
-                    if gap <= discGap:
-                        dropCnt += (gap - 1)
-                    else:
-                        discCnt += 1
-                    logger.info("gap=%d good=%d drop=%d disc=%d",
-                                gap, goodCnt, dropCnt, discCnt)
-                rcSeqPrev = rcSeq
+            gap = link.packet(now_us, rcSeq)
+            if gap is not None and gap != 1:
+                logger.info("gap=%d good=%d drop=%d disc=%d",
+                            gap, link.good, link.drop, link.disc)
 
         logger.debug("%s %s %s",
                      rcTime.__str__(), rcSeq.__str__(), rcChans.__str__())
 
         if now > logTime:
-            logger.info("good=%d drop=%d disc=%d", goodCnt, dropCnt, discCnt)
+            logger.info("good=%d drop=%d disc=%d",
+                        link.good, link.drop, link.disc)
             count = stats.count()
             if count > 0:
                 logger.info("n=%d avg=%0.0f min=%0.0f max=%0.0f stdev=%0.1f",
@@ -331,22 +426,35 @@ def rcReceive(udpPortNum):
 
         # Make new RC data available to dsmSend thread. rcChans was either set
         # to the new RC data if we got it, or to the failsafe packet if not.
-        rcDsmLock.acquire()
-        rcChansOut = rcChans
-        rcDsmLock.release()
+        # Only this thread assigns rcOut.
+        rcOut = (rcOut[0] + 1, dsmPack(rcChans))
+
+
+def linkServe(sockName):
+    """answer RC link quality requests (see rc_link_quality.py)"""
+    logger.info("linkServe: answering on %s", sockName)
+    # link.snapshot is replaced, never changed, so it is safe to send from
+    # this thread
+    server = telem_metrics.MetricsServer(sockName, lambda: link.snapshot)
+    while True:
+        select.select([ server.sock ], [], [])
+        server.handle()
 
 
 
 parser = optparse.OptionParser("pixrc.py [options]")
 parser.add_option("--sim", action="store_true", default=False,
                   help="do not send to Pixhawk")
+parser.add_option("--jitter", type="int", default=None, metavar="SECONDS",
+                  help="print DSM send interval histograms, old timing and "
+                       "new, and exit")
 (opts, args) = parser.parse_args()
 
 os.nice(-20)
 
-# Don't let the RC receive thread update the RC data while the DSM send thread
-# is using it
-rcDsmLock = threading.Lock()
+if opts.jitter:
+    jitterTest(opts.jitter)
+    sys.exit(0)
 
 if DSM_SEND_ENABLE:
     sender = threading.Thread(name = "dsmSend", target = dsmSend, args = (rcDsmDev, rcDsmBaud))
@@ -357,6 +465,13 @@ receiver = threading.Thread(name = "rcReceive", target = rcReceive, args = (rcDe
 receiver.daemon = True
 receiver.start()
 
+# Not watched below; if it stops, only the link quality requests go
+# unanswered
+server = threading.Thread(name = "linkServe", target = linkServe,
+                          args = (rcLinkSock, ))
+server.daemon = True
+server.start()
+
 # When this module exits, the threads will be killed.
 # This loop watches to see that both threads are still running, and if either
 # stops, it exits, causing init to restart this module.
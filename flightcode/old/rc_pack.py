@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# RC packet unpacking and DSM packing for pixrc.py (the formats are described
+# there).
+#
+# Both run for every RC packet (50 Hz) at real-time priority, so the per-
+# channel work is kept out of python where possible: the RC packet is
+# unpacked with one precompiled Struct per channel count, the 1000..2000 ->
+# 174..1874 scaling is a lookup table, and the DSM packet is packed with one
+# precompiled Struct per number of 16-byte frames.
+
+import struct
+
+CHANNEL_BITS = 11
+CHANNEL_MASK = 0x7ff
+
+DSM_MAGIC = 0x00ab
+DSM_UNUSED = 0xffff
+DSM_CHANNELS_PER_FRAME = 7
+
+# an RC packet has this many channels
+RC_CHANNELS_MIN = 4
+RC_CHANNELS_MAX = 14
+
+# RC packet: timestamp, sequence, channels; by packet length
+_rcStructs = { }
+for n in range(RC_CHANNELS_MIN, RC_CHANNELS_MAX + 1):
+    s = struct.Struct("<QH%dH" % n)
+    _rcStructs[s.size] = s
+
+# Channel number bits, by channel number (the channel number field is 5 bits)
+_channelBits = [ c << CHANNEL_BITS for c in range(32) ]
+
+# DSM packet, by number of frames
+_dsmStructs = [ struct.Struct(">%dH" % (8 * n)) for n in range(6) ]
+
+# Words to fill out a partial frame
+_dsmUnused = [ DSM_UNUSED ] * DSM_CHANNELS_PER_FRAME
+
+
+def _dsmValue(pwm):
+    """PWM (usec, 1000...2000) to DSM channel value (174...1874), clipped"""
+    value = pwm * 1700 / 1000 - 1526
+    if value < 0:
+        value = 0
+    if value > 2000:
+        value = 2000
+    return value & CHANNEL_MASK
+
+# DSM channel value for every (16-bit) PWM value
+_dsmValues = [ _dsmValue(pwm) for pwm in range(65536) ]
+
+
+
+def rcUnpack(packedData):
+    """Unpack RC packet.
+
+    Returns a tuple (timestamp, sequence, channels[]), or None if the length
+    is not that of a packet with 4..14 channels.
+    """
+    s = _rcStructs.get(len(packedData))
+    if s is None:
+        return None
+    fields = s.unpack(packedData)
+    return fields[0], fields[1], list(fields[2:])
+
+
+
+def dsmPack(channels):
+    """Pack channels (PWM values, 16 bits each) into DSM packet."""
+    if channels is None:
+        return None
+    numChans = len(channels)
+    words = [ bits | _dsmValues[pwm]
+              for bits, pwm in zip(_channelBits, channels) ]
+    unused = _dsmUnused[:(-numChans) % DSM_CHANNELS_PER_FRAME]
+    # one or two frames (what an RC packet has) without a loop
+    if 0 < numChans <= DSM_CHANNELS_PER_FRAME:
+        return _dsmStructs[1].pack(DSM_MAGIC, *(words + unused))
+    if DSM_CHANNELS_PER_FRAME < numChans <= (2 * DSM_CHANNELS_PER_FRAME):
+        args = [ DSM_MAGIC ] + words[:DSM_CHANNELS_PER_FRAME] + \
+               [ DSM_MAGIC ] + words[DSM_CHANNELS_PER_FRAME:] + unused
+        return _dsmStructs[2].pack(*args)
+    args = [ ]
+    for i in range(0, numChans, DSM_CHANNELS_PER_FRAME):
+        args.append(DSM_MAGIC)
+        args.extend(words[i:i + DSM_CHANNELS_PER_FRAME])
+    args.extend(unused)
+    return _dsmStructs[len(args) / 8].pack(*args)
+
+
+
+def _rcUnpackLegacy(packedData):
+    """rcUnpack as it was, one struct.unpack per channel (for the test)"""
+    dataLen = len(packedData)
+    if dataLen < 10 or (dataLen & 1) != 0:
+        return None
+    numChans = (dataLen - 10) / 2
+    if numChans < 4 or numChans > 14:
+        return None
+    timestamp, sequence = struct.unpack("<QH", packedData[:10])
+    channels = [ ]
+    for i in range(10, dataLen, 2):
+        channels.extend(struct.unpack("<H", packedData[i:i+2]))
+    return timestamp, sequence, channels
+
+
+
+def _dsmPackLegacy(channels):
+    """dsmPack as it was, one struct.pack per word (for the test)"""
+    if channels is None:
+        return None
+    dsmPacket = ""
+    channelsLeft = len(channels)
+    channelNum = 0
+    while channelsLeft > 0:
+        dsmPacket += struct.pack(">H", 171)
+        for c in range(0, 7):
+            if channelsLeft > 0:
+                value = channels[channelNum]
+                value = value * 1700 / 1000 - 1526
+                if(value < 0):
+                    value = 0
+                if(value > 2000):
+                    value = 2000;
+                chan = (channelNum << CHANNEL_BITS) | (value & CHANNEL_MASK)
+                dsmPacket += struct.pack(">H", chan)
+                channelsLeft -= 1
+                channelNum += 1
+            else:
+                dsmPacket += struct.pack(">H", 65535)
+    return dsmPacket
+
+
+
+if __name__ == "__main__":
+    import random
+    import timeit
+
+    # same results as the old functions, for packets of every length (good
+    # and bad) and channels anywhere in the 16-bit range
+    for i in range(20000):
+        numChans = random.randint(0, 16)
+        if random.randint(0, 1):
+            channels = [ random.randint(0, 65535) for c in range(numChans) ]
+        else:
+            channels = [ random.randint(900, 2100) for c in range(numChans) ]
+        packed = struct.pack("<QH%dH" % numChans,
+                             random.randint(0, 2**64 - 1),
+                             random.randint(0, 65535), *channels)
+        if random.randint(0, 9) == 0:
+            packed = packed[:random.randint(0, len(packed))]
+        elif RC_CHANNELS_MIN <= numChans <= RC_CHANNELS_MAX:
+            # unpacking gets back what was packed
+            assert rcUnpack(packed)[2] == channels
+        assert rcUnpack(packed) == _rcUnpackLegacy(packed), repr(packed)
+        assert dsmPack(channels) == _dsmPackLegacy(channels), channels
+    assert dsmPack(None) is None
+    # every PWM value, in each position
+    for pwm in range(65536):
+        channels = [ pwm ] * 14
+        assert dsmPack(channels) == _dsmPackLegacy(channels), pwm
+    print "ok"
+
+    # time for a typical 8-channel packet
+    packed = struct.pack("<QH8H", 3966001072, 3965, *([ 1500 ] * 8))
+    channels = [ 1500 ] * 8
+    num = 100000
+    for name, func, arg in (("rcUnpack", _rcUnpackLegacy, packed),
+                            ("rcUnpack", rcUnpack, packed),
+                            ("dsmPack", _dsmPackLegacy, channels),
+                            ("dsmPack", dsmPack, channels)):
+        t = timeit.Timer(lambda: func(arg)).timeit(num)
+        print "%-16s %-8s %6.2f usec" % (func.__name__, name,
+                                         t * 1000000 / num)
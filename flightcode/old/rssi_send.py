@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import ConfigParser
 import os
 import socket
 import sys
@@ -10,6 +11,7 @@ import iw
 from pymavlink import mavutil
 sys.path.append("/usr/bin")
 import clock
+import rc_link_quality
 
 if_name = "wlan0"
 src_system = 10
@@ -20,8 +22,9 @@ conf_filename = "/etc/sololink.conf"
 # 'mav' is a mavutil.mavlink.MAVLink, needed for
 #   srcSystem, srcComponent, and sequence
 # 'dbm' is the signal dbm as read from the wifi card
+# 'rxerrors' is the RC packets lost (from pixrc), mod 64K
 # return is a mavlink message as a string (binary)
-def create_rssi_msg(mav, dbm):
+def create_rssi_msg(mav, dbm, rxerrors=0):
     # dbm is a small negative number. We would like the rssi byte in the
     # mavlink message to be interpretable as a signed byte, but the mavlink
     # stuff packs it as an unsigned byte. Get the right bits into the
@@ -48,7 +51,8 @@ def create_rssi_msg(mav, dbm):
 
     # on Solo, we are "remrssi"
     msg = mavutil.mavlink.MAVLink_radio_status_message(
-        rssi=0, remrssi=rssi, txbuf=0, noise=0, remnoise=0, rxerrors=0, fixed=0
+        rssi=0, remrssi=rssi, txbuf=0, noise=0, remnoise=0,
+        rxerrors=(rxerrors & 0xffff), fixed=0
     )
     return msg.pack(mav)
 
@@ -66,6 +70,15 @@ logger = logging.getLogger("wifi")
 
 logger.info("rssi_send starting")
 
+config = ConfigParser.SafeConfigParser()
+config.read(conf_filename)
+
+# pixrc's RC link quality socket (rc_link_quality.py)
+try:
+    rc_link_sock = config.get("solo", "rcLinkSock")
+except ConfigParser.Error:
+    rc_link_sock = rc_link_quality.DEFAULT_SOCK_NAME
+
 mav = mavutil.mavlink.MAVLink(None, src_system, src_component)
 
 # socket to inject into downlink telemetry from
@@ -110,6 +123,17 @@ while True:
         else:
             lbl = key
         s = s + str(lbl) + "=" + str(info[key]) + " "
+    # RC link health from pixrc; don't hold up the rssi for it
+    rc = rc_link_quality.query(rc_link_sock, timeout_s=0.1)
+    rxerrors = 0
+    if rc is not None:
+        rxerrors = rc["drop"]
+        s = s + "rcdrop=%d rctmo=%d" % (rc["drop"], rc["timeouts"])
+        if rc["loss_pct"] is not None:
+            s = s + " rcloss=%0.1f%%" % (rc["loss_pct"], )
+        if rc["gap_us"]["p99"] is not None:
+            s = s + " rcgap99=%d rcgapmax=%d" % \
+                (rc["gap_us"]["p99"] / 1000, rc["gap_us"]["max"] / 1000)
     logger.info(s)
     dbm = info["signal"]
 
@@ -120,7 +144,7 @@ while True:
 
     if rclockout is False:
         try:
-            m = create_rssi_msg(mav, dbm)
+            m = create_rssi_msg(mav, dbm, rxerrors)
             sock.sendto(m, "/run/telem_downlink")
             mav.seq += 1
             if mav.seq >= 256:
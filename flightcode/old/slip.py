@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
+import collections
 import datetime
 import logging
 import logging.config
 import serial
+import slip_capture
+import slip_codec
 
 configFileName = "/etc/sololink.conf"
 
@@ -15,29 +18,35 @@ logger = logging.getLogger("slip")
 class slip():
 
 
-    END     = chr(0xc0) # indicates end of packet
-    ESC     = chr(0xdb) # indicates byte stuffing
-    ESC_END = chr(0xdc) # ESC ESC_END means END data byte
-    ESC_ESC = chr(0xdd) # ESC ESC_ESC means ESC data byte
+    END     = slip_codec.END     # indicates end of packet
+    ESC     = slip_codec.ESC     # indicates byte stuffing
+    ESC_END = slip_codec.ESC_END # ESC ESC_END means END data byte
+    ESC_ESC = slip_codec.ESC_ESC # ESC ESC_ESC means ESC data byte
 
 
     # This is really for detecting garbage input, and not passing huge junk to the
     # stm32 message handlers. Intended to be much bigger than any real packet. If
     # we get more than this much data without finding an END, we drop the packet
     # and go back to looking for sync.
-    maxPktLen = 1024
+    maxPktLen = slip_codec.MAX_PKT_LEN
 
 
-    def __init__(self, stream):
-        # I/O interface, provides s=read() and write(s)
+    def __init__(self, stream, capture=None):
+        # I/O interface, provides s=read(size) and write(s); read returns
+        # what is available (up to size), like a socket's recv
         self._stream = stream
-        self._inSync = False
+        # slip_capture.CaptureWriter for everything sent and received
+        self._capture = capture
+        self._decoder = slip_codec.SlipDecoder(slip.maxPktLen)
+        # packets received but not returned yet, as (pktTime, pkt)
+        self._pkts = collections.deque()
         # count of each reason we lost sync
-        self.desyncCounts = {}
+        self.desyncCounts = self._decoder.desyncs
+        self._desyncTotal = 0
         self._desyncLogInterval = datetime.timedelta(seconds=1) # =None to never log
         self._desyncLogLast = None
         # receive counters
-        self.counts = { 'BYTE': 0, 'SYNC': 0, 'DROP': 0, 'ESC': 0 }
+        self.counts = self._decoder.counts
         self._syncLogInterval = datetime.timedelta(seconds=1) # =None to never log
         self._syncLogLast = None
 
@@ -45,12 +54,17 @@ class slip():
     # Lost sync. Functionally, we just want to set inSync False, but for analysis
     # and debugging, we use a function so we can count things and log and such.
     def desync(self, reason):
+        self._decoder.desync(reason)
+        self._logDesync()
+
+
+    # The decoder counts the times it loses sync; log them (debug)
+    def _logDesync(self):
+        total = sum(self.desyncCounts.values())
+        if total == self._desyncTotal:
+            return
+        self._desyncTotal = total
         now = datetime.datetime.now()
-        self._inSync = False
-        # count various reasons for losing sync (debug)
-        if reason not in self.desyncCounts:
-            self.desyncCounts[reason] = 0
-        self.desyncCounts[reason] += 1
         # periodically log (debug)
         if (self._desyncLogInterval is not None) and \
            ((self._desyncLogLast is None) or \
@@ -59,96 +73,75 @@ class slip():
             self._desyncLogLast = now
 
 
+    # Read what the stream has. A serial port says how much it has; anything
+    # else is expected to return what it has, like a socket.
+    def _read(self):
+        try:
+            size = max(self._stream.inWaiting(), 1)
+        except AttributeError:
+            size = 4096
+        return self._stream.read(size)
+
+
     # Receive one SLIP-encoded packet. If there is a timeout
     # waiting for the next character, any data received so far is dropped and
     # (None, None) is returned. The timout is set when the port is opened.
+    #
+    # The packet is returned as a string. Its timestamp is the time of the
+    # read that completed it; packets completed by the same read have the
+    # same time.
     def recv(self):
 
-        pktTime = None
-        pkt = []
-
-        if not self._inSync:
-            now = datetime.datetime.now()
-            self.counts['SYNC'] += 1
-            # periodically log
-            if (self._syncLogInterval is not None) and \
-               ((self._syncLogLast is None) or \
-                ((now - self._syncLogLast) >= self._syncLogInterval)):
-                logger.info("syncing, counts = %s", str(self.counts))
-                self._syncLogLast = now
-            # find the next END
-            while True:
-                b = self._stream.read()
-                if len(b) == 0:
-                    return None, None # timeout
-                self.counts['BYTE'] += 1
-                if b == slip.END:
-                    break
-                self.counts['DROP'] += 1
-
-        # already synced, or just got an END
-        self._inSync = True
-
-        # read packet
-        while True:
-            b = self._stream.read()
+        while not self._pkts:
+
+            if not self._decoder.in_sync:
+                now = datetime.datetime.now()
+                # periodically log
+                if (self._syncLogInterval is not None) and \
+                   ((self._syncLogLast is None) or \
+                    ((now - self._syncLogLast) >= self._syncLogInterval)):
+                    logger.info("syncing, counts = %s", str(self.counts))
+                    self._syncLogLast = now
+
+            b = self._read()
             if len(b) == 0:
                 return None, None # timeout
-            self.counts['BYTE'] += 1
-            if len(pkt) == 0:
-                if b == slip.END:
-                    # packet data has not started
-                    continue
-                else:
-                    # first byte in packet
-                    # timestamp is that of the first byte in the packet
-                    pktTime = datetime.datetime.now()
-
-            # If b is END at this point, it is the packet end. pkt[] must have
-            # at least one byte, and pktTime must have been set to get past the
-            # continue a few lines up
-            if b == slip.END:
-                return pktTime, pkt
-
-            if b == slip.ESC:
-                b = self._stream.read()
-                if len(b) == 0:
-                    return None, None # timeout
-                self.counts['BYTE'] += 1
-                if b == slip.ESC_END:
-                    pkt.append(slip.END)
-                elif b == slip.ESC_ESC:
-                    pkt.append(slip.ESC)
-                else:
-                    pkt.append(b)
-                self.counts['ESC'] += 1
-            else:
-                pkt.append(b)
-
-            # Sanity check
-            if len(pkt) > slip.maxPktLen:
-                # Something is wrong
-                slip.desync('TOO_LONG')
+            self._feed(b)
 
+        return self._pkts.popleft()
 
-    # Send one SLIP-encoded packet.
-    # 'pkt' is anything we can iterate over a byte at a time
-    # (e.g. string, list of single-char strings)
-    def send(self, pkt):
 
-        self._stream.write(slip.END) # may be optional
+    # Receive whatever the stream has now, without waiting for a packet; for
+    # a caller that knows the stream is readable (e.g. from select). Returns
+    # a list of (pktTime, pkt), which may be empty if no packet was
+    # completed, or None if there was nothing to read.
+    def recvReady(self):
+        b = self._read()
+        if len(b) == 0:
+            return None
+        self._feed(b)
+        pkts = list(self._pkts)
+        self._pkts.clear()
+        return pkts
 
-        for c in pkt:
-            if c == slip.END:
-                self._stream.write(slip.ESC)
-                self._stream.write(slip.ESC_END)
-            elif c == slip.ESC:
-                self._stream.write(slip.ESC)
-                self._stream.write(slip.ESC_ESC)
-            else:
-                self._stream.write(c)
 
-        self._stream.write(slip.END)
+    def _feed(self, b):
+        pktTime = datetime.datetime.now()
+        for pkt in self._decoder.feed(b):
+            self._pkts.append((pktTime, pkt))
+            if self._capture is not None:
+                self._capture.add(slip_capture.RX, pkt)
+        self._logDesync()
+
+
+    # Send one SLIP-encoded packet.
+    # 'pkt' is a string, or a list of single-char strings
+    def send(self, pkt):
+        if not isinstance(pkt, str):
+            pkt = "".join(pkt)
+        if self._capture is not None:
+            self._capture.add(slip_capture.TX, pkt)
+        self._stream.write(slip_codec.encode(pkt))
 
 
 
@@ -163,13 +156,13 @@ if __name__ == "__main__":
         def __init__(self, data):
             self._data = data
             self._index = 0
-        def read(self):
-            b = self._data[self._index]
-            self._index += 1
+        def read(self, size):
+            b = self._data[self._index:self._index + size]
+            self._index += len(b)
             return b
 
     # These tests just check the END processing.
-    # ESC processing has been running for a while; add tests if needed.
+    # ESC processing is tested in slip_codec.py.
 
     testData = ""
     # junk discarded before first END, and the first END
@@ -183,10 +176,10 @@ if __name__ == "__main__":
     # lots of ENDs are okay
     testData += slip.END + slip.END + slip.END + "4:789" + slip.END
 
-    testSer = dataSource(testData)
+    testSer = slip(dataSource(testData))
 
     while True:
-        try:
-            print recv(testSer)
-        except:
+        pktTime, pkt = testSer.recv()
+        if pkt is None:
             break
+        print pkt
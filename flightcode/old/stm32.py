@@ -1,26 +1,34 @@
 #!/usr/bin/env python
 
-# Receive and handle messages from the STM32: stm32.receiver waits for messages
-# from the STM32. When one arrives, strip off the one-byte packet ID, and call
-# a handler based on the packet ID.
+# Receive and handle messages from the STM32, and send messages to it, all
+# from one loop (stm32.run) that selects on the serial port and the UDP ports.
 #
-#                                      |--> DSM -----------> stm32_rc
-#                                      |
-#                                      |--> SYSINFO -------> stm32_sysinfo
-# STM32 --> slip --> stm32.receiver -->|
-#                                      |--> MAVLINK -------> stm32_mavlink
-#                                      |
-#                                      |--> PAIR_CONFIRM --> stm32_pairCnf
+# When data arrives from the STM32, it is decoded into packets; for each one,
+# strip off the one-byte packet ID, and call the handler for the packet ID
+# (stm32.dispatch, through a table). Packets are counted in arrays indexed by
+# packet ID, and the counts are logged from the loop, so nothing per packet
+# looks at the time or builds a dict.
+#
+#                                   |--> DSM -----------> stm32_rc
+#                                   |
+#                                   |--> SYSINFO -------> stm32_sysinfo
+# STM32 --> slip --> stm32.dispatch-|
+#                                   |--> MAVLINK -------> stm32_mavlink
+#                                   |
+#                                   |--> PAIR_CONFIRM --> stm32_pairCnf
 #
 # To send messages to the STM32, write them to a UDP port, where the port
-# used determines the message ID used. The stm32.sender function is called
-# after each incoming RC packet, and if there is anything in any of the UDP
-# ports, it prepends the one-byte message ID and sends it to the STM32.
+# used determines the message ID used. When there is anything in any of the
+# UDP ports, stm32.send queues it by packet ID (see stm32_queue.py), and the
+# queue sends what fits in each RC frame's byte budget, pairing and sysinfo
+# ahead of MAVLink, prepending the one-byte message ID. Data from the STM32 is
+# handled before the UDP ports, so RC is never held up behind messages going
+# the other way, and the budget keeps the serial link from backing up.
 #
 # mavlink --> udp -->|
 #                    |
 # sysinfo --> udp -->|
-#                    |--> select --> stm32.sender --> slip --> STM32
+#                    |--> select --> stm32.send --> queue --> slip --> STM32
 # pairReq --> udp -->|
 #                    |
 # pairCnf --> udp -->|
@@ -29,6 +37,7 @@
 # it is the serial port to the STM32, but for testing it can be a TCP socket
 # to the STM32 "simulator" (see stm32_sim.py).
 
+import clock
 import ConfigParser
 import datetime
 import logd
@@ -40,11 +49,11 @@ import select
 import serial
 import simple_stats
 import slip
+import slip_capture
 import socket
+import stm32_queue
 import struct
 import sys
-import threading
-import time
 
 from stm32_defs import *
 
@@ -121,8 +130,11 @@ pktIdToTypeName = [
     "RAW_RPT",
     "PAIR_REQ",
     "PAIR_CNF",
-    "PAIR_RES"
+    "PAIR_RES",
+    "SHUTDOWN"
 ]
+# one for every possible packet ID, so it can be indexed without checking
+pktIdToTypeName += [ "UNKNOWN" ] * (256 - len(pktIdToTypeName))
 
 # i.MX6 -> STM32 message ports. A message arriving on one of these ports will
 # be given the STM32 protocol packet ID and slipped to the STM32.
@@ -138,6 +150,24 @@ stm32Baud = configGetInt("stm32Baud")
 # Timeout for reading the next packet from the slip interface
 portTimeout = 0.2
 
+# Optional capture of all packets to and from the STM32 (see slip_capture.py
+# and slip_replay.py); the file is a ring of stm32CaptureSize bytes
+try:
+    stm32CaptureFile = config.get("solo", "stm32CaptureFile")
+except ConfigParser.Error:
+    stm32CaptureFile = ""
+try:
+    stm32CaptureSize = config.getint("solo", "stm32CaptureSize")
+except ConfigParser.Error:
+    stm32CaptureSize = slip_capture.DEFAULT_SIZE
+
+# Optional limit on bytes sent to the STM32 per RC frame (20 msec); the
+# default leaves some of the 115200 baud link spare
+try:
+    stm32TxBytesPerFrame = config.getint("solo", "stm32TxBytesPerFrame")
+except ConfigParser.Error:
+    stm32TxBytesPerFrame = stm32_queue.LINK_BYTES_PER_FRAME
+
 
 
 setSoloIpErrorLogged = False
@@ -170,7 +200,7 @@ def setSoloIp():
 
 # A UDP socket that has an associated packet ID. The idea is that each type
 # of outgoing packet has an associated UDP port. To send a packet of a
-# particular type, a message is sent to that type's port. The sender thread
+# particular type, a message is sent to that type's port. The loop
 # can then select on a set of UDP sockets, and when data arrives on one, it
 # can get the packet ID associated with that socket.
 class idSocket(socket.socket):
@@ -186,7 +216,14 @@ class stm32():
 
 
     def __init__(self, port, logPipe):
-        self._slip = slip.slip(port)
+        if stm32CaptureFile:
+            logger.info("capturing packets to %s", stm32CaptureFile)
+            capture = slip_capture.CaptureWriter(stm32CaptureFile,
+                                                 stm32CaptureSize)
+        else:
+            capture = None
+        self._port = port
+        self._slip = slip.slip(port, capture)
         self._stats = simple_stats.SimpleStats()
         # The MAVLink uplink address is learned the first time we get a
         # MAVLink packet from Solo.
@@ -195,94 +232,102 @@ class stm32():
         # pair request packet from the pairing server module.
         self._pairingAddress = None
         # Message handlers.
-        # Receiver thread uses these to process messages received from STM32.
+        # The loop uses these to process messages received from STM32.
         self.rc = stm32_rc(self)
         self.mavlink = stm32_mavlink(self)
         self.sysinfo = stm32_sysinfo(self)
         self.pairCnf = stm32_pairConfirm(self)
-        # debug counts
-        self._msgInCounts = {}
-        self._msgOutCounts = {}
+        # Handler for each packet ID, called as handler(pktTime, pkt) with
+        # the packet ID stripped; None for packets that are junk
+        self._handlers = [ None ] * 256
+        self._handlers[PKT_ID_DSM] = self.handleDsm
+        self._handlers[PKT_ID_CAL] = self.handleIgnore
+        self._handlers[PKT_ID_SYSINFO] = self.sysinfo.handle
+        # Upstream MAVLink (Artoo -> Solo)
+        self._handlers[PKT_ID_MAVLINK] = self.mavlink.handle
+        self._handlers[PKT_ID_PAIR_CONFIRM] = self.pairCnf.handle
+        self._handlers[PKT_ID_SHUTDOWN_REQUEST] = self.handleShutdown
+        # (monotonic) time of the last DSM packet, usec
+        self._dsmLast_us = None
+        # time the packets being handled were read, usec
+        self._rxTime_us = None
+        # debug counts; messages by packet ID, junk by type
+        self._msgInCounts = [ 0 ] * 256
+        self._msgOutCounts = [ 0 ] * 256
         self._junkCounts = {}
-        # control how often we log progress and junk messages
-        self._logProgressInterval = datetime.timedelta(seconds=30) # =None to never log
-        self._logProgressLast = None
-        self._logJunkInterval = datetime.timedelta(seconds=5) # =None to never log
-        self._logJunkLast = None
+        # control how often we log progress and junk messages (monotonic
+        # time, usec)
+        self._logProgressInterval_us = 30000000 # =None to never log
+        self._logProgressLast_us = None
+        self._logJunkInterval_us = 5000000 # =None to never log
+        self._logJunkLast_us = None
         # Packet log
         self._logPipe = logPipe
-        # Sender thread (sends messages to STM32)
+        self.packetLogger = None
+        #self.packetLogger = logd.Stm32Logger(self._logPipe)
+        # UDP ports with messages to send to the STM32
         self._inSocks = [ ]
+        # Messages waiting to go to the STM32
+        self._outQueue = stm32_queue.OutQueue(self.sendPacket,
+                                              stm32TxBytesPerFrame)
         # A packet arriving on one of these UDP ports is sent to the STM32
         # with the given packet ID
         self.addInput(mavDestPort, PKT_ID_MAVLINK)
         self.addInput(sysDestPort, PKT_ID_SYSINFO)
         self.addInput(pairReqDestPort, PKT_ID_PAIR_REQUEST)
         self.addInput(pairResDestPort, PKT_ID_PAIR_RESULT)
-        # Receiver thread (receives messages from STM32)
         self._quit = False
         self._timeout = False
-        self._receiver = threading.Thread(name = 'stm32.receiver',
-                                          target = stm32.receiver,
-                                          args = (self, ))
-        self._receiver.daemon = True
-        self._sender = threading.Thread(name = 'stm32.sender',
-                                          target = stm32.sender,
-                                          args = (self, ))
-        self._sender.daemon = True
-        # Start thread
-        self._receiver.start()
-        self._sender.start()
 
 
     def exit(self):
+        # run() returns at its next wakeup
         self._quit = True
-        self._receiver.join(1.0)
-        if self._receiver.isAlive():
-            logger.error("timeout waiting for receiver thread to exit")
-        self._sender.join(1.0)
-        if self._sender.isAlive():
-            logger.error("timeout waiting for sender thread to exit")
-
-
-    def logProgress(self, msgInType, msgOutType):
-        # count incoming messages of each type
-        if msgInType is not None:
-            if msgInType not in self._msgInCounts:
-                self._msgInCounts[msgInType] = 0
-            self._msgInCounts[msgInType] += 1
-        # count outgoing messages of each type
-        if msgOutType is not None:
-            if msgOutType not in self._msgOutCounts:
-                self._msgOutCounts[msgOutType] = 0
-            self._msgOutCounts[msgOutType] += 1
-        # periodically print counts
-        now = datetime.datetime.now()
-        if (self._logProgressInterval is not None) and \
-           ((self._logProgressLast is None) or \
-            ((now - self._logProgressLast) >= self._logProgressInterval)):
-            logger.info("messages in:  %s", str(self._msgInCounts))
-            logger.info("messages out: %s", str(self._msgOutCounts))
+
+
+    # Message counts by type name, for logging (the counts are by packet ID)
+    def countsByName(self, counts):
+        named = {}
+        for pktId in range(len(counts)):
+            if counts[pktId] != 0:
+                typeName = pktIdToTypeName[pktId]
+                named[typeName] = named.get(typeName, 0) + counts[pktId]
+        return named
+
+
+    # Called from the loop; periodically log the counts
+    def logProgress(self, now_us):
+        if (self._logProgressInterval_us is not None) and \
+           ((self._logProgressLast_us is None) or \
+            ((now_us - self._logProgressLast_us) >= self._logProgressInterval_us)):
+            logger.info("messages in:  %s",
+                        str(self.countsByName(self._msgInCounts)))
+            logger.info("messages out: %s",
+                        str(self.countsByName(self._msgOutCounts)))
+            for line in self._outQueue.stats():
+                logger.info("queue %s", line)
             if self._stats.count() > 0:
                 logger.info("dsm: n=%d avg=%0.0f min=%0.0f max=%0.0f stdev=%0.1f",
                             self._stats.count(), self._stats.average(),
                             self._stats.min(), self._stats.max(),
                             self._stats.stdev())
                 self._stats.reset()
-            self._logProgressLast = now
+            self._logProgressLast_us = now_us
 
 
     def logJunk(self, junkType):
-        now = datetime.datetime.now()
         if junkType not in self._junkCounts:
             self._junkCounts[junkType] = 0
         self._junkCounts[junkType] += 1
-        if (self._logJunkInterval is not None) and \
-           ((self._logJunkLast is None) or \
-            ((now - self._logJunkLast) >= self._logJunkInterval)):
+        if self._logJunkInterval_us is None:
+            return
+        # the coarse clock is plenty for a 5 second interval, and cheaper
+        now_us = clock.gettime_us(clock.CLOCK_MONOTONIC_COARSE)
+        if (self._logJunkLast_us is None) or \
+           ((now_us - self._logJunkLast_us) >= self._logJunkInterval_us):
             logger.info("junk: stm32 %s, slip %s",
                         str(self._junkCounts), str(self._slip.counts))
-            self._logJunkLast = now
+            self._logJunkLast_us = now_us
 
 
     def logPacket(self, pktTime, pkt):
@@ -292,148 +337,188 @@ class stm32():
         logd.logStm32Packet(pktTime, pkt)
 
 
-    # Receiver thread waits for a packet to arrive from the STM32 over the
-    # serial port, then based on the packet ID, gives it to one of the message
-    # handlers. This thread is normally blocked on the serial port; the
-    # message handlers should not block.
+    # Everything is done from one loop: it waits (select) for data from the
+    # STM32 or a message on any of the UDP ports. Whatever arrives from the
+    # STM32 is handled first, so RC goes out ahead of anything else that is
+    # ready at the same time, then messages are queued for the STM32 and the
+    # queue sends what this RC frame has room for. Each RC packet from the
+    # STM32 starts a new frame; if they stop, the queue keeps time itself.
     #
-    # If the recv function returns (None, None), then there was a timeout
-    # waiting for data.
-    def receiver(self):
-        logger.info("stm32.receiver running")
-
-        self.packetLogger = None
-        #self.packetLogger = logd.Stm32Logger(self._logPipe)
+    # The loop also pings the STM32 (see main), and returns if it stops
+    # answering; the handlers should not block.
+    def run(self):
+        logger.info("stm32 loop running")
 
         if self.packetLogger:
             now = datetime.datetime.now()
             self.packetLogger.log_packet(now, "\0start " + str(now))
 
-        pktTimeDsmLast = None
-
-        while True:
-
-            pktTime, pkt = self._slip.recv()
-
-            if self._quit:
-                break
-
-            if pktTime is None or pkt is None:
+        socks = [ self._port ] + self._inSocks
+
+        # We use the sysinfo message as a "ping", sent through our own UDP
+        # port so the whole path is checked. Something like a real ping (with
+        # less data returned) might be better.
+        pingSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        pingInterval_us = 1000000
+        # Can miss 2, but missing 3 means something is wrong. If none have
+        # been missed, the sysinfo age when we check will be approximately 1
+        # sec; could be just less than 1 or just more than 1. Similar for one
+        # missed; age will be about 2, or two missed; age will be about 3.
+        # That is why 3.5 is the threshold to detect three missed.
+        pingTimeout = datetime.timedelta(seconds=3.5)
+
+        portTimeout_us = int(portTimeout * 1000000)
+        now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+        rxLast_us = now_us
+        pingNext_us = now_us
+
+        while not self._quit:
+
+            wakeup_us = min(rxLast_us + portTimeout_us, pingNext_us)
+            if self._outQueue.pending():
+                # over budget; wake for the next frame if RC doesn't first
+                wakeup_us = min(wakeup_us, self._outQueue.nextFrame_us())
+            timeout_us = wakeup_us - now_us
+            ready = select.select(socks, [], [],
+                                  max(timeout_us, 0) / 1000000.0)[0]
+            now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+
+            if self._port in ready:
+                if not self.receive(now_us):
+                    # readable but nothing there: the simulator went away
+                    logger.error("stm32 port closed")
+                    break
+                rxLast_us = now_us
+                self._timeout = False
+            elif (now_us - rxLast_us) >= portTimeout_us:
                 self.logJunk("TIMEOUT")
                 self._timeout = True
-                continue
-            self._timeout = False
-
-            if len(pkt) < 1:
-                self.logJunk("ZERO")
-                continue
+                rxLast_us = now_us
 
-            if self.packetLogger:
-                self.packetLogger.log_packet(pktTime, "".join(pkt))
+            for sock in self._inSocks:
+                if sock in ready:
+                    self.send(sock, now_us)
 
-            pktId = ord(pkt[0])
+            if self._outQueue.pending():
+                self._outQueue.drain(now_us)
 
-            try:
-                typeName = pktIdToTypeName[pktId]
-            except:
-                logger.info("stm32.receiver: %s", [hex(ord(c)) for c in pkt])
-                typeName = "UNKNOWN"
-
-            if pktId == PKT_ID_NOP:
-                self.logJunk(typeName)
-            elif pktId == PKT_ID_DSM:
-                self.rc.handle(pktTime, pkt[1:])
-                # update stats
-                if pktTimeDsmLast is not None:
-                    delta_us = (pktTime - pktTimeDsmLast).total_seconds() * 1000000
-                    self._stats.update(delta_us)
-                pktTimeDsmLast = pktTime
-                # handle outgoing messages
-#                self.ender()
-            elif pktId == PKT_ID_CAL:
-                pass
-            elif pktId == PKT_ID_SYSINFO:
-                self.sysinfo.handle(pktTime, pkt[1:])
-            elif pktId == PKT_ID_MAVLINK:
-                # Upstream MAVLink (Artoo -> Solo)
-                self.mavlink.handle(pktTime, pkt[1:])
-            elif pktId == PKT_ID_PAIR_CONFIRM:
-                self.pairCnf.handle(pktTime, pkt[1:])
-            elif pktId == PKT_ID_SHUTDOWN_REQUEST:
-                #Shutdown gracefully...
-                logger.info("received shutdown request");
-                os.system("shutdown -h now")
-            else:
-                # Don't desync here. We did just get an END, after all.
-                self.logJunk(typeName)
+            self.logProgress(now_us)
 
-            self.logProgress(typeName, None)
+            if now_us >= pingNext_us:
+                age = datetime.datetime.now() - self.sysinfo.updateTime
+                if age > pingTimeout:
+                    break
+                pingSock.sendto('', ('127.0.0.1', sysDestPort))
+                pingNext_us = now_us + pingInterval_us
 
-        # end while True
+        # end while not self._quit
 
         if self.packetLogger:
             now = datetime.datetime.now()
             self.packetLogger.log_packet(now, "\0exit " + str(now))
             self.packetLogger.uninit()
 
-        logger.info("stm32.receiver exiting")
+        logger.info("stm32 loop exiting")
+
+
+    # Handle what the STM32 has sent. Called when the port is readable; any
+    # RC packets are handled first. Returns False if there was nothing to
+    # read.
+    def receive(self, now_us):
+        pkts = self._slip.recvReady()
+        if pkts is None:
+            return False
+        self._rxTime_us = now_us
+        # RC first
+        later = [ ]
+        for pktTime, pkt in pkts:
+            if pkt[0] == chr(PKT_ID_DSM):
+                self.dispatch(pktTime, pkt)
+            else:
+                later.append((pktTime, pkt))
+        for pktTime, pkt in later:
+            self.dispatch(pktTime, pkt)
+        return True
+
+
+    # Give one packet from the STM32 to its handler
+    def dispatch(self, pktTime, pkt):
+
+        if self.packetLogger:
+            self.packetLogger.log_packet(pktTime, "".join(pkt))
+
+        pktId = ord(pkt[0])
+
+        self._msgInCounts[pktId] += 1
+
+        handler = self._handlers[pktId]
+        if handler is None:
+            # Don't desync here. We did just get an END, after all.
+            typeName = pktIdToTypeName[pktId]
+            if typeName == "UNKNOWN":
+                logger.info("stm32.dispatch: %s", [hex(ord(c)) for c in pkt])
+            self.logJunk(typeName)
+        else:
+            handler(pktTime, pkt[1:])
+
+
+    def handleDsm(self, pktTime, pkt):
+        self.rc.handle(pktTime, pkt)
+        # the STM32 sends RC once per frame; start the outbound budget over
+        self._outQueue.newFrame(self._rxTime_us)
+        # update stats (monotonic time, so time changes don't show up)
+        if self._dsmLast_us is not None:
+            self._stats.update(self._rxTime_us - self._dsmLast_us)
+        self._dsmLast_us = self._rxTime_us
+
 
+    def handleIgnore(self, pktTime, pkt):
+        pass
 
-    # Sender thread waits for packets to arrive on any of the UDP ports. When
-    # a message arrives, it is prepended with the packet ID and sent to the
-    # STM32. This is the only thread that is allowed to write to the serial
-    # port. This thread is normally blocked in the select on the UDP ports.
-    # If there is regular traffic on at least one of the UDP ports, then the
-    # _quit request will be noticed and the thread will exit when requested.
-    # Otherwise, it will be killed when the main module terminates, and could
-    # cause an ugly but harmless exception on the way out. The select could
-    # be done with a time to mitigate this, but that's TBD (the normal case is
-    # that MAVLink is coming in often enough so the timeout is not needed).
-    def sender(self):
 
-        while True:
+    def handleShutdown(self, pktTime, pkt):
+        #Shutdown gracefully...
+        logger.info("received shutdown request");
+        os.system("shutdown -h now")
 
-            if self._quit:
-                break
 
-            ready = select.select(self._inSocks, [], []) #Blocking
+    # A message has arrived on one of the UDP ports: queue it for the STM32.
+    def send(self, sock, now_us):
 
-            for sock in ready[0]:
+        pkt, srcAdrs = sock.recvfrom(4096)
 
-                pkt, srcAdrs = sock.recvfrom(4096)
+        pktId = sock.id()
 
-                pktId = sock.id()
+        if self._mavUplinkAddress is None and pktId == PKT_ID_MAVLINK:
+            # Save source address; it is the destination address for
+            # the mavlink uplink.
+            # srcAdrs is a ("string", port) tuple.
+            self._mavUplinkAddress = srcAdrs
+            logger.info("mavlink destination address: %s",
+                        str(self._mavUplinkAddress));
 
-                try:
-                    typeName = pktIdToTypeName[pktId]
-                except:
-                    typeName = "UNKNOWN"
+        if self._pairingAddress is None and pktId == PKT_ID_PAIR_REQUEST:
+            # Save source address; pairing confirm will go there
+            self._pairingAddress = srcAdrs
+            logger.info("pairing destination address: %s",
+                        str(self._pairingAddress));
 
-                if self._mavUplinkAddress is None and pktId == PKT_ID_MAVLINK:
-                    # Save source address; it is the destination address for
-                    # the mavlink uplink.
-                    # srcAdrs is a ("string", port) tuple.
-                    self._mavUplinkAddress = srcAdrs
-                    logger.info("mavlink destination address: %s",
-                                str(self._mavUplinkAddress));
+        if not self._outQueue.put(pktId, pkt, now_us):
+            self.logJunk("QUEUE_" + pktIdToTypeName[pktId])
 
-                if self._pairingAddress is None and pktId == PKT_ID_PAIR_REQUEST:
-                    # Save source address; pairing confirm will go there
-                    self._pairingAddress = srcAdrs
-                    logger.info("pairing destination address: %s",
-                                str(self._pairingAddress));
 
-                self._slip.send(chr(pktId) + pkt)
+    # Called by the queue: prepend the packet ID and send it to the STM32.
+    # This is the only place that writes to the serial port.
+    def sendPacket(self, pktId, pkt):
 
-                self.logProgress(None, typeName)
+        self._slip.send(chr(pktId) + pkt)
 
-            ### end for sock in ready[0]
-        ### End while True
+        self._msgOutCounts[pktId] += 1
 
 
     # Add a new UDP port to listen on. When a packet arrives, it will be
     # forwarded to the STM32 with the supplied packet ID. All addInput() calls
-    # are expected to be done before the first call to sender().
+    # are expected to be done before the first call to run().
     def addInput(self, portNum, pktId):
         sock = idSocket(pktId)
         sock.bind(('', portNum))
@@ -685,22 +770,24 @@ class stm32_pairConfirm():
 
 
 
-# Provide read() and write() methods identical to those of a serial port.
-# Mainly, read() defaults to one byte. This is for testing when we are using
-# the simulated STM32 via TCP.
+# Provide read() and write() methods like those of a serial port. read()
+# returns what has arrived, up to size bytes. This is for testing when we are
+# using the simulated STM32 via TCP.
 class sock1():
     def __init__(self, sock):
         self._sock = sock
-    def read(self):
+    def read(self, size=1):
         # socket raises exception when it times out; serial port just
         # returns no data
         try:
-            b = self._sock.recv(1)
+            b = self._sock.recv(size)
         except socket.timeout:
             b = ""
         return b
     def write(self, c):
         self._sock.sendall(c)
+    def fileno(self):
+        return self._sock.fileno()
 
 
 
@@ -732,41 +819,15 @@ def createSerialPort(device, baud):
 
 def main(port, logPipe):
 
-    # 'port' is anything with .read() and .write() methods, where .read returns
-    # one byte, and .write writes however many bytes are supplied.
+    # 'port' is anything with .read(size), .write() and .fileno() methods,
+    # where .read returns what it has (up to size bytes), and .write writes
+    # however many bytes are supplied.
     s = stm32(port, logPipe)
 
-    # Ping the STM32 periodically to make sure everything is okay, including
-    # the send thread, the receive thread, and the STM32 itself. If any pieces
-    # are stuck, this script exits, killing both threads, and init restarts
-    # it all.
-
-    # We use the sysinfo message as a "ping". Something like a real ping (with
-    # less data returned) might be better.
-
-    pingSock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-
-    pingInterval = datetime.timedelta(seconds=1)
-
-    # can't do timedelta * float
-    pingTimeout = 3 * pingInterval + pingInterval / 2
-
-    while True:
-        pingSock.sendto('', ('127.0.0.1', sysDestPort))
-        time.sleep(pingInterval.total_seconds())
-        age = datetime.datetime.now() - s.sysinfo.updateTime
-        # Can miss 2, but missing 3 means something is wrong
-        # If none have been missed, "age" will be approximately 1; could be just
-        # less than 1 or just more than 1. Similar for one missed; age will be
-        # about 2, or two missed; age will be about 3. That is why 3.5
-        # (calculated above) is the threshold to detect three missed.
-        if age > pingTimeout:
-            # Exiting this thread causes the stm32 threads to be terminated;
-            # the init process should restart everything
-            break
-
-    # Tell the receiver thread to quit gracefully, then wait for it do do so
-    s.exit()
+    # The loop pings the STM32 periodically to make sure everything is okay,
+    # including the loop itself and the STM32. If it stops answering, run()
+    # returns and this script exits, and init restarts it all.
+    s.run()
 
     logger.error("stm32 not responding; exiting")
 
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# Outbound queue to the STM32.
+#
+# Messages to the STM32 are queued by class, and sent in priority order, a
+# limited number of bytes per RC frame (20 msec). The serial link is 115200
+# baud, about 230 bytes per frame, and carries everything; without a limit,
+# a burst of MAVLink (e.g. a parameter download) fills the serial buffers and
+# everything behind it waits, including pairing and sysinfo.
+#
+# Each class has:
+#   a priority (lower is sent first)
+#   a limit on packets queued; when full, either the oldest packet (MAVLink,
+#     where newer data is worth more) or the new one is dropped
+#   a byte budget per frame
+# The budgets add up to the link's budget per frame. Pairing and sysinfo have
+# a small share to themselves, so they go out in the frame they arrive in no
+# matter how much MAVLink is waiting; MAVLink has the rest.
+#
+# A packet is sent if its class has some budget left, and its whole length is
+# charged; a packet larger than what is left goes out anyway and the
+# overdraft is taken from the class's next frame, so big MAVLink packets are
+# never stuck and the average stays within budget.
+
+import collections
+
+from stm32_defs import *
+
+# bytes per RC frame for all classes together; a little less than the link
+# can do at 115200 baud, for SLIP overhead and RC-synchronous slack
+LINK_BYTES_PER_FRAME = 200
+
+# bytes per RC frame kept for pairing and for sysinfo (MAVLink gets the rest)
+PAIR_BYTES_PER_FRAME = 32
+SYSINFO_BYTES_PER_FRAME = 16
+
+FRAME_US = 20000
+
+# SLIP adds at least this much to each packet (two ENDs)
+PKT_OVERHEAD = 2
+
+
+
+class OutClass():
+
+    def __init__(self, name, priority, maxPackets, dropOldest, bytesPerFrame):
+        self.name = name
+        self.priority = priority
+        self.maxPackets = maxPackets
+        self.dropOldest = dropOldest
+        self.bytesPerFrame = bytesPerFrame
+        # (time queued, packet ID, packet)
+        self.queue = collections.deque()
+        self.budget = bytesPerFrame
+        # counts and stats since resetStats
+        self.sent = 0
+        self.dropped = 0
+        self.maxDepth = 0
+        self.waitTotal_us = 0
+        self.waitMax_us = 0
+
+    def resetStats(self):
+        self.sent = 0
+        self.dropped = 0
+        self.maxDepth = len(self.queue)
+        self.waitTotal_us = 0
+        self.waitMax_us = 0
+
+    def stats(self):
+        if self.sent > 0:
+            waitAvg_us = self.waitTotal_us / self.sent
+        else:
+            waitAvg_us = 0
+        return "%s: sent=%d dropped=%d depth=%d/%d wait avg=%d max=%d" % \
+            (self.name, self.sent, self.dropped, len(self.queue),
+             self.maxDepth, waitAvg_us, self.waitMax_us)
+
+
+
+class OutQueue():
+
+    def __init__(self, send, linkBytesPerFrame=LINK_BYTES_PER_FRAME):
+        # send(pktId, pkt) writes one packet to the STM32
+        self._send = send
+        self.linkBytesPerFrame = linkBytesPerFrame
+        mavBytesPerFrame = linkBytesPerFrame - PAIR_BYTES_PER_FRAME - \
+                           SYSINFO_BYTES_PER_FRAME
+        self.classes = [
+            OutClass("pair", 0, 8, False, PAIR_BYTES_PER_FRAME),
+            OutClass("sysinfo", 1, 4, False, SYSINFO_BYTES_PER_FRAME),
+            OutClass("mavlink", 2, 32, True, mavBytesPerFrame),
+        ]
+        self.classes.sort(key=lambda c: c.priority)
+        # class for each packet ID
+        self._classById = { PKT_ID_PAIR_REQUEST: self.classes[0],
+                            PKT_ID_PAIR_RESULT: self.classes[0],
+                            PKT_ID_SYSINFO: self.classes[1],
+                            PKT_ID_MAVLINK: self.classes[2] }
+        self.frameStart_us = None
+
+    def put(self, pktId, pkt, now_us):
+        """queue a packet; returns False if a packet was dropped"""
+        cls = self._classById.get(pktId, self.classes[-1])
+        dropped = False
+        if len(cls.queue) >= cls.maxPackets:
+            cls.dropped += 1
+            dropped = True
+            if not cls.dropOldest:
+                return False
+            cls.queue.popleft()
+        cls.queue.append((now_us, pktId, pkt))
+        if cls.maxDepth < len(cls.queue):
+            cls.maxDepth = len(cls.queue)
+        return not dropped
+
+    def newFrame(self, now_us):
+        """start a new frame's budgets (called for each RC packet)"""
+        self.frameStart_us = now_us
+        for cls in self.classes:
+            # overdraft from a big packet is paid back, but unused budget
+            # does not carry over
+            cls.budget = min(cls.budget, 0) + cls.bytesPerFrame
+
+    def pending(self):
+        for cls in self.classes:
+            if cls.queue:
+                return True
+        return False
+
+    def nextFrame_us(self):
+        """when the next frame starts if RC does not start it first"""
+        if self.frameStart_us is None:
+            return None
+        return self.frameStart_us + FRAME_US
+
+    def drain(self, now_us):
+        """send what the budgets allow, highest priority first"""
+        if self.frameStart_us is None or \
+           (now_us - self.frameStart_us) >= FRAME_US:
+            # no RC (e.g. STM32 not sending it); keep time ourselves
+            self.newFrame(now_us)
+        for cls in self.classes:
+            queue = cls.queue
+            while queue and cls.budget > 0:
+                queued_us, pktId, pkt = queue.popleft()
+                cls.budget -= len(pkt) + 1 + PKT_OVERHEAD
+                wait_us = now_us - queued_us
+                cls.waitTotal_us += wait_us
+                if cls.waitMax_us < wait_us:
+                    cls.waitMax_us = wait_us
+                cls.sent += 1
+                self._send(pktId, pkt)
+
+    def stats(self):
+        """one line per class, and reset the stats"""
+        lines = [ cls.stats() for cls in self.classes ]
+        for cls in self.classes:
+            cls.resetStats()
+        return lines
+
+
+
+if __name__ == "__main__":
+    # a MAVLink burst doesn't hold up pairing or sysinfo, and the link stays
+    # within budget
+    sent = []
+    q = OutQueue(lambda pktId, pkt: sent.append((pktId, pkt)))
+    now_us = 0
+    for i in range(100):
+        q.put(PKT_ID_MAVLINK, "m" * 100, now_us)
+    frames = []
+    while q.pending():
+        q.drain(now_us)
+        # sysinfo and pairing arriving after this frame's MAVLink still go
+        # out in this frame
+        q.put(PKT_ID_SYSINFO, "", now_us)
+        q.put(PKT_ID_PAIR_REQUEST, "p" * 20, now_us)
+        q.drain(now_us)
+        assert sent[-2:] == [(PKT_ID_PAIR_REQUEST, "p" * 20),
+                             (PKT_ID_SYSINFO, "")]
+        frames.append(sent)
+        sent = []
+        now_us += FRAME_US
+    # 32 MAVLink queued (oldest dropped)
+    mav = [len(p) + 3 for f in frames for i, p in f if i == PKT_ID_MAVLINK]
+    assert len(mav) == 32
+    # the link averages no more than its budget
+    total = sum(mav) + len(frames) * (3 + 24)
+    assert (total - 103) <= (len(frames) * LINK_BYTES_PER_FRAME)
+    for line in q.stats():
+        print line
+    print "ok"
@@ -2,6 +2,7 @@
 
 import datetime
 import slip
+import slip_capture
 import socket
 import struct
 import threading
@@ -63,6 +64,24 @@ def rcThreadRun(slipIf):
         pass
 
 
+# Replay thread
+# Instead of generating RC packets, send the packets a capture has from the
+# STM32, with their original timing (or faster or slower)
+def replayThreadRun(slipIf, records, speed):
+    for time_us, direction, pkt in slip_capture.replay(records, speed):
+        try:
+            slipSendLock.acquire()
+            slipIf.send(pkt)
+            slipSendLock.release()
+        except:
+            break
+    try:
+        slipSendLock.release()
+    except:
+        pass
+    print "replay done"
+
+
 # Message thread
 # Wait for and respond to incoming messages
 def msgThreadRun(slipIf):
@@ -117,8 +136,8 @@ def msgThreadRun(slipIf):
 class sock1():
     def __init__(self, sock):
         self._sock = sock
-    def read(self):
-        return self._sock.recv(1)
+    def read(self, size):
+        return self._sock.recv(size)
     def write(self, c):
         self._sock.sendall(c)
 
@@ -127,8 +146,20 @@ parser = OptionParser("stm32_sim.py [options]")
 parser.add_option("-p", dest="port", type="int",
                   help="TCP port to listen on",
                   default = DEFAULT_PORT)
+parser.add_option("--replay", dest="replay", type="string",
+                  help="send the STM32 packets from this capture file "
+                       "instead of generated RC packets")
+parser.add_option("--speed", dest="speed", type="float",
+                  help="replay speed (1 is as captured, 0 is as fast as "
+                       "possible)",
+                  default = 1.0)
 (opts, args) = parser.parse_args()
 
+if opts.replay:
+    replayRecords = [r for r in slip_capture.read_capture(opts.replay) \
+                     if r[1] == slip_capture.RX]
+    print "replaying", len(replayRecords), "packets from", opts.replay
+
 
 listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -147,7 +178,11 @@ while True:
     slipIf = slip.slip(sock1(dataSock))
 
     # start threads
-    rcThread = threading.Thread(name="rcThread", target=rcThreadRun, args=(slipIf,))
+    if opts.replay:
+        rcThread = threading.Thread(name="replayThread", target=replayThreadRun,
+                                    args=(slipIf, replayRecords, opts.speed))
+    else:
+        rcThread = threading.Thread(name="rcThread", target=rcThreadRun, args=(slipIf,))
     rcThread.daemon = True
     rcThread.start()
 
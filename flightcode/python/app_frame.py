@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# Length-prefixed framing for the app server's TCP connection.
+#
+# A frame (request or response) is a 32-bit big-endian byte count followed by
+# opaque data. The byte count includes itself, i.e. the minimum byte count is
+# four.
+#
+# FrameReader receives into one reusable buffer, as much as the socket has
+# each time, and hands out complete frames; bytes of the next frame are kept
+# for the next call. The old reader did a recv(1) per byte so it never read
+# past the end of a frame.
+#
+# Run this file to check that frames split anywhere are put back together.
+
+import socket
+import struct
+import threading
+
+HEADER = struct.Struct("!I")
+
+# Largest frame accepted; anything larger means we are out of sync with the
+# other end (or it is not talking to us).
+MAX_FRAME_LEN = 1024 * 1024
+
+
+
+class FrameError(Exception):
+    """the other end sent something that is not a frame"""
+    pass
+
+
+
+def pack_frame(data):
+    """frame containing 'data' (a string)"""
+    return HEADER.pack(HEADER.size + len(data)) + data
+
+
+
+class FrameReader(object):
+    """buffered frame reader for a stream socket
+
+    read_frame() returns the next frame (as a string, with the byte count
+    still included), or None if the other end closed the connection.
+    socket.error and socket.timeout from the socket are passed on, as is
+    FrameError for a byte count that can't be right.
+
+    The buffer starts at 'size' bytes and grows if a frame is larger, up to
+    max_len. 'syscalls' counts recv calls and 'frames' counts frames read.
+    """
+
+    def __init__(self, sock, size=4096, max_len=MAX_FRAME_LEN):
+        self.sock = sock
+        self.max_len = max_len
+        self._buf = bytearray(size)
+        # valid data is _buf[_start:_end]
+        self._start = 0
+        self._end = 0
+        self.syscalls = 0
+        self.frames = 0
+
+    def _frame_len(self):
+        """length of the next frame, or None if the byte count isn't here yet"""
+        if (self._end - self._start) < HEADER.size:
+            return None
+        (frame_len, ) = HEADER.unpack_from(self._buf, self._start)
+        if frame_len < HEADER.size or frame_len > self.max_len:
+            raise FrameError("bad frame length %d" % (frame_len, ))
+        return frame_len
+
+    def next_frame(self):
+        """next complete frame already received, or None"""
+        frame_len = self._frame_len()
+        if frame_len is None or (self._end - self._start) < frame_len:
+            return None
+        start = self._start
+        self._start += frame_len
+        if self._start == self._end:
+            self._start = self._end = 0
+        self.frames += 1
+        return str(self._buf[start:start + frame_len])
+
+    def _make_room(self):
+        """make sure there is space after _end for the rest of a frame"""
+        frame_len = self._frame_len()
+        if frame_len is None:
+            frame_len = HEADER.size
+        if self._start > 0 and (self._start + frame_len) > len(self._buf):
+            # move what we have to the front
+            length = self._end - self._start
+            self._buf[:length] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = length
+        if frame_len > len(self._buf):
+            self._buf.extend(bytearray(frame_len - len(self._buf)))
+
+    def fill(self):
+        """receive whatever the socket has (blocking until there is something)
+
+        Returns the number of bytes received; 0 means the connection closed.
+        """
+        self._make_room()
+        if self._end == len(self._buf):
+            # room was made for the frame, so the buffer only fills up with
+            # a frame complete in it; this is a caller error
+            raise FrameError("buffer full")
+        self.syscalls += 1
+        # (no memoryview is kept, since that would stop _buf from growing)
+        n = self.sock.recv_into(memoryview(self._buf)[self._end:])
+        self._end += n
+        return n
+
+    def read_frame(self):
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if self.fill() == 0:
+                return None
+
+
+
+if __name__ == "__main__":
+    # check frames split anywhere are put back together
+    rx, tx = socket.socketpair()
+    data = "".join([pack_frame(chr(i) * i) for i in range(100)])
+    reader = FrameReader(rx, size=16)
+    def send():
+        for i in range(0, len(data), 7):
+            tx.sendall(data[i:i + 7])
+        tx.close()
+    sender = threading.Thread(target=send)
+    sender.daemon = True
+    sender.start()
+    for i in range(100):
+        assert reader.read_frame() == pack_frame(chr(i) * i)
+    assert reader.read_frame() is None
+    sender.join()
+    rx.close()
+    print "ok"
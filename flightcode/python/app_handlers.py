@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+# Requests the app server answers.
+#
+# A request's data (after the frame's byte count) starts with a 32-bit
+# big-endian message ID; the rest is the request's arguments. The response is
+# a frame with the same message ID followed by the result, which is JSON
+# unless noted otherwise. Requests with an unknown ID (or too short to have
+# one) are not answered; apps that only keep the connection open to say they
+# are there send those.
+
+import json
+import os
+import socket
+import struct
+import time
+import app_frame
+import param_stored_vals_msg
+
+MSG_ID = struct.Struct("!I")
+
+# message IDs
+APP_MSG_VERSION = 1         # versions of this and the other processors
+APP_MSG_LOG_LIST = 2        # dataflash logs that can be downloaded
+APP_MSG_STICK_CONFIG = 3    # stick axis mapping from the stm32
+APP_MSG_METRICS = 4         # handler counts and latencies
+
+version_files = [ ("sololink", "/VERSION"),
+                  ("pixhawk", "/PIX_VERSION"),
+                  ("stm32", "/STM_VERSION") ]
+
+log_dir = "/log/dataflash"
+
+
+
+class HandlerStats(object):
+    """count and latency (usec) of one handler's requests"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def add(self, us, error=False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.total_us += us
+        if self.max_us < us:
+            self.max_us = us
+
+    def metrics(self):
+        if self.count > 0:
+            avg_us = self.total_us / self.count
+        else:
+            avg_us = 0
+        return { "count": self.count, "errors": self.errors,
+                 "avg_us": avg_us, "max_us": self.max_us }
+
+
+
+class Pending(object):
+    """a request waiting for another process (stm32, pixrc) to answer
+
+    A handler that has to ask another process sends its request on 'sock'
+    and returns one of these instead of waiting for the answer, so the
+    server's loop is never blocked. The server selects on 'sock' and the
+    dispatcher calls parse(reply) when it is readable; parse returns the
+    response data, or raises an exception for an error, as a handler would.
+    If there is no answer in timeout_s, the response has no data.
+    """
+
+    def __init__(self, sock, timeout_s, parse, source):
+        self.sock = sock
+        self.sock.setblocking(0)
+        self.deadline = time.time() + timeout_s
+        self.parse = parse
+        self.source = source
+
+
+
+class Dispatcher(object):
+    """route requests to handlers by message ID
+
+    A handler is called as handler(client, args), where args is the request
+    data after the message ID, and returns the response data (a string),
+    None for no response, or a Pending if the response comes later. An
+    exception from a handler is logged and counted, and the response has no
+    data after the message ID, so the app is not left waiting for it.
+
+    The caller selects on pending_socks() (waiting no longer than
+    wait_time()) and calls poll() to get the responses that are ready.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.handlers = { }
+        self.stats = { }
+        self.unknown = 0
+        # name -> function returning more metrics to include
+        self.sources = { }
+        # (client, message ID, handler name, start time, Pending)
+        self.pending = [ ]
+
+    def register(self, msg_id, name, handler):
+        self.handlers[msg_id] = (name, handler)
+        self.stats[name] = HandlerStats()
+
+    def dispatch(self, client, pkt):
+        """handle one request (a frame, byte count included)
+
+        Returns the response frame, or None.
+        """
+        data_start = app_frame.HEADER.size
+        if len(pkt) < (data_start + MSG_ID.size):
+            self.unknown += 1
+            return None
+        (msg_id, ) = MSG_ID.unpack_from(pkt, data_start)
+        if msg_id not in self.handlers:
+            self.unknown += 1
+            self.logger.debug("no handler for message %d", msg_id)
+            return None
+        name, handler = self.handlers[msg_id]
+        start = time.time()
+        try:
+            data = handler(client, pkt[data_start + MSG_ID.size:])
+            error = False
+        except Exception as e:
+            self.logger.error("%s: %s", name, str(e))
+            data = ""
+            error = True
+        if isinstance(data, Pending):
+            self.pending.append((client, msg_id, name, start, data))
+            return None
+        return self._respond(msg_id, name, start, data, error)
+
+    def _respond(self, msg_id, name, start, data, error):
+        self.stats[name].add(int((time.time() - start) * 1000000), error)
+        if data is None:
+            return None
+        return app_frame.pack_frame(MSG_ID.pack(msg_id) + data)
+
+    def pending_socks(self):
+        return [ p[4].sock for p in self.pending ]
+
+    def wait_time(self, now):
+        """seconds until a pending request times out (None if there are
+        none)"""
+        if not self.pending:
+            return None
+        return max(0, min([ p[4].deadline for p in self.pending ]) - now)
+
+    def poll(self, readable, now):
+        """finish pending requests that have been answered or have timed out
+
+        Returns a list of (client, response frame).
+        """
+        responses = [ ]
+        waiting = [ ]
+        for entry in self.pending:
+            client, msg_id, name, start, pending = entry
+            if pending.sock in readable:
+                try:
+                    data = pending.parse(pending.sock.recv(65536))
+                    error = False
+                except Exception as e:
+                    self.logger.error("%s: %s", name, str(e))
+                    data = ""
+                    error = True
+            elif now >= pending.deadline:
+                self.logger.error("%s: no response from %s", name,
+                                  pending.source)
+                data = ""
+                error = True
+            else:
+                waiting.append(entry)
+                continue
+            pending.sock.close()
+            responses.append((client, self._respond(msg_id, name, start,
+                                                    data, error)))
+        self.pending = waiting
+        return responses
+
+    def abort(self, client):
+        """forget client's pending requests (e.g. it disconnected)"""
+        for entry in self.pending:
+            if entry[0] is client:
+                entry[4].sock.close()
+        self.pending = [ p for p in self.pending if p[0] is not client ]
+
+    def add_metrics(self, name, snapshot):
+        self.sources[name] = snapshot
+
+    def metrics(self):
+        m = { "unknown": self.unknown }
+        for name in self.stats:
+            m[name] = self.stats[name].metrics()
+        for name in self.sources:
+            m[name] = self.sources[name]()
+        return m
+
+
+
+def read_version(file_name):
+    try:
+        f = open(file_name)
+    except IOError:
+        return None
+    version = f.readline().strip('\r\n\t\0 ')
+    f.close()
+    return version
+
+
+
+def handle_version(client, args):
+    versions = { }
+    for (name, file_name) in version_files:
+        versions[name] = read_version(file_name)
+    return json.dumps(versions)
+
+
+
+def handle_log_list(client, args):
+    """[ [name, size, mtime], ... ] for the regular files in log_dir
+
+    The RECENT symlinks are skipped; they are other names for logs that are
+    already in the list.
+    """
+    logs = []
+    try:
+        names = os.listdir(log_dir)
+    except OSError:
+        names = []
+    for name in sorted(names):
+        path = os.path.join(log_dir, name)
+        if os.path.islink(path):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue # removed since listdir
+        if os.path.isfile(path):
+            logs.append([name, st.st_size, int(st.st_mtime)])
+    return json.dumps(logs)
+
+
+
+def parse_stick_config(msg):
+    params = param_stored_vals_msg.unpack(msg)
+    return json.dumps([list(stick[:3]) for stick in params['rcSticks']])
+
+
+
+def handle_stick_config(client, args):
+    """[ [input, direction, expo], ... ] for each of the six stick axes
+
+    This asks the stm32 process, and is answered when it does (within 0.2
+    sec), so it is the slowest request.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto("", ("127.0.0.1",
+                     param_stored_vals_msg.PARAM_STORED_VALS_PORT))
+    return Pending(sock, 0.2, parse_stick_config, "stm32")
+
+
+
+def register_all(dispatcher):
+    """register the standard handlers"""
+    dispatcher.register(APP_MSG_VERSION, "version", handle_version)
+    dispatcher.register(APP_MSG_LOG_LIST, "log_list", handle_log_list)
+    dispatcher.register(APP_MSG_STICK_CONFIG, "stick_config",
+                        handle_stick_config)
+    dispatcher.register(APP_MSG_METRICS, "metrics",
+                        lambda client, args: json.dumps(dispatcher.metrics()))
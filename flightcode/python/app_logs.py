@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+# Dataflash log download over the app server's connection.
+#
+# The app asks for a log by name, with the byte offset to start at (0 for
+# the whole log, or how much it already has to resume). The response to the
+# request (APP_MSG_LOG_DOWNLOAD) is JSON with the log's name, its size, and
+# the starting offset; the log data follows in APP_MSG_LOG_DATA frames:
+#
+#   message ID (32 bits), offset in the log (64 bits), data
+#
+# A data frame with no data (offset == size) marks the end. The size is taken
+# when the download starts; a log still being written is sent up to there.
+#
+# File data goes from the page cache to the socket with sendfile(), so it is
+# not copied through Python. All downloads together are held to a byte rate,
+# so the app's telemetry and video on the same link are not starved.
+
+import ctypes
+import errno
+import json
+import os
+import socket
+import struct
+import time
+
+APP_MSG_LOG_DOWNLOAD = 5    # request: offset (64 bits), name
+APP_MSG_LOG_DATA = 6        # log data, sent after APP_MSG_LOG_DOWNLOAD
+
+OFFSET = struct.Struct("!Q")
+DATA_HEADER = struct.Struct("!IIQ")  # frame length, message ID, offset
+
+# file data per frame
+CHUNK_SIZE = 16384
+
+try:
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    try:
+        # large file version, so offsets past 2 GB work on 32-bit ARM
+        _sendfile = libc.sendfile64
+        _off_t = ctypes.c_int64
+    except AttributeError:
+        _sendfile = libc.sendfile
+        _off_t = ctypes.c_long
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(_off_t),
+                          ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+    have_sendfile = True
+except (OSError, AttributeError):
+    # fall back to read() and send()
+    have_sendfile = False
+
+
+
+def sendfile(sock, f, offset, count):
+    """send up to 'count' bytes of file 'f' from 'offset' to 'sock'
+
+    Returns the number of bytes sent. Raises socket.error as sock.send()
+    would, e.g. EAGAIN if the socket is non-blocking and full.
+    """
+    if not have_sendfile:
+        f.seek(offset)
+        return sock.send(f.read(count))
+    off = _off_t(offset)
+    n = _sendfile(sock.fileno(), f.fileno(), ctypes.byref(off), count)
+    if n < 0:
+        e = ctypes.get_errno()
+        raise socket.error(e, os.strerror(e))
+    return n
+
+
+
+class Throttle(object):
+    """token bucket: 'rate' bytes/sec, up to 'burst' bytes at once
+
+    A rate of zero means no limit.
+    """
+
+    def __init__(self, rate, burst=CHUNK_SIZE):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._time = time.time()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def available(self, now):
+        """bytes that can be sent now"""
+        if self.rate == 0:
+            return CHUNK_SIZE
+        self._refill(now)
+        return int(self._tokens)
+
+    def take(self, count):
+        if self.rate != 0:
+            self._tokens -= count
+
+    def wait_time(self, now):
+        """seconds until at least a quarter of the burst can be sent"""
+        if self.rate == 0:
+            return 0
+        self._refill(now)
+        need = self.burst / 4 - self._tokens
+        # less than a byte short counts as there (rounding would otherwise
+        # leave it short by ever smaller amounts)
+        if need < 1:
+            return 0
+        return need / self.rate
+
+
+
+class LogDownload(object):
+    """one log being sent to one app"""
+
+    def __init__(self, name, path, offset):
+        self.name = name
+        self.f = open(path, "rb")
+        self.size = os.fstat(self.f.fileno()).st_size
+        if offset > self.size:
+            self.f.close()
+            raise ValueError("offset %d past end of %s (%d bytes)" % \
+                             (offset, name, self.size))
+        self.start_offset = offset
+        self.offset = offset
+        self.start_time = time.time()
+        self.sent = 0
+        self.done = False
+        # unsent part of the current frame: header, then file data
+        self._header = ""
+        self._data_left = 0
+        self._last = False
+
+    def in_frame(self):
+        """True if part of a data frame has been sent; nothing else may be
+        sent to the app until the rest of it is"""
+        return len(self._header) > 0 or self._data_left > 0
+
+    def write(self, sock, budget, more_frames=True):
+        """send up to 'budget' bytes (or to the end of the log)
+
+        If more_frames is False, only the rest of the current frame is sent.
+        Returns the number of bytes sent, which is less than budget if the
+        socket is full.
+        """
+        sent = 0
+        try:
+            while sent < budget and not self.done:
+                if not self.in_frame():
+                    if not more_frames:
+                        break
+                    n = min(CHUNK_SIZE, self.size - self.offset)
+                    self._header = DATA_HEADER.pack(DATA_HEADER.size + n,
+                                                    APP_MSG_LOG_DATA,
+                                                    self.offset)
+                    self._data_left = n
+                    self._last = (n == 0)
+                if self._header:
+                    n = sock.send(self._header)
+                    self._header = self._header[n:]
+                else:
+                    n = sendfile(sock, self.f, self.offset,
+                                 min(self._data_left, budget - sent))
+                    if n == 0:
+                        raise IOError("%s is shorter than %d bytes" % \
+                                      (self.name, self.size))
+                    self.offset += n
+                    self._data_left -= n
+                sent += n
+                if self._last and not self.in_frame():
+                    self.done = True
+        except socket.error as se:
+            if se.errno != errno.EAGAIN:
+                raise
+        self.sent += sent
+        return sent
+
+    def close(self):
+        self.f.close()
+
+    def metrics(self):
+        elapsed = time.time() - self.start_time
+        if elapsed > 0:
+            rate = int(self.sent / elapsed)
+        else:
+            rate = 0
+        return { "name": self.name, "size": self.size,
+                 "start_offset": self.start_offset, "offset": self.offset,
+                 "bytes_per_sec": rate }
+
+
+
+class LogService(object):
+    """log downloads for all the connected apps
+
+    handle_download() is the APP_MSG_LOG_DOWNLOAD handler. The server calls
+    write() when a client with a download (see 'downloads') can be written,
+    and abort() when a client goes away.
+    """
+
+    def __init__(self, logger, log_dir, rate):
+        self.logger = logger
+        self.log_dir = log_dir
+        self.throttle = Throttle(rate)
+        # client -> LogDownload
+        self.downloads = { }
+        self.started = 0
+        self.completed = 0
+        self.aborted = 0
+        self.bytes = 0
+
+    def _path(self, name):
+        """full name of log 'name', or None if it is not a log"""
+        log_dir = os.path.realpath(self.log_dir)
+        path = os.path.realpath(os.path.join(log_dir, name))
+        if os.path.dirname(path) != log_dir or not os.path.isfile(path):
+            return None
+        return path
+
+    def handle_download(self, client, args):
+        if len(args) < OFFSET.size:
+            raise ValueError("short download request")
+        (offset, ) = OFFSET.unpack_from(args)
+        name = args[OFFSET.size:]
+        path = self._path(name)
+        if path is None:
+            raise ValueError("no log %s" % (name, ))
+        # a new request replaces one in progress
+        self.abort(client)
+        download = LogDownload(name, path, offset)
+        self.downloads[client] = download
+        self.started += 1
+        self.logger.info("download %s from %d (%d bytes) to %s", name, offset,
+                         download.size, str(client.address))
+        return json.dumps({ "name": name, "size": download.size,
+                            "offset": offset })
+
+    def ready(self, now):
+        """True if downloads may send now (a quarter of the burst, the same
+        as wait_time(), so sends are worth waking up for)"""
+        return self.throttle.wait_time(now) == 0
+
+    def wait_time(self, now):
+        return self.throttle.wait_time(now)
+
+    def write(self, client, now, more_frames=True):
+        """continue client's download; raises socket.error if the
+        connection is broken"""
+        download = self.downloads[client]
+        if not self.ready(now):
+            return
+        budget = self.throttle.available(now)
+        n = download.write(client.sock, budget, more_frames)
+        self.throttle.take(n)
+        self.bytes += n
+        if download.done:
+            del self.downloads[client]
+            download.close()
+            self.completed += 1
+            self.logger.info("download %s complete, %d bytes at %d bytes/sec",
+                             download.name, download.sent,
+                             download.metrics()["bytes_per_sec"])
+
+    def abort(self, client):
+        download = self.downloads.pop(client, None)
+        if download is not None:
+            download.close()
+            self.aborted += 1
+            self.logger.info("download %s stopped at %d of %d bytes",
+                             download.name, download.offset, download.size)
+
+    def metrics(self):
+        return { "started": self.started, "completed": self.completed,
+                 "aborted": self.aborted, "bytes": self.bytes,
+                 "rate_limit": self.throttle.rate,
+                 "active": [d.metrics() for d in self.downloads.values()] }
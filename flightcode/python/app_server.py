@@ -4,75 +4,33 @@
 # busybox 'pidof' can find this process by name.
 
 import ConfigParser
+import errno
 import logging
 import logging.config
 import optparse
 import os
+import select
 import socket
-import struct
 import sys
+import time
 sys.path.append("/usr/bin")
 import app_connected_msg
+import app_frame
+import app_handlers
+import app_logs
 
 solo_conf = "/etc/sololink.conf"
 
 # items read from solo_conf
 app_server_port = 0
 app_address_file = ""
+app_log_rate = 0
 
+# Apps connected at once; more than that are closed as soon as they connect
+MAX_CLIENTS = 4
 
-
-def get_request(sock):
-    """get one request from socket
-
-    A request is a 32-bit byte count followed by opaque data. The byte count
-    includes itself, i.e. the minimum byte count is four. The request is
-    returned as a string, with the initial byte count still included. The
-    purpose of "requests" at this level is really to just provide for reliable
-    datagrams over TCP.
-    """
-
-    # Read byte count
-    # XXX This is inefficient but simple; we never want to read beyond the end
-    # of the request we are receiving, to avoid needing to save state between
-    # calls to get_request.
-    pkt = ""
-    while len(pkt) < 4:
-        try:
-            b = sock.recv(1)
-        except socket.error as se:
-            # Android app: disconnect wifi without closing app and you get:
-            # socket.error: [Errno 110] Connection timed out
-            logger.info("socket.error: %s", str(se))
-            return None
-        except socket.timeout as st:
-            # Has not been observed to happen.
-            logger.info("socket.timeout: %s", str(st))
-            return None
-        if not b:
-            return None
-        pkt += b
-
-    (pkt_len, ) = struct.unpack("!I", pkt)
-
-    logger.debug("packet length %d", pkt_len)
-
-    # Read the rest of the packet
-    # XXX Super-inefficient. Don't read beyond the end of the current packet.
-    while len(pkt) < pkt_len:
-        try:
-            b = sock.recv(1)
-        except socket.error as se:
-            logger.info("socket.error: %s", str(se))
-            return None
-        except socket.timeout as st:
-            logger.info("socket.timeout: %s", str(st))
-            return None
-        if not b:
-            return None
-        pkt += b
-
-    return pkt
+# seconds between logging request counts and latencies
+REPORT_INTERVAL = 60
 
 
 
@@ -92,6 +50,116 @@ def unset_app_ip():
 
 
 
+class Client(object):
+    """one app connection"""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.reader = app_frame.FrameReader(sock)
+        # responses not sent yet
+        self.out = ""
+
+
+
+def close_client(client):
+    logger.info("closing connection from %s", str(client.address))
+    try:
+        client.sock.shutdown(socket.SHUT_RDWR)
+    except socket.error as se:
+        # Android app: disconnect wifi without closing app and you get:
+        # socket.error: [Errno 107] Transport endpoint is not connected
+        logger.info("socket.error: %s", str(se))
+    except socket.timeout as st:
+        # Has not been observed to happen.
+        logger.info("socket.timeout: %s", str(st))
+    client.sock.close()
+
+
+
+def handle_client(client, dispatcher):
+    """receive from a client that is readable and answer what it sent
+
+    A request is a 32-bit byte count followed by the request data, handled
+    by app_handlers. The byte count includes itself, i.e. the minimum byte
+    count is four. The purpose of "requests" at this level is really to just
+    provide for reliable datagrams over TCP.
+
+    Each client has its own reader, which keeps any bytes past the end of the
+    last complete request for the next call.
+
+    Returns False if the connection should be closed.
+    """
+    try:
+        if client.reader.fill() == 0:
+            # Remote end closed the connection
+            return False
+    except socket.error as se:
+        if se.errno == errno.EAGAIN:
+            return True
+        # Android app: disconnect wifi without closing app and you get:
+        # socket.error: [Errno 110] Connection timed out
+        logger.info("socket.error: %s", str(se))
+        return False
+    except app_frame.FrameError as fe:
+        # not talking our protocol; give up on the connection
+        logger.info("bad request: %s", str(fe))
+        return False
+    while True:
+        try:
+            pkt = client.reader.next_frame()
+        except app_frame.FrameError as fe:
+            logger.info("bad request: %s", str(fe))
+            return False
+        if pkt is None:
+            return True
+        logger.debug("packet length %d", len(pkt))
+        response = dispatcher.dispatch(client, pkt)
+        if response is not None:
+            client.out += response
+    ### end while True
+
+
+
+def write_client(client, logs, now):
+    """send what is waiting to go to a client: responses, then the client's
+    log download (if any), as far as the socket and the download rate allow
+
+    Returns False if the connection should be closed.
+    """
+    download = logs.downloads.get(client)
+    try:
+        if download is not None:
+            # responses go between download frames, so if one is waiting
+            # only finish the frame being sent
+            logs.write(client, now, more_frames=not client.out)
+        if client.out and (download is None or not download.in_frame()):
+            n = client.sock.send(client.out)
+            client.out = client.out[n:]
+    except socket.error as se:
+        if se.errno == errno.EAGAIN:
+            return True
+        logger.info("socket.error: %s", str(se))
+        return False
+    except IOError as ie:
+        # log went away or was truncated
+        logger.info("download: %s", str(ie))
+        logs.abort(client)
+        return False
+    return True
+
+
+
+def log_metrics(dispatcher):
+    for name in sorted(dispatcher.stats):
+        stats = dispatcher.stats[name]
+        if stats.count > 0:
+            logger.info("%s: %d requests, %d errors, avg %d usec, max %d usec",
+                        name, stats.count, stats.errors,
+                        stats.total_us / stats.count, stats.max_us)
+
+
+
 # app server connection loop
 def app_server():
 
@@ -107,49 +175,89 @@ def app_server():
     listen_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
     listen_sock.bind(("", app_server_port))
 
-    # only allow one connection
-    listen_sock.listen(0)
-
-    while True:
-
-        logger.info("waiting for connection")
-
-        # wait for connection
-        (sock, address) = listen_sock.accept()
+    listen_sock.listen(MAX_CLIENTS)
 
-        logger.info("connection from %s", str(address))
+    dispatcher = app_handlers.Dispatcher(logger)
+    app_handlers.register_all(dispatcher)
 
-        set_app_ip(address[0])
-        logger.info("app IP is %s", address[0])
+    logs = app_logs.LogService(logger, app_handlers.log_dir, app_log_rate)
+    dispatcher.register(app_logs.APP_MSG_LOG_DOWNLOAD, "log_download",
+                        logs.handle_download)
+    dispatcher.add_metrics("downloads", logs.metrics)
 
-        app_connected_msg.send_connected()
+    # clients in the order they connected
+    clients = []
 
-        # process requests from the client
-        while True:
-            # Get one request. We don't yet use these; it is the existence of
-            # the connection that is meaningful.
-            pkt = get_request(sock)
-            if not pkt:
-                # Remote end closed the connection
-                break
-            logger.info("received request: %s", str([hex(ord(x)) for x in pkt]))
-        ### end while True
+    report_time = time.time() + REPORT_INTERVAL
 
-        app_connected_msg.send_disconnected()
+    logger.info("waiting for connection")
 
-        unset_app_ip()
+    while True:
 
-        logger.info("closing connection")
-        try:
-            sock.shutdown(socket.SHUT_RDWR)
-        except socket.error as se:
-            # Android app: disconnect wifi without closing app and you get:
-            # socket.error: [Errno 107] Transport endpoint is not connected
-            logger.info("socket.error: %s", str(se))
-        except socket.timeout as st:
-            # Has not been observed to happen.
-            logger.info("socket.timeout: %s", str(st))
-        sock.close()
+        now = time.time()
+        socks = [listen_sock] + [client.sock for client in clients] + \
+                dispatcher.pending_socks()
+        timeout = max(0, report_time - now)
+        # requests waiting for other processes time out
+        if dispatcher.pending:
+            timeout = min(timeout, dispatcher.wait_time(now))
+        # Wait to write to a client with responses waiting, or with a
+        # download if the rate allows sending now; otherwise wake up when
+        # it will.
+        downloads_ready = logs.ready(now)
+        if logs.downloads and not downloads_ready:
+            timeout = min(timeout, logs.wait_time(now))
+        wsocks = [client.sock for client in clients \
+                  if client.out or (downloads_ready and client in logs.downloads)]
+        ready, writable, x = select.select(socks, wsocks, [], timeout)
+
+        # requests first, so a new connection doesn't delay them
+        closed = []
+        for client in clients:
+            if client.sock in ready and not handle_client(client, dispatcher):
+                closed.append(client)
+        now = time.time()
+        for client, response in dispatcher.poll(ready, now):
+            if response is not None:
+                client.out += response
+        for client in clients:
+            if client not in closed and \
+               (client.out or client.sock in writable) and \
+               not write_client(client, logs, now):
+                closed.append(client)
+        for client in closed:
+            clients.remove(client)
+            logs.abort(client)
+            dispatcher.abort(client)
+            close_client(client)
+            if clients:
+                # most recent app still connected
+                set_app_ip(clients[-1].address[0])
+                logger.info("app IP is %s", clients[-1].address[0])
+            else:
+                app_connected_msg.send_disconnected()
+                unset_app_ip()
+                logger.info("waiting for connection")
+
+        if listen_sock in ready:
+            (sock, address) = listen_sock.accept()
+            logger.info("connection from %s", str(address))
+            if len(clients) >= MAX_CLIENTS:
+                logger.info("too many connections; closing")
+                sock.close()
+            else:
+                if not clients:
+                    app_connected_msg.send_connected()
+                # never block the loop on one app
+                sock.setblocking(0)
+                clients.append(Client(sock, address))
+                set_app_ip(address[0])
+                logger.info("app IP is %s", address[0])
+
+        now = time.time()
+        if now >= report_time:
+            log_metrics(dispatcher)
+            report_time = now + REPORT_INTERVAL
 
     ### end while True
 
@@ -178,6 +286,12 @@ if __name__ == "__main__":
         logger.error("error reading config from %s", solo_conf)
         sys.exit(1)
 
+    # optional: log download rate, bytes/sec (0 for no limit)
+    try:
+        app_log_rate = config.getint("solo", "appLogRate")
+    except:
+        app_log_rate = 0
+
     parser = optparse.OptionParser("app_server [options]")
 
     (opts, args) = parser.parse_args()
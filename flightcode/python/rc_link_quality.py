@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# RC link quality, kept by pixrc.py.
+#
+# pixrc tells a LinkQuality about every RC packet it accepts (and every
+# receive timeout), and it keeps histograms over a rolling window of
+#
+#   gap_us  time between packets
+#   loss    packets missed (by sequence number) just before each packet
+#   burst   packets that arrived together (less than BURST_GAP_US apart)
+#
+# as well as counts since pixrc started.
+#
+# Each histogram is a ring of fixed-size arrays, one per second of the
+# window, plus the window's total. When a second drops out of the window its
+# counts are subtracted from the total, so the total is always current without
+# adding up the whole window, and memory does not grow however long the
+# flight is. Percentiles come from the total, to bucket resolution.
+#
+# Once a second LinkQuality makes a snapshot (a dictionary) of the counts and
+# percentiles; pixrc answers requests on a unix datagram socket with the
+# latest snapshot as JSON (telem_metrics.MetricsServer), and query() gets it.
+#
+#   rc_link_quality.py [socket_name]
+#
+# prints it.
+
+import array
+import json
+import sys
+import telem_metrics
+
+DEFAULT_SOCK_NAME = "/var/run/rc_link"
+
+WINDOW_S = 10
+
+# gap_us: 1 msec buckets; the last is everything from 255 msec up
+GAP_BUCKET_US = 1000
+GAP_BUCKETS = 256
+
+# loss: packets missed, 0..DISC_GAP-1
+LOSS_BUCKETS = 8
+
+# burst: packets; the last is everything from 15 up
+BURST_BUCKETS = 16
+
+# A sequence gap more than this is a discontinuity (e.g. Artoo restarted),
+# not lost packets
+DISC_GAP = 5
+
+SEQ_MOD = 65536
+
+# Packets arriving less than this apart are a burst
+BURST_GAP_US = 2000
+
+SNAPSHOT_INTERVAL_US = 1000000
+
+
+
+class RollingHistogram(object):
+    """counts of samples in fixed buckets over the last 'window_s' seconds
+
+    Samples are non-negative integers; bucket n has samples from
+    n * bucket_size up, and the last bucket has everything larger.
+    """
+
+    def __init__(self, buckets, bucket_size, window_s=WINDOW_S):
+        self.buckets = buckets
+        self.bucket_size = bucket_size
+        self.window_s = window_s
+        # per second: counts by bucket, number of samples, sum, max
+        self._slots = [ array.array("I", [0]) * buckets
+                        for i in range(window_s) ]
+        self._slot_count = [ 0 ] * window_s
+        self._slot_sum = [ 0 ] * window_s
+        self._slot_max = [ None ] * window_s
+        # the window's counts by bucket, number of samples, and sum
+        self._total = array.array("I", [0]) * buckets
+        self.count = 0
+        self.sum = 0
+        # second (monotonic) that _slots[_index] is for
+        self._second = None
+        self._index = 0
+
+    def _advance(self, now_us):
+        """move the window up to now, dropping seconds that fall out"""
+        second = now_us / 1000000
+        if self._second is None:
+            self._second = second
+            return
+        steps = min(second - self._second, self.window_s)
+        for i in range(steps):
+            self._index = (self._index + 1) % self.window_s
+            index = self._index
+            if self._slot_count[index] > 0:
+                slot = self._slots[index]
+                total = self._total
+                for b in range(self.buckets):
+                    if slot[b] != 0:
+                        total[b] -= slot[b]
+                        slot[b] = 0
+                self.count -= self._slot_count[index]
+                self.sum -= self._slot_sum[index]
+                self._slot_count[index] = 0
+                self._slot_sum[index] = 0
+            self._slot_max[index] = None
+        if second > self._second:
+            self._second = second
+
+    def add(self, value, now_us):
+        self._advance(now_us)
+        b = min(value / self.bucket_size, self.buckets - 1)
+        index = self._index
+        self._slots[index][b] += 1
+        self._total[b] += 1
+        self._slot_count[index] += 1
+        self._slot_sum[index] += value
+        if self._slot_max[index] < value:
+            self._slot_max[index] = value
+        self.count += 1
+        self.sum += value
+
+    def percentiles(self, ps, now_us):
+        """values at the percentiles in the sorted list 'ps' (e.g. [50, 99]),
+        to bucket resolution (the bottom of the bucket); None if no samples"""
+        self._advance(now_us)
+        if self.count == 0:
+            return [ None ] * len(ps)
+        values = [ ]
+        cumulative = 0
+        b = 0
+        for p in ps:
+            # the sample at this percentile, counting from 1
+            target = max((self.count * p + 99) / 100, 1)
+            while cumulative + self._total[b] < target:
+                cumulative += self._total[b]
+                b += 1
+            values.append(b * self.bucket_size)
+        return values
+
+    def summary(self, now_us):
+        p50, p90, p99 = self.percentiles([50, 90, 99], now_us)
+        if self.count > 0:
+            avg = float(self.sum) / self.count
+        else:
+            avg = None
+        return { "count": self.count, "avg": avg,
+                 "p50": p50, "p90": p90, "p99": p99,
+                 "max": max(self._slot_max) }
+
+
+
+class LinkQuality(object):
+    """RC packet timing and sequence statistics
+
+    All methods are called from one thread (pixrc's rcReceive). Other threads
+    only read 'snapshot', which is replaced (never changed) once a second.
+    """
+
+    def __init__(self, window_s=WINDOW_S):
+        self.window_s = window_s
+        self.gap = RollingHistogram(GAP_BUCKETS, GAP_BUCKET_US, window_s)
+        self.loss = RollingHistogram(LOSS_BUCKETS, 1, window_s)
+        self.burst = RollingHistogram(BURST_BUCKETS, 1, window_s)
+        # since start
+        self.packets = 0
+        self.good = 0       # in sequence
+        self.drop = 0       # missed (small sequence gaps)
+        self.disc = 0       # discontinuities (large sequence gaps)
+        self.timeouts = 0
+        self.snapshot = None
+        self._last_us = None
+        self._sequence = None
+        self._burst = 0
+        self._snapshot_us = None
+
+    def packet(self, now_us, sequence):
+        """count an RC packet (received at monotonic now_us)
+
+        Returns the sequence gap (1 is in order), or None for the first.
+        """
+        self.packets += 1
+        if self._last_us is not None:
+            gap_us = now_us - self._last_us
+            self.gap.add(gap_us, now_us)
+            if gap_us >= BURST_GAP_US:
+                self.burst.add(self._burst, now_us)
+                self._burst = 0
+        self._last_us = now_us
+        self._burst += 1
+        gap = None
+        if self._sequence is not None:
+            gap = (sequence - self._sequence) % SEQ_MOD
+            if gap == 1:
+                self.good += 1
+                self.loss.add(0, now_us)
+            elif 1 < gap <= DISC_GAP:
+                self.drop += (gap - 1)
+                self.loss.add(gap - 1, now_us)
+            else:
+                self.disc += 1
+        self._sequence = sequence
+        self._snap(now_us)
+        return gap
+
+    def timeout(self, now_us):
+        """count a receive timeout (no RC for a while)"""
+        self.timeouts += 1
+        self._snap(now_us)
+
+    def _snap(self, now_us):
+        if self._snapshot_us is None or \
+           (now_us - self._snapshot_us) >= SNAPSHOT_INTERVAL_US:
+            self.snapshot = self.metrics(now_us)
+            self._snapshot_us = now_us
+
+    def metrics(self, now_us):
+        """counts since start, and the window's histogram summaries"""
+        if self._last_us is not None:
+            age_us = now_us - self._last_us
+        else:
+            age_us = None
+        # lost / (received + lost), in the window
+        sent = self.loss.count + self.loss.sum
+        if sent > 0:
+            loss_pct = 100.0 * self.loss.sum / sent
+        else:
+            loss_pct = None
+        return { "packets": self.packets,
+                 "good": self.good,
+                 "drop": self.drop,
+                 "disc": self.disc,
+                 "timeouts": self.timeouts,
+                 "age_us": age_us,
+                 "window_s": self.window_s,
+                 "loss_pct": loss_pct,
+                 "gap_us": self.gap.summary(now_us),
+                 "loss": self.loss.summary(now_us),
+                 "burst": self.burst.summary(now_us) }
+
+
+
+def query(sock_name=DEFAULT_SOCK_NAME, timeout_s=1.0):
+    """get the RC link metrics from pixrc, as a dictionary (None on timeout,
+    or if pixrc has not had any RC yet)"""
+    return telem_metrics.query(sock_name, timeout_s)
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sock_name = sys.argv[1]
+    else:
+        sock_name = DEFAULT_SOCK_NAME
+    metrics = query(sock_name)
+    if metrics is None:
+        print "no response from %s" % (sock_name, )
+        sys.exit(1)
+    print json.dumps(metrics, indent=4, sort_keys=True)
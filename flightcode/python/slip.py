@@ -1,20 +1,46 @@
 #!/usr/bin/env python
 
+import collections
+import slip_capture
+import slip_codec
+
 class SlipDevice:
 
-    END     = chr(0300) # indicates end of packet
-    ESC     = chr(0333) # indicates byte stuffing
-    ESC_END = chr(0334) # ESC ESC_END means END data byte
-    ESC_ESC = chr(0335) # ESC ESC_ESC means ESC data byte
+    END     = slip_codec.END     # indicates end of packet
+    ESC     = slip_codec.ESC     # indicates byte stuffing
+    ESC_END = slip_codec.ESC_END # ESC ESC_END means END data byte
+    ESC_ESC = slip_codec.ESC_ESC # ESC ESC_ESC means ESC data byte
 
-    def __init__(self, serial_dev):
+    def __init__(self, serial_dev, max_len=slip_codec.MAX_PKT_LEN,
+                 capture=None):
         self.ser = serial_dev
         self.insync = False
+        self.decoder = slip_codec.SlipDecoder(max_len)
+        # decoded packets not returned by read() yet
+        self.pkts = collections.deque()
+        # slip_capture.CaptureWriter for everything sent and received
+        self.capture = capture
+
+    def _decode(self, dat):
+        pkts = self.decoder.feed(dat)
+        if self.capture is not None:
+            for pkt in pkts:
+                self.capture.add(slip_capture.RX, pkt)
+        self.pkts.extend(pkts)
+
+    def _read_serial(self):
+        """whatever is in the serial buffer, waiting for at least one byte
+        (or the port's timeout) if it is empty"""
+        try:
+            waiting = self.ser.inWaiting()
+        except AttributeError:
+            waiting = 0
+        return self.ser.read(max(waiting, 1))
 
     def sync(self):
         attempts = 0
         while 1:
-            dat = self.ser.read()
+            dat = self._read_serial()
             if not dat:
                 attempts += 1
                 if(attempts >= 3):
@@ -22,51 +48,35 @@ class SlipDevice:
                     return False
                 continue
 
-            if dat == self.END:
+            self._decode(dat)
+            if self.decoder.in_sync:
                 self.insync = True
                 return True
 
     def read(self):
         """
         read a SLIP packet from artoo.
-        """
-        pkt = []
 
+        The packet is returned as a string. Everything available is read from
+        the serial port at once, and any packets after the first are kept for
+        later calls.
+        """
         if not self.insync:
             if(self.sync() == False):
-                return pkt;
+                return []
+
+        while not self.pkts:
+            self._decode(self._read_serial())
 
-        while True:
-            b = self.ser.read()
-            if b == self.END:
-                if len(pkt) > 0:
-                    return pkt
-            elif b == self.ESC:
-                b = self.ser.read()
-                if b == self.ESC_END:
-                    pkt.append(self.END)
-                elif b == self.ESC_ESC:
-                    pkt.append(self.ESC)
-                else:
-                    pkt.append(b)
-            else:
-                pkt.append(b)
+        return self.pkts.popleft()
 
     def write(self, pkt):
         """
         write a SLIP message to artoo
         """
+        if not isinstance(pkt, str):
+            pkt = "".join(pkt)
+        if self.capture is not None:
+            self.capture.add(slip_capture.TX, pkt)
+        self.ser.write(slip_codec.encode(pkt))
 
-        slip_bytes = [self.END]
-        for b in pkt:
-            if b == self.END:
-                slip_bytes.append(self.ESC)
-                slip_bytes.append(self.ESC_END)
-            elif b == self.ESC:
-                slip_bytes.append(self.ESC)
-                slip_bytes.append(self.ESC_ESC)
-            else:
-                slip_bytes.append(b)
-
-        slip_bytes.append(self.END)
-        self.ser.write("".join(slip_bytes))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Capture of the packets on a SLIP link, with timestamps, for debugging (e.g.
+# RC jitter on the STM32 link).
+#
+# The capture is a ring in a fixed-size file: once it is full, the oldest
+# packets are overwritten, so it can be left on. The file is mmapped, so
+# adding a packet is a couple of copies into memory and no system calls.
+#
+# Layout (little-endian):
+#
+#   header (HEADER_SIZE bytes)
+#     magic, version, data_size, offset, oldest
+#   data (data_size bytes)
+#     records: time (usec, CLOCK_MONOTONIC), direction, length, then the
+#     packet (unescaped)
+#
+# Records are written from offset 0 until the next one doesn't fit; then a
+# PAD record header is written (if there is room for one) and writing starts
+# at 0 again. 'offset' is where the next record goes, and 'oldest' is the
+# first record left from the previous time around (NO_RECORD if none), so
+# the capture in time order is oldest up to the PAD, then 0 up to offset.
+
+import mmap
+import os
+import struct
+import time
+import clock
+
+MAGIC = 0x50414353 # "SCAP"
+VERSION = 1
+
+HEADER = struct.Struct("<IIIII")
+HEADER_SIZE = 32 # HEADER, padded
+_POSITIONS = struct.Struct("<II") # offset, oldest
+_OFFSET_POSITIONS = 12
+
+RECORD = struct.Struct("<QBH")
+
+# directions
+RX = 0 # received from the other end
+TX = 1 # sent to the other end
+PAD = 0xff
+
+NO_RECORD = 0xffffffff
+
+DEFAULT_SIZE = 1024 * 1024
+
+
+
+class CaptureWriter(object):
+    """write packets to a capture file (replacing what is there)"""
+
+    def __init__(self, file_name, data_size=DEFAULT_SIZE):
+        self.file_name = file_name
+        self.data_size = data_size
+        self.packets = 0
+        f = open(file_name, "w+b")
+        f.truncate(HEADER_SIZE + data_size)
+        self._mm = mmap.mmap(f.fileno(), HEADER_SIZE + data_size)
+        f.close()
+        self._offset = 0
+        self._oldest = NO_RECORD
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, data_size, 0, NO_RECORD)
+
+    def _next(self, offset):
+        """offset of the record after the one at 'offset' (previous time
+        around), or NO_RECORD if that was the last one"""
+        if (self.data_size - offset) < RECORD.size:
+            return NO_RECORD
+        time_us, direction, length = \
+            RECORD.unpack_from(self._mm, HEADER_SIZE + offset)
+        if direction == PAD:
+            return NO_RECORD
+        offset += RECORD.size + length
+        if (self.data_size - offset) < RECORD.size:
+            return NO_RECORD
+        return offset
+
+    def add(self, direction, pkt, time_us=None):
+        """add a packet (string); time_us defaults to now"""
+        if time_us is None:
+            time_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+        mm = self._mm
+        length = len(pkt)
+        offset = self._offset
+        end = offset + RECORD.size + length
+        if end > self.data_size:
+            if length > (self.data_size - RECORD.size):
+                return # would never fit
+            if (self.data_size - offset) >= RECORD.size:
+                RECORD.pack_into(mm, HEADER_SIZE + offset, 0, PAD, 0)
+            offset = 0
+            end = RECORD.size + length
+            self._oldest = 0
+        # records from last time around that this one overwrites
+        oldest = self._oldest
+        while oldest != NO_RECORD and oldest < end:
+            oldest = self._next(oldest)
+        self._oldest = oldest
+        RECORD.pack_into(mm, HEADER_SIZE + offset, time_us, direction, length)
+        start = HEADER_SIZE + offset + RECORD.size
+        mm[start:start + length] = pkt
+        self._offset = end
+        _POSITIONS.pack_into(mm, _OFFSET_POSITIONS, end, oldest)
+        self.packets += 1
+
+    def close(self):
+        self._mm.close()
+
+
+
+def read_capture(file_name):
+    """packets in a capture file, oldest first, as a list of
+    (time_us, direction, pkt)"""
+    f = open(file_name, "rb")
+    data = f.read()
+    f.close()
+    if len(data) < HEADER_SIZE:
+        raise ValueError("%s is not a capture file" % (file_name, ))
+    magic, version, data_size, offset, oldest = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or \
+       len(data) < (HEADER_SIZE + data_size):
+        raise ValueError("%s is not a capture file" % (file_name, ))
+    records = []
+    def read_records(start, stop):
+        while (start + RECORD.size) <= stop:
+            time_us, direction, length = \
+                RECORD.unpack_from(data, HEADER_SIZE + start)
+            if direction == PAD:
+                break
+            start += RECORD.size
+            if (start + length) > stop:
+                break # cut off (should not happen)
+            records.append((time_us, direction,
+                            data[HEADER_SIZE + start:
+                                 HEADER_SIZE + start + length]))
+            start += length
+    if oldest != NO_RECORD:
+        read_records(oldest, data_size)
+    read_records(0, offset)
+    return records
+
+
+
+def replay(records, speed=1.0):
+    """generator of the records, each at its time relative to the first one
+    divided by 'speed' (so 1.0 is the original timing, 2.0 is twice as fast,
+    and 0 is as fast as possible)"""
+    start = None
+    for record in records:
+        if speed > 0:
+            now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+            if start is None:
+                start = (now_us, record[0])
+            due_us = start[0] + (record[0] - start[1]) / speed
+            if due_us > now_us:
+                time.sleep((due_us - now_us) / 1000000.0)
+        yield record
+
+
+
+if __name__ == "__main__":
+    # write a capture that wraps several times, check it reads back, and
+    # time add() for RC-sized packets
+    import random
+    import tempfile
+    file_name = os.path.join(tempfile.mkdtemp(), "capture")
+    writer = CaptureWriter(file_name, 4096)
+    sent = []
+    for i in range(1000):
+        pkt = os.urandom(random.randint(0, 100))
+        writer.add(i % 2, pkt, i)
+        sent.append((i, i % 2, pkt))
+        if (i % 97) == 0:
+            got = read_capture(file_name)
+            assert got == sent[-len(got):], "capture lost or changed packets"
+            # at least half the ring is the newest packets
+            assert sum([RECORD.size + len(r[2]) for r in got]) > 2048 or \
+                   len(got) == len(sent)
+    writer.close()
+    pkt = "\x01" + "\x00" * 16
+    writer = CaptureWriter(file_name)
+    start = time.time()
+    for i in range(100000):
+        writer.add(RX, pkt)
+    print "add(): %0.2f usec/packet" % ((time.time() - start) * 10, )
+    writer.close()
+    os.unlink(file_name)
+    os.rmdir(os.path.dirname(file_name))
+    print "ok"
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# SLIP encoding and decoding, without any I/O.
+#
+# SlipDecoder is given data as it arrives, in pieces of any size, and returns
+# the complete packets; it keeps a partial packet until the rest arrives.
+# Used by flightcode/python/slip.py (SlipDevice) and flightcode/old/slip.py.
+#
+# Packets are found with str.split() on END and unescaped with
+# str.replace(), so the work per byte is done in C.
+
+END     = chr(0xc0) # indicates end of packet
+ESC     = chr(0xdb) # indicates byte stuffing
+ESC_END = chr(0xdc) # ESC ESC_END means END data byte
+ESC_ESC = chr(0xdd) # ESC ESC_ESC means ESC data byte
+
+# This is really for detecting garbage input, and not passing huge junk to the
+# stm32 message handlers. Intended to be much bigger than any real packet. If
+# we get more than this much data without finding an END, we drop the packet
+# and go back to looking for sync.
+MAX_PKT_LEN = 1024
+
+
+
+def encode(pkt):
+    """SLIP-encoded packet (string), with an END before and after"""
+    # ESC first, so the ESCs added for END are not escaped again
+    pkt = pkt.replace(ESC, ESC + ESC_ESC)
+    pkt = pkt.replace(END, ESC + ESC_END)
+    return END + pkt + END
+
+
+
+def unescape(data):
+    """undo the byte stuffing in one packet's data (no ENDs)
+
+    ESC_END pairs are done first, so an escaped ESC followed by ESC_END is not
+    taken for an escaped END. A bad escape (ESC followed by something else) is
+    left as is.
+    """
+    if ESC not in data:
+        return data
+    data = data.replace(ESC + ESC_END, END)
+    return data.replace(ESC + ESC_ESC, ESC)
+
+
+
+class SlipDecoder(object):
+    """incremental SLIP decoder
+
+    feed() takes received data and returns a list of the packets (strings)
+    it completed, in order. Data before the first END is dropped (we don't
+    know where a packet starts until we see one end), as is a packet longer
+    than max_len; the decoder then looks for the next END.
+
+    'counts' has the bytes received ('BYTE'), bytes dropped looking for sync
+    ('DROP'), times sync was found ('SYNC'), escapes ('ESC'), and packets
+    ('PKT'). 'desyncs' counts the times sync was lost, by reason.
+    """
+
+    def __init__(self, max_len=MAX_PKT_LEN):
+        self.max_len = max_len
+        self.in_sync = False
+        # received data after the last END, still escaped
+        self._partial = ""
+        self.counts = { 'BYTE': 0, 'SYNC': 0, 'DROP': 0, 'ESC': 0, 'PKT': 0 }
+        self.desyncs = { }
+
+    def desync(self, reason):
+        self.in_sync = False
+        self._partial = ""
+        self.desyncs[reason] = self.desyncs.get(reason, 0) + 1
+
+    def feed(self, data):
+        """packets completed by 'data'"""
+        counts = self.counts
+        counts['BYTE'] += len(data)
+        if not self.in_sync:
+            i = data.find(END)
+            if i < 0:
+                counts['DROP'] += len(data)
+                return []
+            counts['DROP'] += i
+            counts['SYNC'] += 1
+            self.in_sync = True
+            data = data[i + 1:]
+        frames = (self._partial + data).split(END)
+        # the last one is not finished (it is "" if data ended with END)
+        partial = frames.pop()
+        pkts = []
+        for frame in frames:
+            if not frame:
+                # leading ENDs, or several in a row, are okay
+                continue
+            if ESC in frame:
+                counts['ESC'] += frame.count(ESC)
+                frame = unescape(frame)
+            if len(frame) > self.max_len:
+                # complete, but not believable; the END it ended with is a
+                # good place to start again, so we are still in sync
+                self.desyncs['TOO_LONG'] = self.desyncs.get('TOO_LONG', 0) + 1
+                continue
+            pkts.append(frame)
+        counts['PKT'] += len(pkts)
+        # An escaped packet can be up to twice max_len; only unescape it to
+        # check when it might be too long
+        if len(partial) > self.max_len and \
+           len(unescape(partial)) > self.max_len:
+            counts['DROP'] += len(partial)
+            self.desync('TOO_LONG')
+        else:
+            self._partial = partial
+        return pkts
+
+
+
+if __name__ == "__main__":
+    import random
+
+    # END processing
+    dec = SlipDecoder()
+    data = ""
+    # junk discarded before first END, and the first END
+    data += "abc" + END
+    # first packet
+    data += "1:123" + END
+    # second packet, only the one END between first and second
+    data += "2:45" + END
+    # leading ENDs are okay
+    data += END + "3:6" + END
+    # lots of ENDs are okay
+    data += END + END + END + "4:789" + END
+    expect = ["1:123", "2:45", "3:6", "4:789"]
+    assert dec.feed(data) == expect
+    assert dec.counts['DROP'] == 3 and dec.counts['SYNC'] == 1
+
+    # escapes, and data split at every possible place
+    pkts = ["".join([chr(random.choice([0xc0, 0xdb, 0xdc, 0xdd, 0x41]))
+                     for j in range(random.randint(1, 20))])
+            for i in range(50)]
+    data = "".join([encode(pkt) for pkt in pkts])
+    for n in range(1, 8):
+        dec = SlipDecoder()
+        got = []
+        for i in range(0, len(data), n):
+            got.extend(dec.feed(data[i:i + n]))
+        assert got == pkts, "split %d" % n
+
+    # too long, whether it ends or not, then back in sync
+    dec = SlipDecoder(max_len=10)
+    assert dec.feed(END + "x" * 11 + END + "ok" + END) == ["ok"]
+    assert dec.feed("y" * 30) == []
+    assert not dec.in_sync
+    assert dec.feed("y" + END + "ok" + END) == ["ok"]
+    assert dec.desyncs == { 'TOO_LONG': 2 }
+    # an escaped packet of max_len is fine
+    assert dec.feed(encode(END * 10)) == [END * 10]
+
+    print "ok"
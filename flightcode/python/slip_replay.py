@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# Replay a SLIP link capture (see slip_capture.py).
+#
+# The captured packets are encoded again and fed back through the decoder
+# (slip_codec.SlipDecoder), in pieces the size a serial read might return,
+# at the original speed or faster. What comes out is checked against what
+# went in, and the timing of the received packets is summarized per packet
+# ID, which is the interesting part for RC jitter (packet ID 1 on the STM32
+# link).
+#
+# To replay a capture into stm32.py instead, use stm32_sim.py --replay.
+
+import sys
+from optparse import OptionParser
+import slip_capture
+import slip_codec
+
+
+
+class IntervalStats(object):
+    """intervals (usec) between packets of one type"""
+
+    def __init__(self):
+        self.count = 0
+        self.last_us = None
+        self.total_us = 0
+        self.min_us = None
+        self.max_us = None
+        # intervals by msec
+        self.histogram = { }
+
+    def add(self, time_us):
+        self.count += 1
+        if self.last_us is not None:
+            interval_us = time_us - self.last_us
+            self.total_us += interval_us
+            if self.min_us is None or interval_us < self.min_us:
+                self.min_us = interval_us
+            if self.max_us is None or interval_us > self.max_us:
+                self.max_us = interval_us
+            ms = interval_us / 1000
+            self.histogram[ms] = self.histogram.get(ms, 0) + 1
+        self.last_us = time_us
+
+    def __str__(self):
+        if self.count < 2:
+            return "%d packets" % (self.count, )
+        return "%d packets, interval min %d avg %d max %d usec" % \
+            (self.count, self.min_us, self.total_us / (self.count - 1),
+             self.max_us)
+
+
+
+def main():
+    parser = OptionParser("slip_replay.py [options] capture_file")
+    parser.add_option("--speed", dest="speed", type="float", default=0,
+                      help="1 is the original timing, 0 (default) is as "
+                           "fast as possible")
+    parser.add_option("--chunk", dest="chunk", type="int", default=16,
+                      help="bytes given to the decoder at a time")
+    parser.add_option("--histogram", dest="histogram", type="int",
+                      default=None,
+                      help="print interval histogram (msec) for packet ID")
+    parser.add_option("-v", dest="verbose", action="store_true",
+                      default=False, help="print every packet")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    records = slip_capture.read_capture(args[0])
+    rx_records = [r for r in records if r[1] == slip_capture.RX]
+    print "%d packets (%d received, %d sent)" % \
+        (len(records), len(rx_records), len(records) - len(rx_records))
+    if not rx_records:
+        return
+
+    decoder = slip_codec.SlipDecoder()
+    # we start in the middle of the stream
+    decoder.feed(slip_codec.END)
+    stats = { }
+    mismatches = 0
+    index = 0
+    for time_us, direction, pkt in slip_capture.replay(rx_records, opts.speed):
+        data = slip_codec.encode(pkt)
+        for i in range(0, len(data), opts.chunk):
+            for got in decoder.feed(data[i:i + opts.chunk]):
+                if got != rx_records[index][2]:
+                    mismatches += 1
+                index += 1
+        if opts.verbose:
+            print "%d.%06d %s" % (time_us / 1000000, time_us % 1000000,
+                                  " ".join(["%02x" % ord(c) for c in pkt]))
+        if pkt:
+            pkt_id = ord(pkt[0])
+            if pkt_id not in stats:
+                stats[pkt_id] = IntervalStats()
+            stats[pkt_id].add(time_us)
+
+    print "decoded %d of %d packets, %d different, desyncs %s" % \
+        (index, len(rx_records), mismatches, str(decoder.desyncs))
+    for pkt_id in sorted(stats):
+        print "id %d: %s" % (pkt_id, str(stats[pkt_id]))
+    if opts.histogram in stats:
+        histogram = stats[opts.histogram].histogram
+        for ms in sorted(histogram):
+            print "%4d msec %6d" % (ms, histogram[ms])
+
+
+
+if __name__ == "__main__":
+    main()
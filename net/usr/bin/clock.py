@@ -8,6 +8,7 @@
 # datetime jump).
 
 import ctypes
+import errno
 import os
 
 CLOCK_REALTIME              = 0
@@ -21,6 +22,9 @@ CLOCK_BOOTTIME              = 7
 CLOCK_REALTIME_ALARM        = 8
 CLOCK_BOOTTIME_ALARM        = 9
 
+# clock_nanosleep flag: the time is absolute, not relative
+TIMER_ABSTIME               = 1
+
 class timespec(ctypes.Structure):
     _fields_ = [
         ("tv_sec", ctypes.c_long),
@@ -35,6 +39,10 @@ clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
 clock_settime = librt.clock_settime
 clock_settime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
 
+clock_nanosleep = librt.clock_nanosleep
+clock_nanosleep.argtypes = [ctypes.c_int, ctypes.c_int,
+                            ctypes.POINTER(timespec), ctypes.POINTER(timespec)]
+
 def gettime(clock_id):
     t = timespec()
     if clock_gettime(clock_id, ctypes.pointer(t)) != 0:
@@ -57,6 +65,20 @@ def settime_us(clock_id, us):
         errno_ = ctypes.get_errno()
         raise OSError(errno_, os.strerror(errno_))
 
+# Sleep until the clock reads 'us' (an absolute time, not a delay), so time
+# spent before the call doesn't move the wakeup; returns at once if that time
+# has passed. Good for periodic work: add the period to the last deadline
+# each time and the errors don't add up.
+def sleep_until_us(clock_id, us):
+    t = timespec(us/1000000, (us%1000000) * 1000)
+    while True:
+        # clock_nanosleep returns the error rather than setting errno
+        err = clock_nanosleep(clock_id, TIMER_ABSTIME, ctypes.pointer(t), None)
+        if err == 0:
+            return
+        if err != errno.EINTR:
+            raise OSError(err, os.strerror(err))
+
 def test(do_set):
     rt = gettime(CLOCK_REALTIME)
     print "REALTIME:  %10d.%09d" % (rt.tv_sec, rt.tv_nsec)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# MAVLink packet framing helpers for the telemetry forwarder (telem_ctrl).
+#
+# These work directly on packet buffers (bytearray, or any buffer that
+# struct.unpack_from accepts) so the forwarding path does not have to slice
+# or ord() its way through each header.
+
+import array
+import struct
+
+# MAVLink v1 header:
+#   magic, payload length, sequence, system id, component id, message id
+# Followed by the payload and a two-byte checksum.
+V1_MAGIC = 254
+V1_HEADER = struct.Struct("<BBBBBB")
+V1_OVERHEAD = 8 # header + checksum
+
+# MAVLink v2 header:
+#   magic, payload length, incompat flags, compat flags, sequence,
+#   system id, component id, message id (24 bits, unpacked as 16 + 8)
+# Followed by the payload, a two-byte checksum, and a 13-byte signature if
+# the SIGNED incompat flag is set. Trailing zero bytes in the payload are
+# not sent, so the payload may be shorter than the message.
+V2_MAGIC = 253
+V2_HEADER = struct.Struct("<BBBBBBBHB")
+V2_OVERHEAD = 12 # header + checksum
+V2_INCOMPAT_SIGNED = 0x01
+V2_INCOMPAT_KNOWN = V2_INCOMPAT_SIGNED
+V2_SIGNATURE_LEN = 13
+
+# Results from FrameChecker.check()
+FRAME_OK = 0
+FRAME_SHORT = 1         # too short to be a packet
+FRAME_MAGIC = 2         # not a v1 or v2 packet
+FRAME_LENGTH = 3        # length in header does not match packet length
+FRAME_INCOMPAT = 4      # v2 incompat flags we don't understand
+FRAME_CRC = 5           # checksum wrong
+FRAME_NUM_RESULTS = 6
+
+frame_result_names = [ "OK", "SHORT", "MAGIC", "LENGTH", "INCOMPAT", "CRC" ]
+
+# Number of possible sources, where a source index is
+# (system id << 8) | component id
+NUM_SOURCES = 65536
+
+# tlog record: big-endian microsecond timestamp, then the packet
+TLOG_TIMESTAMP = struct.Struct(">Q")
+
+
+
+def _crc_x25_table():
+    table = array.array("H", [0]) * 256
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc >>= 1
+        table[i] = crc
+    return table
+
+_crc_table = _crc_x25_table()
+
+
+
+def crc_x25(data, crc=0xffff):
+    """MAVLink (CRC-16/MCRF4XX) checksum of data (bytearray)"""
+    table = _crc_table
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xff]
+    return crc
+
+
+
+def crc_extra_table(mavlink):
+    """dictionary of CRC_EXTRA values, indexed by message id
+
+    'mavlink' is a pymavlink dialect module, e.g. mavutil.mavlink. Older
+    pymavlink maps message ids to tuples ending with the CRC_EXTRA; newer
+    maps them to message classes with a crc_extra attribute.
+    """
+    crc_extras = { }
+    for msg_id, entry in mavlink.mavlink_map.items():
+        if isinstance(entry, tuple):
+            crc_extras[msg_id] = entry[-1]
+        else:
+            crc_extras[msg_id] = entry.crc_extra
+    return crc_extras
+
+
+
+class FrameChecker(object):
+    """validate MAVLink v1 and v2 framing
+
+    check() returns a tuple
+        (result, sequence, src_system, src_component, msg_id,
+         payload_offset, payload_len)
+    where result is one of the FRAME_* values; the other items are only
+    meaningful if result is FRAME_OK.
+
+    If crc_extras (see crc_extra_table) is supplied, the checksum is verified
+    for every message id in it. Messages not in it can't be verified; they
+    are counted in 'unchecked' and passed as FRAME_OK.
+    """
+
+    def __init__(self, crc_extras=None):
+        self.crc_extras = crc_extras
+        self.unchecked = 0
+        self.v1 = 0
+        self.v2 = 0
+        self._v1_unpack_from = V1_HEADER.unpack_from
+        self._v2_unpack_from = V2_HEADER.unpack_from
+
+    def check(self, buf, pkt_len):
+        if pkt_len < V1_OVERHEAD:
+            return (FRAME_SHORT, 0, 0, 0, 0, 0, 0)
+        magic = buf[0]
+        if magic == V1_MAGIC:
+            magic, length, sequence, src_sys, src_comp, msg_id = \
+                self._v1_unpack_from(buf)
+            if length != (pkt_len - V1_OVERHEAD):
+                return (FRAME_LENGTH, 0, 0, 0, 0, 0, 0)
+            payload_offset = V1_HEADER.size
+            self.v1 += 1
+        elif magic == V2_MAGIC:
+            if pkt_len < V2_OVERHEAD:
+                return (FRAME_SHORT, 0, 0, 0, 0, 0, 0)
+            magic, length, incompat, compat, sequence, src_sys, src_comp, \
+                msg_id_lo, msg_id_hi = self._v2_unpack_from(buf)
+            if incompat & ~V2_INCOMPAT_KNOWN:
+                return (FRAME_INCOMPAT, 0, 0, 0, 0, 0, 0)
+            overhead = V2_OVERHEAD
+            if incompat & V2_INCOMPAT_SIGNED:
+                overhead += V2_SIGNATURE_LEN
+            if length != (pkt_len - overhead):
+                return (FRAME_LENGTH, 0, 0, 0, 0, 0, 0)
+            msg_id = (msg_id_hi << 16) | msg_id_lo
+            payload_offset = V2_HEADER.size
+            self.v2 += 1
+        else:
+            return (FRAME_MAGIC, 0, 0, 0, 0, 0, 0)
+        if self.crc_extras is not None:
+            crc_extra = self.crc_extras.get(msg_id)
+            if crc_extra is None:
+                self.unchecked += 1
+            else:
+                crc_end = payload_offset + length
+                crc = crc_x25(buf[1:crc_end])
+                crc = crc_x25((crc_extra, ), crc)
+                if crc != (buf[crc_end] | (buf[crc_end + 1] << 8)):
+                    return (FRAME_CRC, 0, 0, 0, 0, 0, 0)
+        return (FRAME_OK, sequence, src_sys, src_comp, msg_id,
+                payload_offset, length)
+
+
+
+def source_index(src_system, src_component):
+    """index of a (system id, component id) in per-source arrays"""
+    return (src_system << 8) | src_component
+
+
+
+def source_tuple(index):
+    """(system id, component id) for a per-source array index"""
+    return (index >> 8, index & 0xff)
+
+
+
+def source_counters(typecode="L"):
+    """zeroed per-source counter array"""
+    return array.array(typecode, [0]) * NUM_SOURCES
+
+
+
+def tlog_packets(file_name):
+    """read a tlog, returning a list of (timestamp_us, packet) tuples
+
+    Each packet is a bytearray, as it would be in a receive buffer. Reading
+    stops at the first record that does not look like MAVLink.
+    """
+    f = open(file_name, "rb")
+    data = f.read()
+    f.close()
+    packets = []
+    index = 0
+    while index + TLOG_TIMESTAMP.size + 2 <= len(data):
+        (timestamp_us, ) = TLOG_TIMESTAMP.unpack_from(data, index)
+        index += TLOG_TIMESTAMP.size
+        magic = ord(data[index])
+        length = ord(data[index + 1])
+        if magic == V1_MAGIC:
+            pkt_len = length + V1_OVERHEAD
+        elif magic == V2_MAGIC:
+            pkt_len = length + V2_OVERHEAD
+            if index + 2 < len(data) and \
+               (ord(data[index + 2]) & V2_INCOMPAT_SIGNED):
+                pkt_len += V2_SIGNATURE_LEN
+        else:
+            break
+        if index + pkt_len > len(data):
+            break
+        packets.append((timestamp_us, bytearray(data[index:index + pkt_len])))
+        index += pkt_len
+    return packets
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+# Python interface into the linux batched datagram functions
+# recvmmsg(), sendmmsg()
+#
+# Motivation is to let forwarding loops (telem_ctrl) move many datagrams per
+# system call instead of one recvfrom() or sendto() per packet. If the C
+# library does not have the functions, the same interface is provided using
+# one non-blocking recvfrom_into() or sendto() per packet.
+#
+# Only AF_INET datagram sockets are supported.
+
+import ctypes
+import errno
+import os
+import socket
+import struct
+
+# recvmmsg/sendmmsg flags
+MSG_DONTWAIT = 0x40
+
+# sin_addr is kept in network byte order, so it is packed in native order
+_in_addr = struct.Struct("=I")
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t)
+    ]
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),      # network byte order
+        ("sin_addr", ctypes.c_uint32),      # network byte order
+        ("sin_zero", ctypes.c_char * 8)
+    ]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int)
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint)
+    ]
+
+try:
+    libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    recvmmsg = libc.recvmmsg
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                         ctypes.c_int, ctypes.c_void_p]
+    sendmmsg = libc.sendmmsg
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                         ctypes.c_int]
+    have_mmsg = True
+except (OSError, AttributeError):
+    # old C library; fall back to one call per packet
+    have_mmsg = False
+
+
+
+def _buffer_address(buf):
+    """address of the data in a bytearray or string
+
+    The caller must keep 'buf' alive while the address is in use.
+    """
+    if isinstance(buf, bytearray):
+        return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+    return ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value
+
+
+
+class RecvBatch(object):
+    """receive all ready datagrams from a socket in one call
+
+    Datagrams are received into a pool of preallocated bytearrays. After
+    recv() returns n, datagram i (0 <= i < n) is bufs[i][:lens[i]], and came
+    from addrs[i] (an ("ip", port) tuple). The data is only valid until the
+    next call to recv().
+
+    If 'batch' is False, recv() receives exactly one datagram, the same way
+    sock.recvfrom() would; this lets the caller use one code path for both
+    modes.
+
+    'syscalls' counts the calls made into the kernel, including the ones that
+    found nothing to receive.
+    """
+
+    def __init__(self, sock, count=32, size=4096, batch=True):
+        self.sock = sock
+        self.batch = batch
+        if not batch:
+            count = 1
+        self.count = count
+        self.bufs = [bytearray(size) for i in range(count)]
+        self.lens = [0] * count
+        self.addrs = [None] * count
+        self.syscalls = 0
+        self.use_mmsg = batch and have_mmsg
+        if self.use_mmsg:
+            self._names = (sockaddr_in * count)()
+            self._iovs = (iovec * count)()
+            self._msgs = (mmsghdr * count)()
+            for i in range(count):
+                self._iovs[i].iov_base = _buffer_address(self.bufs[i])
+                self._iovs[i].iov_len = size
+                hdr = self._msgs[i].msg_hdr
+                hdr.msg_name = ctypes.addressof(self._names[i])
+                hdr.msg_iov = ctypes.pointer(self._iovs[i])
+                hdr.msg_iovlen = 1
+        self._fd = sock.fileno()
+
+    def recv(self):
+        """receive ready datagrams, returning how many were received"""
+        if self.use_mmsg:
+            return self._recv_mmsg()
+        if not self.batch:
+            self.syscalls += 1
+            self.lens[0], self.addrs[0] = self.sock.recvfrom_into(self.bufs[0])
+            return 1
+        n = 0
+        while n < self.count:
+            self.syscalls += 1
+            try:
+                self.lens[n], self.addrs[n] = \
+                    self.sock.recvfrom_into(self.bufs[n], 0, MSG_DONTWAIT)
+            except socket.error as se:
+                if se.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            n += 1
+        return n
+
+    def _recv_mmsg(self):
+        msgs = self._msgs
+        for i in range(self.count):
+            msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+        self.syscalls += 1
+        n = recvmmsg(self._fd, ctypes.addressof(msgs), self.count,
+                     MSG_DONTWAIT, None)
+        if n < 0:
+            errno_ = ctypes.get_errno()
+            if errno_ in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise socket.error(errno_, os.strerror(errno_))
+        for i in range(n):
+            name = self._names[i]
+            self.lens[i] = msgs[i].msg_len
+            self.addrs[i] = (socket.inet_ntoa(_in_addr.pack(name.sin_addr)),
+                             socket.ntohs(name.sin_port))
+        return n
+
+
+
+class SendBatch(object):
+    """queue datagrams and send them all in one call
+
+    add() queues 'length' bytes of 'buf' (bytearray or string) for 'addr'.
+    The same buffer may be queued for several destinations without being
+    copied. The buffers must not change until flush() is called.
+
+    If 'batch' is False, add() sends immediately, the same way sock.sendto()
+    would.
+
+    A datagram that the kernel refuses (e.g. no route to a station that just
+    left) is counted in 'errors' and skipped; the rest are still sent.
+    """
+
+    def __init__(self, sock, count=64, batch=True):
+        self.sock = sock
+        self.batch = batch
+        self.count = count
+        self.syscalls = 0
+        self.errors = 0
+        self.use_mmsg = batch and have_mmsg
+        self._pending = []
+        if self.use_mmsg:
+            self._iovs = (iovec * count)()
+            self._msgs = (mmsghdr * count)()
+            for i in range(count):
+                hdr = self._msgs[i].msg_hdr
+                hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+                hdr.msg_iov = ctypes.pointer(self._iovs[i])
+                hdr.msg_iovlen = 1
+            # destinations change rarely; keep their sockaddrs around
+            self._names = { }
+        self._fd = sock.fileno()
+
+    def _name(self, addr):
+        name = self._names.get(addr)
+        if name is None:
+            name = sockaddr_in()
+            name.sin_family = socket.AF_INET
+            name.sin_port = socket.htons(addr[1])
+            name.sin_addr = _in_addr.unpack(socket.inet_aton(addr[0]))[0]
+            self._names[addr] = name
+        return name
+
+    def add(self, buf, length, addr):
+        if not self.batch:
+            self._sendto(buf, length, addr)
+            return
+        self._pending.append((buf, length, addr))
+        if len(self._pending) >= self.count:
+            self.flush()
+
+    def _sendto(self, buf, length, addr):
+        self.syscalls += 1
+        try:
+            self.sock.sendto(memoryview(buf)[:length], addr)
+        except socket.error:
+            self.errors += 1
+
+    def flush(self):
+        """send everything queued by add()"""
+        pending = self._pending
+        if not pending:
+            return
+        self._pending = []
+        if not self.use_mmsg:
+            for buf, length, addr in pending:
+                self._sendto(buf, length, addr)
+            return
+        msgs = self._msgs
+        iovs = self._iovs
+        for i in range(len(pending)):
+            buf, length, addr = pending[i]
+            iovs[i].iov_base = _buffer_address(buf)
+            iovs[i].iov_len = length
+            msgs[i].msg_hdr.msg_name = ctypes.addressof(self._name(addr))
+        start = 0
+        total = len(pending)
+        while start < total:
+            self.syscalls += 1
+            n = sendmmsg(self._fd,
+                         ctypes.addressof(msgs) + start * ctypes.sizeof(mmsghdr),
+                         total - start, 0)
+            if n <= 0:
+                # the first datagram failed; skip it and send the rest
+                self.errors += 1
+                n = 1
+            start += n
+        # keep buffers referenced until the kernel has copied them
+        del pending
+
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+# Shared-memory packet ring, for passing telemetry to local consumers
+# without a system call or a trip through the UDP stack per packet.
+#
+# The ring is a file (normally in /run, which is tmpfs) that the writer and
+# all readers mmap. There is one writer (telem_ctrl) and any number of
+# readers; each reader keeps its own cursor, so readers don't affect the
+# writer or each other. The writer never waits: a reader that falls more than
+# a ring's worth behind loses the oldest packets, and counts them.
+#
+# Layout (little-endian):
+#
+#   header (HEADER_SIZE bytes)
+#     magic, version, data_size, generation, reserve, commit
+#   data (data_size bytes)
+#     records: 2-byte length, then the packet
+#
+# Positions ('reserve', 'commit', and reader cursors) count bytes written
+# since the ring was created, and never wrap; the data offset of a position
+# is position % data_size. A record never wraps around the end of the data
+# area; if it does not fit, a PAD length is written (if there is room for
+# it) and the record starts at offset 0.
+#
+# The writer sets 'reserve' to the end of a record before writing it, and
+# sets 'commit' once records are complete. A reader copies records up to
+# 'commit', then re-reads 'reserve'; a record more than data_size behind
+# 'reserve' may have been overwritten while it was being copied, and is
+# discarded (like a seqlock read that has to retry).
+#
+# When the writer re-creates the ring (e.g. telem_ctrl restarted), it sets
+# 'generation' in the old file to STALE before replacing it, so readers
+# still mapping the old file know to open the new one.
+#
+# Positions are 64-bit, which is not one atomic store on 32-bit ARM, so
+# readers read them until two reads agree.
+
+import ctypes
+import mmap
+import os
+import random
+import struct
+
+MAGIC = 0x474e4952 # "RING"
+VERSION = 1
+
+HEADER = struct.Struct("<IIIIQQ")
+HEADER_SIZE = 64 # HEADER, padded
+_OFFSET_GENERATION = 12
+_OFFSET_RESERVE = 16
+_OFFSET_COMMIT = 24
+
+_position = struct.Struct("<Q")
+_generation = struct.Struct("<I")
+STALE = 0
+
+RECORD = struct.Struct("<H")
+PAD = 0xffff
+
+
+
+def _address(buf):
+    """address of the data in a bytearray, string, or writable mmap"""
+    if isinstance(buf, str):
+        return ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value
+    return ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+
+
+
+class RingWriter(object):
+    """the writing end of a ring
+
+    add() copies a packet into the ring; flush() makes everything added
+    visible to readers. Like mmsg.SendBatch, so telem_ctrl can add packets
+    as it forwards them and flush once per wakeup.
+    """
+
+    def __init__(self, file_name, data_size=65536):
+        self.file_name = file_name
+        self.data_size = data_size
+        self.packets = 0
+        self._mark_stale()
+        # create a new file, so readers that still have the old one mapped
+        # are not confused by it changing size
+        tmp_name = "%s.%d" % (file_name, os.getpid())
+        f = open(tmp_name, "w+b")
+        f.truncate(HEADER_SIZE + data_size)
+        self._mm = mmap.mmap(f.fileno(), HEADER_SIZE + data_size)
+        f.close()
+        self._base = _address(self._mm)
+        self._position = 0
+        HEADER.pack_into(self._mm, 0, MAGIC, VERSION, data_size,
+                         random.getrandbits(32) | 1, 0, 0)
+        os.rename(tmp_name, file_name)
+
+    def _mark_stale(self):
+        """tell readers of an existing ring file that it is being replaced"""
+        try:
+            f = open(self.file_name, "r+b")
+        except IOError:
+            return # not there
+        try:
+            if os.fstat(f.fileno()).st_size >= HEADER_SIZE:
+                mm = mmap.mmap(f.fileno(), HEADER_SIZE)
+                _generation.pack_into(mm, _OFFSET_GENERATION, STALE)
+                mm.close()
+        finally:
+            f.close()
+
+    def add(self, buf, length):
+        """copy 'length' bytes of 'buf' (bytearray or string) into the ring"""
+        if length >= PAD or (RECORD.size + length) > self.data_size:
+            raise ValueError("packet too large for ring")
+        mm = self._mm
+        position = self._position
+        offset = position % self.data_size
+        end = position + RECORD.size + length
+        pad = 0
+        if (self.data_size - offset) < (RECORD.size + length):
+            # doesn't fit before the end; start over at the beginning
+            pad = self.data_size - offset
+            end += pad
+        _position.pack_into(mm, _OFFSET_RESERVE, end)
+        if pad > 0:
+            if pad >= RECORD.size:
+                RECORD.pack_into(mm, HEADER_SIZE + offset, PAD)
+            offset = 0
+        RECORD.pack_into(mm, HEADER_SIZE + offset, length)
+        ctypes.memmove(self._base + HEADER_SIZE + offset + RECORD.size,
+                       _address(buf), length)
+        self._position = end
+        self.packets += 1
+
+    def flush(self):
+        """make the packets added so far visible to readers"""
+        _position.pack_into(self._mm, _OFFSET_COMMIT, self._position)
+
+    def close(self):
+        self._mm.close()
+
+
+
+class RingReader(object):
+    """one reader's view of a ring
+
+    read() returns the packets (strings) written since the last read().
+    'overruns' counts the times the reader fell so far behind that unread
+    packets were overwritten (how many is not known); 'lost' counts packets
+    discarded because they might have been overwritten while being read.
+
+    A new reader starts with whatever is written after it is created. If the
+    ring file does not exist yet, or the writer re-creates it, read() opens
+    it again and starts over.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.overruns = 0
+        self.lost = 0
+        self._mm = None
+        self._open()
+
+    def _open(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        try:
+            f = open(self.file_name, "rb")
+        except IOError:
+            return False
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER_SIZE:
+                return False
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, data_size, generation, reserve, commit = \
+            HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION or generation == STALE or \
+           size < (HEADER_SIZE + data_size):
+            mm.close()
+            return False
+        self._mm = mm
+        self.data_size = data_size
+        self._generation = generation
+        self._cursor = self._read_position(_OFFSET_COMMIT)
+        return True
+
+    def _read_position(self, offset):
+        position = _position.unpack_from(self._mm, offset)[0]
+        while True:
+            again = _position.unpack_from(self._mm, offset)[0]
+            if again == position:
+                return position
+            position = again
+
+    def read(self):
+        """packets written since the last read"""
+        if self._mm is None and not self._open():
+            return []
+        mm = self._mm
+        if _generation.unpack_from(mm, _OFFSET_GENERATION)[0] != \
+           self._generation:
+            # writer started over
+            self._open()
+            return []
+        data_size = self.data_size
+        commit = self._read_position(_OFFSET_COMMIT)
+        cursor = self._cursor
+        if (self._read_position(_OFFSET_RESERVE) - cursor) > data_size:
+            # fell behind; skip to the newest
+            self.overruns += 1
+            cursor = commit
+        records = []
+        while cursor < commit:
+            offset = cursor % data_size
+            if (data_size - offset) < RECORD.size:
+                cursor += data_size - offset
+                continue
+            length = RECORD.unpack_from(mm, HEADER_SIZE + offset)[0]
+            if length == PAD:
+                cursor += data_size - offset
+                continue
+            if (cursor + RECORD.size + length) > commit:
+                # length was overwritten under us
+                cursor = -1
+                break
+            start = HEADER_SIZE + offset + RECORD.size
+            records.append((cursor, mm[start:start + length]))
+            cursor += RECORD.size + length
+        # anything the writer may have overwritten while we copied it is
+        # not trustworthy
+        oldest = self._read_position(_OFFSET_RESERVE) - data_size
+        if cursor < 0 or (records and records[0][0] < oldest):
+            valid = [pkt for (position, pkt) in records if position >= oldest]
+            self.lost += len(records) - len(valid)
+            self._cursor = commit
+            return valid
+        self._cursor = cursor
+        return [pkt for (position, pkt) in records]
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+
+if __name__ == "__main__":
+    # write and read a ring, including wrapping and a reader falling behind
+    import tempfile
+    file_name = os.path.join(tempfile.mkdtemp(), "ring")
+    writer = RingWriter(file_name, 1024)
+    reader = RingReader(file_name)
+    sent = []
+    got = []
+    for i in range(1000):
+        pkt = bytearray(os.urandom(random.randint(1, 100)))
+        writer.add(pkt, len(pkt))
+        sent.append(str(pkt))
+        if (i % 5) == 4:
+            writer.flush()
+            got.extend(reader.read())
+    writer.flush()
+    got.extend(reader.read())
+    assert got == sent, "ring lost or changed packets"
+    # more than the ring holds without reading
+    for i in range(100):
+        writer.add(bytearray(50), 50)
+    writer.flush()
+    got = reader.read()
+    assert got == [] and reader.overruns == 1
+    # the writer starts over
+    writer.close()
+    writer = RingWriter(file_name, 2048)
+    writer.add("abc", 3)
+    writer.flush()
+    reader.read() # reopens
+    writer.add("def", 3)
+    writer.flush()
+    assert reader.read() == ["def"]
+    writer.close()
+    reader.close()
+    os.unlink(file_name)
+    os.rmdir(os.path.dirname(file_name))
+    print "ok"
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+# Benchmark for the telemetry forwarder (telem_ctrl.py).
+#
+# Runs telem_ctrl against a fake hostapd control socket and a fake ARP table
+# listing num_gcs stations at 127.0.0.2, 127.0.0.3, ..., each with a GCS
+# receiver socket. Downlink telemetry (a tlog, or a synthetic stream) is sent
+# to telem_ctrl's solo-side port at increasing rates until it can't keep up.
+# Each rate step reports:
+#
+#   rate    packets/sec offered
+#   recv    fraction received, worst GCS
+#   p50/p90/p99/max
+#           forward latency (usec) of packets received by the first GCS
+#   cpu     telem_ctrl CPU use (percent of one core)
+#
+# The result is the highest rate at which every GCS got at least --min-recv
+# of the packets. With --min-rate, exits with status 1 if that is lower, so
+# it can be used to check that a change did not make the forwarder slower.
+#
+# The load generator runs on the same machine, so results are only
+# comparable between runs on the same machine.
+#
+#   telem_bench.py [--tlog file.tlog] [--gcs 2] [--rate 500] [--duration 5]
+
+import os
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import mavframe
+import telem_metrics
+from optparse import OptionParser
+
+# messages per second in the synthetic stream, roughly what solo sends:
+# (message id, payload length, rate)
+SYNTHETIC_MIX = [
+    (0, 9, 1),          # HEARTBEAT
+    (1, 31, 2),         # SYS_STATUS
+    (2, 12, 1),         # SYSTEM_TIME
+    (24, 30, 5),        # GPS_RAW_INT
+    (30, 28, 25),       # ATTITUDE
+    (33, 28, 10),       # GLOBAL_POSITION_INT
+    (42, 2, 2),         # MISSION_CURRENT
+    (62, 26, 5),        # NAV_CONTROLLER_OUTPUT
+    (65, 42, 5),        # RC_CHANNELS
+    (74, 20, 10),       # VFR_HUD
+    (163, 28, 10),      # AHRS
+]
+
+# the fake stations
+STATION_MAC = "02:00:00:00:00:%02x"
+STATION_IP = "127.0.0.%d"
+
+# solo is at this address; the load generator sends from it
+SOLO_IP = "127.0.0.254"
+
+# the part of sololink.conf that telem_ctrl needs
+CONF = """\
+[solo]
+mavDestPort=%(stm32_port)d
+telemDestPort=%(solo_port)d
+useGpsTime=False
+telemBatchIo=%(batch_io)s
+telemCrcCheck=%(crc_check)s
+telemMetricsSock=%(metrics_sock)s
+
+[loggers]
+keys=root,tlm
+
+[handlers]
+keys=fileHandler
+
+[formatters]
+keys=simpleFormatter
+
+[logger_root]
+level=INFO
+handlers=fileHandler
+
+[logger_tlm]
+level=INFO
+handlers=fileHandler
+qualname=tlm
+propagate=0
+
+[handler_fileHandler]
+class=FileHandler
+level=DEBUG
+formatter=simpleFormatter
+args=("%(log_file)s", )
+
+[formatter_simpleFormatter]
+format=%%(asctime)s %%(name)-4s %%(levelname)-8s %%(message)s
+datefmt=
+"""
+
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+
+def synthetic_packets(mix, crc_extras):
+    """v1 packets from solo's autopilot (1, 1)
+
+    'mix' is a list of (message id, payload length, rate) tuples. Messages
+    are spread evenly over each second. Payloads are zero. Enough seconds
+    are generated that the sequence numbers carry on correctly when the
+    list is sent over and over.
+    """
+    timed = []
+    for msg_id, length, rate in mix:
+        for i in range(rate):
+            timed.append((float(i) / rate, msg_id, length))
+    timed.sort()
+    seconds = 1
+    while (len(timed) * seconds) % 256 != 0:
+        seconds += 1
+    packets = []
+    sequence = 0
+    for t, msg_id, length in timed * seconds:
+        pkt = bytearray(mavframe.V1_HEADER.pack(mavframe.V1_MAGIC, length,
+                                                sequence, 1, 1, msg_id))
+        pkt.extend("\0" * length)
+        crc = mavframe.crc_x25(pkt[1:])
+        crc = mavframe.crc_x25((crc_extras.get(msg_id, 0), ), crc)
+        pkt.append(crc & 0xff)
+        pkt.append(crc >> 8)
+        packets.append(pkt)
+        sequence = (sequence + 1) & 0xff
+    return packets
+
+
+
+def tlog_downlink(file_name):
+    """the downlink packets from a tlog
+
+    A tlog has both directions; downlink is everything not from a GCS
+    (system id 255).
+    """
+    checker = mavframe.FrameChecker()
+    packets = []
+    for timestamp_us, pkt in mavframe.tlog_packets(file_name):
+        result, sequence, src_sys, src_comp, msg_id, payload_offset, \
+            payload_len = checker.check(pkt, len(pkt))
+        if result == mavframe.FRAME_OK and src_sys != 255:
+            packets.append(pkt)
+    return packets
+
+
+
+class FakeHostapd(object):
+    """enough of the hostapd control interface for StationTracker"""
+
+    def __init__(self, sock_name, macs):
+        self.macs = macs
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(sock_name)
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _answer(self, cmd):
+        if cmd == "ATTACH":
+            return "OK\n"
+        if cmd == "PING":
+            return "PONG\n"
+        if cmd == "STA-FIRST":
+            return self.macs[0] + "\n" if self.macs else "FAIL\n"
+        if cmd.startswith("STA-NEXT "):
+            mac = cmd.split()[1]
+            if mac in self.macs and self.macs.index(mac) + 1 < len(self.macs):
+                return self.macs[self.macs.index(mac) + 1] + "\n"
+        return "FAIL\n"
+
+    def _run(self):
+        while self.running:
+            ready = select.select([self.sock], [], [], 0.2)
+            if not ready[0]:
+                continue
+            cmd, sender = self.sock.recvfrom(4096)
+            try:
+                self.sock.sendto(self._answer(cmd.strip()), sender)
+            except socket.error:
+                pass
+
+
+
+class Receivers(object):
+    """the GCSes
+
+    Every packet is counted; the first GCS also records when each packet
+    arrived, for latency.
+    """
+
+    def __init__(self, socks):
+        self.socks = socks
+        self.counts = [0] * len(socks)
+        self.arrivals = []
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reset(self):
+        self.counts = [0] * len(self.socks)
+        self.arrivals = []
+
+    def _run(self):
+        first = self.socks[0]
+        while self.running:
+            ready = select.select(self.socks, [], [], 0.2)
+            now = time.time()
+            for sock in ready[0]:
+                pkt = sock.recv(4096)
+                self.counts[self.socks.index(sock)] += 1
+                if sock is first:
+                    self.arrivals.append((now, pkt))
+
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+
+def cpu_seconds(pid):
+    """user + system CPU time used by a process"""
+    f = open("/proc/%d/stat" % (pid, ))
+    # the command name can have spaces; fields after it are fixed
+    fields = f.read().rsplit(")", 1)[1].split()
+    f.close()
+    return (int(fields[11]) + int(fields[12])) / \
+           float(os.sysconf(os.sysconf_names["SC_CLK_TCK"]))
+
+
+
+def run_step(packets, rate, duration, solo_sock, solo_addr, receivers, pid):
+    """offer 'rate' packets/sec for 'duration' seconds
+
+    Returns (received fraction of the worst GCS, latencies in usec, cpu %).
+    """
+    receivers.reset()
+    sent = []
+    cpu_start = cpu_seconds(pid)
+    start = time.time()
+    num_sent = 0
+    while True:
+        now = time.time()
+        if now - start >= duration:
+            break
+        # catch up to where we should be
+        due = int((now - start) * rate)
+        while num_sent < due:
+            pkt = packets[num_sent % len(packets)]
+            solo_sock.sendto(pkt, solo_addr)
+            sent.append((time.time(), pkt))
+            num_sent += 1
+        time.sleep(0.0005)
+    elapsed = time.time() - start
+    # let the last packets arrive
+    time.sleep(0.5)
+    cpu = 100.0 * (cpu_seconds(pid) - cpu_start) / elapsed
+    received = min(receivers.counts) / float(max(num_sent, 1))
+    # Match the first GCS's packets to the ones sent, in order; lost packets
+    # are skipped.
+    latencies = []
+    index = 0
+    for arrival, pkt in receivers.arrivals:
+        search = index
+        while search < len(sent) and sent[search][1] != pkt:
+            search += 1
+        if search == len(sent):
+            continue
+        latencies.append(int((arrival - sent[search][0]) * 1000000))
+        index = search + 1
+    latencies.sort()
+    return received, latencies, cpu
+
+
+
+def main():
+    parser = OptionParser('telem_bench.py [options]')
+    parser.add_option('--tlog', dest='tlog', type='string', default=None,
+                      help='replay downlink from tlog (default synthetic)')
+    parser.add_option('--gcs', dest='num_gcs', type='int', default=2,
+                      help='number of GCSes')
+    parser.add_option('--rate', dest='rate', type='int', default=250,
+                      help='starting rate, packets/sec')
+    parser.add_option('--max-rate', dest='max_rate', type='int', default=64000,
+                      help='stop at this rate, packets/sec')
+    parser.add_option('--duration', dest='duration', type='float', default=5.0,
+                      help='seconds at each rate')
+    parser.add_option('--min-recv', dest='min_recv', type='float', default=0.99,
+                      help='fraction each GCS must receive to keep up')
+    parser.add_option('--min-rate', dest='min_rate', type='int', default=None,
+                      help='fail if the forwarder can\'t keep up with this rate')
+    parser.add_option('--no-batch', dest='batch_io', action='store_false',
+                      default=True, help='run telem_ctrl without batch I/O')
+    parser.add_option('--crc', dest='crc_check', action='store_true',
+                      default=False, help='run telem_ctrl with checksum checks')
+    parser.add_option('--telem-ctrl', dest='telem_ctrl', type='string',
+                      default=os.path.join(os.path.dirname(
+                          os.path.abspath(__file__)), "telem_ctrl.py"),
+                      help='telem_ctrl.py to run')
+    (opts, args) = parser.parse_args()
+
+    try:
+        from pymavlink import mavutil
+        crc_extras = mavframe.crc_extra_table(mavutil.mavlink)
+    except ImportError:
+        crc_extras = { }
+
+    if opts.tlog is not None:
+        packets = tlog_downlink(opts.tlog)
+        if not packets:
+            print "no downlink packets in %s" % (opts.tlog, )
+            sys.exit(1)
+    else:
+        packets = synthetic_packets(SYNTHETIC_MIX, crc_extras)
+
+    tmp_dir = tempfile.mkdtemp(prefix="telem_bench-")
+    telem_ctrl = None
+    try:
+        solo_port = free_port()
+        gcs_port = free_port()
+        stm32_port = free_port()
+
+        # telem_ctrl sends to stm32 and tlog on the local machine; have
+        # something there so packets are just dropped when nobody reads them
+        local_socks = []
+        for port in (stm32_port, 14583):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.bind(("127.0.0.1", port))
+                local_socks.append(s)
+            except socket.error:
+                s.close() # already in use, e.g. by a real tlog
+
+        macs = []
+        gcs_socks = []
+        arp = open(os.path.join(tmp_dir, "arp"), "w")
+        arp.write("IP address       HW type     Flags       HW address"
+                  "            Mask     Device\n")
+        for i in range(opts.num_gcs):
+            mac = STATION_MAC % (i + 2, )
+            ip = STATION_IP % (i + 2, )
+            macs.append(mac)
+            arp.write("%-16s 0x1         0x2         %s     *        lo\n" %
+                      (ip, mac))
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            s.bind((ip, gcs_port))
+            gcs_socks.append(s)
+        arp.close()
+
+        hostapd_sock = os.path.join(tmp_dir, "hostapd")
+        hostapd = FakeHostapd(hostapd_sock, macs)
+        receivers = Receivers(gcs_socks)
+
+        solo_ip_file = os.path.join(tmp_dir, "solo.ip")
+        f = open(solo_ip_file, "w")
+        f.write(SOLO_IP + "\n")
+        f.close()
+
+        metrics_sock = os.path.join(tmp_dir, "metrics")
+        log_file = os.path.join(tmp_dir, "telem_ctrl.log")
+        conf_file = os.path.join(tmp_dir, "sololink.conf")
+        f = open(conf_file, "w")
+        f.write(CONF % { "stm32_port": stm32_port,
+                         "solo_port": solo_port,
+                         "batch_io": opts.batch_io,
+                         "crc_check": opts.crc_check,
+                         "metrics_sock": metrics_sock,
+                         "log_file": log_file })
+        f.close()
+
+        telem_ctrl = subprocess.Popen([sys.executable, opts.telem_ctrl,
+                                       "--conf", conf_file,
+                                       "--solo-ip-file", solo_ip_file,
+                                       "--hostapd", hostapd_sock,
+                                       "--arp", os.path.join(tmp_dir, "arp"),
+                                       "--gcs-port", str(gcs_port)])
+
+        # wait for telem_ctrl to find all the stations
+        deadline = time.time() + 10.0
+        while True:
+            if telem_ctrl.poll() is not None:
+                print "telem_ctrl exited; see %s" % (log_file, )
+                sys.exit(1)
+            metrics = telem_metrics.query(metrics_sock, 0.2)
+            if metrics is not None and \
+               len(metrics["destinations"]) >= opts.num_gcs:
+                break
+            if time.time() > deadline:
+                print "telem_ctrl did not find the stations"
+                sys.exit(1)
+            time.sleep(0.2)
+
+        solo_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        solo_sock.bind((SOLO_IP, 0))
+        solo_addr = ("127.0.0.1", solo_port)
+
+        print "%d packets/cycle, %d GCSes, batch I/O %s, checksums %s" % \
+            (len(packets), opts.num_gcs, opts.batch_io, opts.crc_check)
+        print "%8s %6s %6s %6s %6s %6s %6s" % \
+            ("rate", "recv", "p50", "p90", "p99", "max", "cpu")
+        best = 0
+        rate = opts.rate
+        while rate <= opts.max_rate:
+            received, latencies, cpu = run_step(packets, rate, opts.duration,
+                                                solo_sock, solo_addr,
+                                                receivers, telem_ctrl.pid)
+            if latencies:
+                print "%8d %6.3f %6d %6d %6d %6d %5.1f%%" % \
+                    (rate, received, percentile(latencies, 0.50),
+                     percentile(latencies, 0.90), percentile(latencies, 0.99),
+                     latencies[-1], cpu)
+            else:
+                print "%8d %6.3f %6s %6s %6s %6s %5.1f%%" % \
+                    (rate, received, "-", "-", "-", "-", cpu)
+            if received < opts.min_recv:
+                break
+            best = rate
+            rate *= 2
+        print "max rate: %d packets/sec" % (best, )
+
+        metrics = telem_metrics.query(metrics_sock)
+        if metrics is not None:
+            for name in ("fanout_latency", "wakeup_latency"):
+                m = metrics[name]
+                if m["count"] > 0:
+                    print "%s: mean %d usec, max %d usec (%d samples)" % \
+                        (name, m["total_us"] / m["count"], m["max_us"],
+                         m["count"])
+
+        receivers.running = False
+        hostapd.running = False
+        if opts.min_rate is not None and best < opts.min_rate:
+            print "FAIL: below --min-rate %d" % (opts.min_rate, )
+            sys.exit(1)
+    finally:
+        if telem_ctrl is not None and telem_ctrl.poll() is None:
+            telem_ctrl.terminate()
+            telem_ctrl.wait()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+
+if __name__ == "__main__":
+    main()
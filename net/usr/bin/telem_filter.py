@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Per-station telemetry forwarding profiles.
+#
+# A profile says, for each MAVLink message id, whether a station gets that
+# message, and if so, at most how often. Profiles are read from sololink.conf:
+#
+#   [telem_profiles]
+#   # profile=stations, where stations are MACs, "primary" (the first station
+#   # to connect), or "secondary" (the others). A MAC takes precedence over
+#   # primary/secondary. Stations with no profile get everything.
+#   viewer=secondary
+#   everything=00:11:22:33:44:55
+#
+#   [telem_profile_viewer]
+#   # comma-separated message names (or ids); use allow or deny, not both
+#   deny=PARAM_VALUE,LOG_DATA
+#   # maximum rates, NAME:Hz
+#   rates=ATTITUDE:10,GLOBAL_POSITION_INT:5
+#
+# Each profile is compiled to a lookup table, so the per-packet decision is
+# one index and a compare.
+
+import array
+import ConfigParser
+
+# table entries: FORWARD, DROP, or the minimum interval in microseconds
+FORWARD = 0
+DROP = -1
+
+# message ids below this are looked up in a list; others in a dictionary
+# (MAVLink 2 ids are 24 bits)
+TABLE_SIZE = 256
+
+PROFILES_SECTION = "telem_profiles"
+PROFILE_SECTION_PREFIX = "telem_profile_"
+
+
+
+def _msg_id(name, mavlink):
+    """message id from a name (e.g. ATTITUDE) or number"""
+    name = name.strip()
+    if name.isdigit():
+        return int(name)
+    return getattr(mavlink, "MAVLINK_MSG_ID_" + name.upper())
+
+
+
+def msg_list(value, mavlink):
+    """list of message ids from comma-separated names (or ids)"""
+    return [_msg_id(name, mavlink) for name in value.split(",") if name.strip()]
+
+
+
+class Profile(object):
+    """forwarding decisions for every message id
+
+    'allow' and 'deny' are lists of message ids; if 'allow' is given, only
+    those messages are forwarded. 'rates' is a dictionary of maximum rates
+    (Hz), indexed by message id.
+    """
+
+    def __init__(self, name, allow=None, deny=None, rates=None):
+        self.name = name
+        if allow:
+            default = DROP
+        else:
+            default = FORWARD
+        self.table = array.array("l", [default]) * TABLE_SIZE
+        self.table_ext = { }
+        self.default = default
+        if allow:
+            for msg_id in allow:
+                self._set(msg_id, FORWARD)
+        if deny:
+            for msg_id in deny:
+                self._set(msg_id, DROP)
+        if rates:
+            for msg_id, rate_hz in rates.items():
+                if self.action(msg_id) == DROP:
+                    continue
+                if rate_hz <= 0:
+                    self._set(msg_id, DROP)
+                else:
+                    self._set(msg_id, int(1000000 / rate_hz))
+
+    def _set(self, msg_id, action):
+        if msg_id < TABLE_SIZE:
+            self.table[msg_id] = action
+        else:
+            self.table_ext[msg_id] = action
+
+    def action(self, msg_id):
+        if msg_id < TABLE_SIZE:
+            return self.table[msg_id]
+        return self.table_ext.get(msg_id, self.default)
+
+
+
+class StationFilter(object):
+    """one station's use of a profile
+
+    forward() decides whether to send a packet to the station, and counts what
+    was not sent.
+    """
+
+    def __init__(self, profile):
+        self.profile = profile
+        self._table = profile.table
+        # next time each rate-limited message may be sent
+        self._next_us = { }
+        self.packets_saved = 0
+        self.bytes_saved = 0
+
+    def forward(self, msg_id, pkt_len, now_us):
+        if msg_id < TABLE_SIZE:
+            action = self._table[msg_id]
+        else:
+            action = self.profile.action(msg_id)
+        if action == FORWARD:
+            return True
+        if action > 0:
+            # Rate limited. Keep to the interval on average, but don't build
+            # up credit while the message is not arriving.
+            next_us = self._next_us.get(msg_id, 0)
+            if now_us >= next_us:
+                next_us += action
+                if next_us <= now_us:
+                    next_us = now_us + action
+                self._next_us[msg_id] = next_us
+                return True
+        self.packets_saved += 1
+        self.bytes_saved += pkt_len
+        return False
+
+
+
+class ProfileConfig(object):
+    """profiles and station assignments read from the config file"""
+
+    def __init__(self, config, mavlink, logger):
+        self.profiles = { }
+        # profile name indexed by MAC, "primary", or "secondary"
+        self.assignments = { }
+        if not config.has_section(PROFILES_SECTION):
+            return
+        for name, stations in config.items(PROFILES_SECTION):
+            section = PROFILE_SECTION_PREFIX + name
+            try:
+                self.profiles[name] = self._read_profile(config, section,
+                                                         name, mavlink)
+            except (ConfigParser.Error, AttributeError, ValueError) as e:
+                logger.error("error reading [%s]: %s", section, str(e))
+                continue
+            for station in stations.split(","):
+                if station.strip():
+                    self.assignments[station.strip().lower()] = name
+            logger.info("telemetry profile %s for %s", name, stations)
+
+    def _read_profile(self, config, section, name, mavlink):
+        allow = None
+        deny = None
+        rates = { }
+        if config.has_option(section, "allow"):
+            allow = msg_list(config.get(section, "allow"), mavlink)
+        if config.has_option(section, "deny"):
+            deny = msg_list(config.get(section, "deny"), mavlink)
+        if config.has_option(section, "rates"):
+            for item in config.get(section, "rates").split(","):
+                if not item.strip():
+                    continue
+                msg_name, rate_hz = item.split(":")
+                rates[_msg_id(msg_name, mavlink)] = float(rate_hz)
+        return Profile(name, allow, deny, rates)
+
+    def filter_for(self, mac, primary):
+        """StationFilter for a station, or None if it gets everything"""
+        name = self.assignments.get(mac)
+        if name is None:
+            if primary:
+                name = self.assignments.get("primary")
+            else:
+                name = self.assignments.get("secondary")
+        if name is None or name not in self.profiles:
+            return None
+        return StationFilter(self.profiles[name])
+
+
+
+class DedupWindow(object):
+    """drop identical messages from different senders within a time window
+
+    Meant for the uplink, where several GCSes send the same HEARTBEAT or
+    REQUEST_DATA_STREAM and only one of each needs to go over the radio.
+    Only messages with an id in 'msg_ids' are checked. A message is a
+    duplicate if the same source (system and component id), message id and
+    payload came from a different sender (e.g. source IP address) less than
+    window_us ago.
+
+    Recent messages are remembered as hashes in a fixed-size ring, so memory
+    does not grow no matter how many senders there are. A message seen again
+    moves to the newest end of the ring, so one that keeps arriving is not
+    pushed out by others.
+    """
+
+    def __init__(self, window_us, msg_ids, size=64):
+        self.window_us = window_us
+        self._check = array.array("b", [0]) * TABLE_SIZE
+        self._check_ext = set()
+        for msg_id in msg_ids:
+            if msg_id < TABLE_SIZE:
+                self._check[msg_id] = 1
+            else:
+                self._check_ext.add(msg_id)
+        self._size = size
+        self._hashes = [None] * size
+        self._times = [0] * size
+        self._senders = [None] * size
+        # ring slot for each hash in the ring
+        self._slots = { }
+        self._next = 0
+        self.duplicates = 0
+
+    def duplicate(self, src_sys, src_comp, msg_id, buf, payload_offset,
+                  payload_len, sender, now_us):
+        """check one message, returning True if it should be dropped"""
+        if msg_id < TABLE_SIZE:
+            if not self._check[msg_id]:
+                return False
+        elif msg_id not in self._check_ext:
+            return False
+        key = hash((src_sys, src_comp, msg_id,
+                    str(buf[payload_offset:payload_offset + payload_len])))
+        old_slot = self._slots.get(key)
+        if old_slot is not None:
+            dup = self._senders[old_slot] != sender and \
+                  (now_us - self._times[old_slot]) < self.window_us
+            if dup:
+                # the window still runs from the first sender's copy
+                time_us = self._times[old_slot]
+                sender = self._senders[old_slot]
+            else:
+                time_us = now_us
+            # leave a hole where it was
+            self._hashes[old_slot] = None
+        else:
+            dup = False
+            time_us = now_us
+        # take the oldest slot
+        slot = self._next
+        self._next = (slot + 1) % self._size
+        evict_key = self._hashes[slot]
+        if evict_key is not None:
+            del self._slots[evict_key]
+        self._hashes[slot] = key
+        self._slots[key] = slot
+        self._times[slot] = time_us
+        self._senders[slot] = sender
+        if dup:
+            self.duplicates += 1
+        return dup
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Event loop for the telemetry forwarder (telem_ctrl).
+#
+# Python 2 has no asyncio; this is the same idea on select(). Sockets are
+# registered with a handler to call when they are readable, and timers are
+# kept in a heap, so select() sleeps exactly until the next timer is due and
+# nothing has to be checked on every wakeup.
+
+import heapq
+import select
+import clock
+
+
+
+class EventLoop(object):
+    """select() loop with timers
+
+    Handlers and timer callbacks are called with the time of the wakeup
+    (CLOCK_MONOTONIC, usec), so every stage sees the same time for one
+    wakeup. Sockets are checked in the order they were added, so the most
+    latency-sensitive one should be added first.
+    """
+
+    def __init__(self):
+        self._socks = []
+        self._handlers = { }
+        # heap of (time_us, sequence, callback, interval_us); sequence keeps
+        # timers due at the same time in the order they were scheduled
+        self._timers = []
+        self._sequence = 0
+        self.now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+        self.select_calls = 0
+        self.running = False
+
+    def add_reader(self, sock, handler):
+        """call handler(now_us) whenever sock is readable"""
+        self._socks.append(sock)
+        self._handlers[sock] = handler
+
+    def call_at(self, time_us, callback, interval_us=0):
+        """call callback(now_us) at time_us, and every interval_us after that
+        if interval_us is not zero"""
+        self._sequence += 1
+        heapq.heappush(self._timers, (time_us, self._sequence, callback,
+                                      interval_us))
+
+    def call_later(self, delay_us, callback):
+        """call callback(now_us) once, delay_us from now"""
+        self.call_at(self.now_us + delay_us, callback)
+
+    def call_every(self, interval_us, callback):
+        """call callback(now_us) every interval_us, starting interval_us
+        from now"""
+        self.call_at(self.now_us + interval_us, callback, interval_us)
+
+    def stop(self):
+        self.running = False
+
+    def run_once(self):
+        """wait for something to do, and do it"""
+        timers = self._timers
+        if timers:
+            timeout_s = max(0, timers[0][0] - self.now_us) / 1000000.0
+        else:
+            timeout_s = None
+        ready = select.select(self._socks, [], [], timeout_s)
+        self.select_calls += 1
+        self.now_us = now_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+        if ready[0]:
+            for sock in self._socks:
+                if sock in ready[0]:
+                    self._handlers[sock](now_us)
+        while timers and timers[0][0] <= now_us:
+            time_us, sequence, callback, interval_us = heapq.heappop(timers)
+            if interval_us:
+                # keep to the schedule, unless we fell a whole interval behind
+                time_us += interval_us
+                if time_us <= now_us:
+                    time_us = now_us + interval_us
+                self.call_at(time_us, callback, interval_us)
+            callback(now_us)
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# Metrics endpoint for the telemetry forwarder (telem_ctrl).
+#
+# telem_ctrl binds a unix datagram socket; any datagram sent to it is answered
+# with one datagram containing a JSON object of cumulative counters. Counters
+# are never reset, so a poller computes rates from the difference between two
+# queries. The requester's socket must be bound to a name, or there is nowhere
+# to send the answer; query() does that.
+#
+#   telem_metrics.py [socket_name]
+#
+# prints the current metrics.
+
+import array
+import errno
+import fcntl
+import json
+import os
+import socket
+import struct
+import sys
+
+DEFAULT_SOCK_NAME = "/var/run/telem_metrics"
+
+# <linux/sockios.h>: timestamp of the last packet received on a socket
+SIOCGSTAMP = 0x8906
+_timeval = struct.Struct("ll")
+
+# Latency histogram buckets are powers of two in microseconds: bucket 0 is
+# < 1 usec, bucket n is [2**(n-1), 2**n) usec, and the last bucket is
+# everything larger.
+LATENCY_BUCKETS = 24
+
+# larger samples (e.g. the system clock was set) are not counted
+LATENCY_MAX_US = 1000000
+
+
+
+class LatencyHistogram(object):
+    """counts of latency samples in power-of-two buckets"""
+
+    def __init__(self):
+        self.buckets = array.array("d", [0]) * LATENCY_BUCKETS
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def add(self, us):
+        if us < 0 or us > LATENCY_MAX_US:
+            return
+        bucket = int(us).bit_length()
+        if bucket >= LATENCY_BUCKETS:
+            bucket = LATENCY_BUCKETS - 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total_us += us
+        if us > self.max_us:
+            self.max_us = us
+
+    def metrics(self):
+        return { "count": self.count,
+                 "total_us": self.total_us,
+                 "max_us": self.max_us,
+                 "buckets": [int(n) for n in self.buckets] }
+
+
+
+def packet_stamp_us(sock):
+    """kernel receive time of the last packet received on 'sock'
+
+    The time is CLOCK_REALTIME, in microseconds. The first call enables
+    timestamps on the socket and returns None; so does a call before any
+    packet has been received since.
+    """
+    try:
+        stamp = fcntl.ioctl(sock.fileno(), SIOCGSTAMP, "\0" * _timeval.size)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    sec, usec = _timeval.unpack(stamp)
+    return sec * 1000000 + usec
+
+
+
+class MetricsServer(object):
+    """answer metrics requests on a unix datagram socket
+
+    The caller selects on 'sock' and calls handle() when it is readable.
+    'snapshot' is a function returning a dictionary of the current metrics;
+    it is only called when there is a request, so nothing is built between
+    requests.
+    """
+
+    def __init__(self, sock_name, snapshot):
+        self.sock_name = sock_name
+        self.snapshot = snapshot
+        self.requests = 0
+        try:
+            os.unlink(sock_name)
+        except OSError:
+            pass # wasn't there, okay
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(sock_name)
+        self.sock.setblocking(0)
+
+    def handle(self):
+        """answer all pending requests"""
+        while True:
+            try:
+                pkt, requester = self.sock.recvfrom(256)
+            except socket.error:
+                break # nothing more to read
+            if not requester:
+                continue # unnamed socket; can't answer
+            self.requests += 1
+            try:
+                self.sock.sendto(json.dumps(self.snapshot()), requester)
+            except socket.error:
+                pass # requester went away
+
+
+
+def query(sock_name=DEFAULT_SOCK_NAME, timeout_s=1.0):
+    """get the metrics from telem_ctrl, as a dictionary (None on timeout)"""
+    local_name = "/tmp/telem_metrics-%d" % os.getpid()
+    try:
+        os.unlink(local_name)
+    except OSError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(local_name)
+    sock.settimeout(timeout_s)
+    try:
+        sock.sendto("metrics", sock_name)
+        return json.loads(sock.recv(65536))
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+        os.unlink(local_name)
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sock_name = sys.argv[1]
+    else:
+        sock_name = DEFAULT_SOCK_NAME
+    metrics = query(sock_name)
+    if metrics is None:
+        print "no response from %s" % (sock_name, )
+        sys.exit(1)
+    print json.dumps(metrics, indent=4, sort_keys=True)
@@ -0,0 +1,672 @@
+#!/usr/bin/env python
+
+# Stages of the telemetry forwarder (telem_ctrl).
+#
+# Downlink packets go through:
+#
+#   receive     everything ready on the solo-side socket (mmsg.RecvBatch)
+#   validate    framing and checksum (Validate)
+#   fan-out     to the GCSes, stm32, tlog, and ring (FanOut)
+#   consumers   per-source accounting (Account), learning solo's port
+#               (SoloAddress), setting the clock from GPS time (TimeSync)
+#
+# A batch is sent on before any consumer sees it, so consumers don't add to
+# forwarding latency. Consumers get a list of validated packets; each is a
+# tuple
+#
+#   (pkt_buf, pkt_len, src_adrs, src, sequence, msg_id,
+#    payload_offset, payload_len)
+#
+# where src is the source index, (src_system << 8) | src_component. The
+# buffers belong to the receive pool and are only valid during the call.
+#
+# Each stage keeps cumulative counts, returned by metrics() for the metrics
+# endpoint; stages that appear in the periodic log line also have report(),
+# which appends the change since the previous report to a list of strings.
+#
+# Run this file to time each stage on a synthetic stream (or a tlog):
+#
+#   telem_stages.py [file.tlog]
+
+import array
+import datetime
+import struct
+import sys
+import time
+import clock
+import mavframe
+import telem_metrics
+
+# how often the log may get a corrupt packet or sequence error message
+LOG_INTERVAL_US = 1000000
+
+# MAVLink SYSTEM_TIME payload: time_unix_usec, time_boot_ms
+SYSTEM_TIME = struct.Struct("<QI")
+
+
+
+def source_name(src):
+    return "%d,%d" % (src >> 8, src & 0xff)
+
+
+
+class Validate(object):
+    """check framing (and checksums, if frame_checker has CRC_EXTRAs)
+
+    Corrupt packets are counted by reason and logged, at most once per
+    LOG_INTERVAL_US.
+    """
+
+    def __init__(self, logger, frame_checker):
+        self.logger = logger
+        self.check = frame_checker.check
+        self.corrupt = 0
+        self.corrupt_by_result = [0] * mavframe.FRAME_NUM_RESULTS
+        self._report_corrupt = 0
+        self._report_by_result = [0] * mavframe.FRAME_NUM_RESULTS
+        # Time when we can log another corrupt packet, and how many were not
+        # logged since the last one.
+        self._log_us = 0
+        self._log_skipped = 0
+
+    def validate(self, recv, num_pkts, now_us):
+        """list of validated packets (see above) from a RecvBatch"""
+        pkts = []
+        check = self.check
+        for pkt_num in range(num_pkts):
+            pkt_buf = recv.bufs[pkt_num]
+            pkt_len = recv.lens[pkt_num]
+            # check for "corrupt", where "corrupt" means we shouldn't even
+            # look at this packet (header is decoded in place)
+            frame_result, sequence, src_sys, src_comp, msg_id, \
+                payload_offset, payload_len = check(pkt_buf, pkt_len)
+            if frame_result == mavframe.FRAME_OK:
+                pkts.append((pkt_buf, pkt_len, recv.addrs[pkt_num],
+                             (src_sys << 8) | src_comp, sequence, msg_id,
+                             payload_offset, payload_len))
+            else:
+                self._corrupt(frame_result, pkt_buf, pkt_len, now_us)
+        return pkts
+
+    def _corrupt(self, frame_result, pkt_buf, pkt_len, now_us):
+        # Log corrupt packets, but don't flood the log
+        self.corrupt += 1
+        self.corrupt_by_result[frame_result] += 1
+        if now_us >= self._log_us:
+            # loggit!
+            if self._log_skipped > 0:
+                self.logger.info("downlink: (skipped %d corrupt packets)",
+                                 self._log_skipped)
+                self._log_skipped = 0
+            self.logger.info("downlink: corrupt packet (%s): %s",
+                             mavframe.frame_result_names[frame_result],
+                             str(list(pkt_buf[:min(pkt_len, 10)])))
+            self._log_us = now_us + LOG_INTERVAL_US
+        else:
+            # don't log it
+            self._log_skipped += 1
+
+    def report(self, msg):
+        if self.corrupt == self._report_corrupt:
+            return
+        msg.append("(-1,-1):%d" % (self.corrupt - self._report_corrupt, ))
+        self._report_corrupt = self.corrupt
+        # why they were corrupt
+        for result in range(mavframe.FRAME_NUM_RESULTS):
+            count = self.corrupt_by_result[result] - \
+                    self._report_by_result[result]
+            if count > 0:
+                msg.append("%s:%d" % (mavframe.frame_result_names[result],
+                                      count))
+            self._report_by_result[result] = self.corrupt_by_result[result]
+
+    def metrics(self):
+        corrupt_by_reason = { }
+        for result in range(mavframe.FRAME_NUM_RESULTS):
+            if self.corrupt_by_result[result] > 0:
+                corrupt_by_reason[mavframe.frame_result_names[result]] = \
+                    self.corrupt_by_result[result]
+        return { "corrupt": self.corrupt,
+                 "corrupt_by_reason": corrupt_by_reason }
+
+
+
+class Account(object):
+    """per-source packet, byte, and sequence error counts
+
+    Counts are indexed by source. 'sources' lists the sources seen, so
+    reporting does not have to scan the whole array. Byte counts are doubles
+    so they do not overflow.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.packets = mavframe.source_counters()
+        self.drops = mavframe.source_counters()
+        self.bytes = mavframe.source_counters("d")
+        self.sources = []
+        # last sequence number from each source, -1 for sources not seen yet.
+        # Each component has an independently running sequence, so we must
+        # keep track of each.
+        self.last_sequence = array.array("h", [-1]) * mavframe.NUM_SOURCES
+        self._report_packets = { }
+        self._report_drops = { }
+        # Time when we can log another drop, and how many were not logged
+        # since the last one.
+        self._log_us = 0
+        self._log_skipped = 0
+
+    def handle(self, pkts, now_us):
+        packets = self.packets
+        last_sequence = self.last_sequence
+        for pkt_buf, pkt_len, src_adrs, src, sequence, msg_id, \
+                payload_offset, payload_len in pkts:
+            # first message from a component is never a sequence error
+            last = last_sequence[src]
+            if last < 0:
+                last = (sequence - 1) & 0xff
+            # Ignore sequence numbers in gimbal messages (they are not right).
+            if sequence != ((last + 1) & 0xff) and src != ((1 << 8) | 154):
+                self._drop(src, sequence, now_us)
+            last_sequence[src] = sequence
+            # count packets from each source
+            if packets[src] == 0:
+                self.sources.append(src)
+            packets[src] += 1
+            self.bytes[src] += pkt_len
+
+    def _drop(self, src, sequence, now_us):
+        # Log dropped packets, but don't flood the log.
+        self.drops[src] += 1
+        if now_us >= self._log_us:
+            # loggit!
+            self.logger.info("downlink: %d sequence errors: sys=%d comp=%d seq=%d",
+                             1 + self._log_skipped, src >> 8, src & 0xff,
+                             sequence)
+            self._log_skipped = 0
+            self._log_us = now_us + LOG_INTERVAL_US
+        else:
+            # don't log it
+            self._log_skipped += 1
+
+    def report(self, msg):
+        for src in self.sources:
+            count = self.packets[src] - self._report_packets.get(src, 0)
+            if count > 0:
+                msg.append("(%d,%d):%d" % (src >> 8, src & 0xff, count))
+            self._report_packets[src] = self.packets[src]
+
+    def report_drops(self, msg):
+        drops = []
+        for src in self.sources:
+            count = self.drops[src] - self._report_drops.get(src, 0)
+            if count > 0:
+                drops.append("(%d,%d):%d" % (src >> 8, src & 0xff, count))
+            self._report_drops[src] = self.drops[src]
+        if drops:
+            msg.append("-")
+            msg.extend(drops)
+
+    def metrics(self):
+        sources = { }
+        for src in self.sources:
+            sources[source_name(src)] = { "packets": self.packets[src],
+                                          "bytes": long(self.bytes[src]),
+                                          "drops": self.drops[src] }
+        return sources
+
+
+
+class SoloAddress(object):
+    """learn the port on solo to send uplink to
+
+    The port on solo varies; it is saved from the first packet from solo,
+    and updated if it changes. 'port' is None until then.
+    """
+
+    def __init__(self, logger, solo_ip):
+        self.logger = logger
+        self.ip = solo_ip
+        self.port = None
+
+    def handle(self, pkts, now_us):
+        for pkt in pkts:
+            src_adrs = pkt[2]
+            if src_adrs[0] == self.ip and src_adrs[1] != self.port:
+                if self.port is None:
+                    # first time we've see solo
+                    self.logger.info("downlink: solo is at %s:%d",
+                                     self.ip, src_adrs[1])
+                else:
+                    # not first time we've see solo, but it's at a new port
+                    self.logger.info("downlink: solo is now at %s:%d",
+                                     self.ip, src_adrs[1])
+                self.port = src_adrs[1]
+
+
+
+class TimeSync(object):
+    """log GPS time, and set the system clock from it if use_gps_time
+
+    Only the first SYSTEM_TIME with a nonzero time is used; after that,
+    'done' is True and the Downlink stops calling this consumer.
+    """
+
+    def __init__(self, logger, use_gps_time, msg_id_system_time):
+        self.logger = logger
+        self.use_gps_time = use_gps_time
+        self.msg_id = msg_id_system_time
+        self.done = False
+
+    def handle(self, pkts, now_us):
+        for pkt_buf, pkt_len, src_adrs, src, sequence, msg_id, \
+                payload_offset, payload_len in pkts:
+            if msg_id != self.msg_id:
+                continue
+            if payload_len >= SYSTEM_TIME.size:
+                unix_usec, boot_msec = \
+                    SYSTEM_TIME.unpack_from(pkt_buf, payload_offset)
+            else:
+                # v2 does not send trailing zeros in the payload
+                payload = pkt_buf[payload_offset:payload_offset + payload_len]
+                unix_usec, boot_msec = SYSTEM_TIME.unpack(
+                    str(payload).ljust(SYSTEM_TIME.size, "\0"))
+            if unix_usec != 0:
+                self.done = True
+                dt = datetime.datetime.fromtimestamp(unix_usec / 1000000.0)
+                self.logger.info("downlink: GPS time %s", str(dt))
+                if self.use_gps_time:
+                    # set system clock
+                    clock.settime_us(clock.CLOCK_REALTIME, unix_usec)
+                    self.logger.info("downlink: system time set from GPS time")
+                return
+
+
+
+class FanOut(object):
+    """send validated packets to every destination
+
+    Destinations are the stations (with their forwarding profiles), plus
+    'local_dests', a list of ("ip", port) on this machine that get
+    everything, plus the shared-memory ring if there is one. Packets go out
+    through 'send' (a SendBatch on the GCS-side socket, since receivers may
+    use the source of telemetry packets as the uplink destination).
+
+    'fanout' is a list of (("ip", port), filter) for each station
+    destination, where filter is None if the destination gets everything. It
+    is rebuilt when the list of stations changes; filters are kept across
+    rebuilds so their counts and rate limits carry on.
+    """
+
+    def __init__(self, send, stations, profile_config, local_dests=(),
+                 ring=None):
+        self.send = send
+        self.stations = stations
+        self.profile_config = profile_config
+        self.local_dests = list(local_dests)
+        self.ring = ring
+        self.fanout = []
+        self._version = None
+        # indexed by ("ip", port); each entry is (primary, filter)
+        self._dest_filters = { }
+
+    def update(self):
+        """rebuild 'fanout' if the stations changed"""
+        if self.stations.version == self._version:
+            return
+        stations = self.stations
+        fanout = []
+        old_dest_filters = self._dest_filters
+        dest_filters = { }
+        for dest_num in range(len(stations.destinations)):
+            dest = stations.destinations[dest_num]
+            mac = stations.destination_macs[dest_num]
+            primary = (mac == stations.destination_macs[0])
+            if dest in old_dest_filters and old_dest_filters[dest][0] == primary:
+                dest_filter = old_dest_filters[dest][1]
+            else:
+                dest_filter = self.profile_config.filter_for(mac, primary)
+            dest_filters[dest] = (primary, dest_filter)
+            fanout.append((dest, dest_filter))
+        self.fanout = fanout
+        self._dest_filters = dest_filters
+        self._version = stations.version
+
+    def handle(self, pkts, now_us):
+        self.update()
+        add = self.send.add
+        fanout = self.fanout
+        local_dests = self.local_dests
+        ring = self.ring
+        for pkt_buf, pkt_len, src_adrs, src, sequence, msg_id, \
+                payload_offset, payload_len in pkts:
+            for dest, dest_filter in fanout:
+                if dest_filter is None or \
+                   dest_filter.forward(msg_id, pkt_len, now_us):
+                    add(pkt_buf, pkt_len, dest)
+            for dest in local_dests:
+                add(pkt_buf, pkt_len, dest)
+            if ring is not None:
+                ring.add(pkt_buf, pkt_len)
+        self.send.flush()
+        if ring is not None:
+            ring.flush()
+
+    def report(self, msg):
+        # what forwarding profiles kept off the air
+        saved = ["%s:%d" % (dest[0], dest_filter.bytes_saved)
+                 for dest, dest_filter in self.fanout if dest_filter is not None]
+        if saved:
+            msg.append("saved:")
+            msg.extend(saved)
+
+    def metrics(self):
+        self.update()
+        destinations = { }
+        for dest, dest_filter in self.fanout:
+            if dest_filter is None:
+                destinations[dest[0]] = { "profile": None }
+            else:
+                destinations[dest[0]] = { "profile": dest_filter.profile.name,
+                                          "packets_saved": dest_filter.packets_saved,
+                                          "bytes_saved": dest_filter.bytes_saved }
+        return destinations
+
+
+
+class Downlink(object):
+    """solo-side socket readable: receive, validate, fan out, then consumers
+
+    Also measures fan-out latency (wakeup until the batch is sent) every
+    wakeup, and wakeup latency (kernel receive until wakeup) every
+    wakeup_sample_interval wakeups, since it costs an ioctl. Both are usec.
+    """
+
+    def __init__(self, recv, validate, fanout, consumers,
+                 wakeup_sample_interval=16):
+        self.recv = recv
+        self.validate = validate
+        self.fanout = fanout
+        self.consumers = list(consumers)
+        self.packets = 0
+        self.fanout_latency = telem_metrics.LatencyHistogram()
+        self.wakeup_latency = telem_metrics.LatencyHistogram()
+        self.wakeup_sample_interval = wakeup_sample_interval
+        self._wakeup_sample_count = 0
+
+    def handle(self, now_us):
+        # packets from solo; in batch mode, everything that is ready
+        num_pkts = self.recv.recv()
+        self.packets += num_pkts
+        self._wakeup_sample_count += 1
+        if self._wakeup_sample_count >= self.wakeup_sample_interval:
+            self._wakeup_sample_count = 0
+            stamp_us = telem_metrics.packet_stamp_us(self.recv.sock)
+            if stamp_us is not None:
+                self.wakeup_latency.add(
+                    clock.gettime_us(clock.CLOCK_REALTIME) - stamp_us)
+        pkts = self.validate.validate(self.recv, num_pkts, now_us)
+        self.fanout.handle(pkts, now_us)
+        self.fanout_latency.add(clock.gettime_us(clock.CLOCK_MONOTONIC) - now_us)
+        done = False
+        for consumer in self.consumers:
+            consumer.handle(pkts, now_us)
+            done = done or getattr(consumer, "done", False)
+        if done:
+            self.consumers = [consumer for consumer in self.consumers
+                              if not getattr(consumer, "done", False)]
+
+
+
+class Uplink(object):
+    """GCS-side socket readable: count, optionally de-duplicate, send to solo
+
+    Uplink is forwarded even if it looks corrupt (solo decides), so there is
+    no checksum check; the header is decoded only for per-source counts and
+    for 'dedup' (a telem_filter.DedupWindow, or None).
+    """
+
+    def __init__(self, recv, send, solo_address, stations, dedup=None):
+        self.recv = recv
+        self.send = send
+        self.solo_address = solo_address
+        self.stations = stations
+        self.dedup = dedup
+        self.check = mavframe.FrameChecker().check
+        self.packets_total = 0
+        self.bytes_total = 0
+        self.corrupt = 0
+        # per-source counts, like Account
+        self.packets = mavframe.source_counters()
+        self.dups = mavframe.source_counters()
+        self.sources = []
+        self._report_total = 0
+        self._report_corrupt = 0
+        self._report_packets = { }
+        self._report_dups = { }
+
+    def handle(self, now_us):
+        recv = self.recv
+        num_pkts = recv.recv()
+        self.packets_total += num_pkts
+        # another address for a station (e.g. a GCS running in a VM) shows
+        # up here first
+        for pkt_num in range(num_pkts):
+            self.stations.lookup(recv.addrs[pkt_num][0], now_us)
+        solo_port = self.solo_address.port
+        for pkt_num in range(num_pkts):
+            pkt_buf = recv.bufs[pkt_num]
+            pkt_len = recv.lens[pkt_num]
+            self.bytes_total += pkt_len
+            frame_result, sequence, src_sys, src_comp, msg_id, \
+                payload_offset, payload_len = self.check(pkt_buf, pkt_len)
+            if frame_result != mavframe.FRAME_OK:
+                self.corrupt += 1
+            else:
+                src = (src_sys << 8) | src_comp
+                if self.packets[src] == 0 and self.dups[src] == 0:
+                    self.sources.append(src)
+                if self.dedup is not None and \
+                   self.dedup.duplicate(src_sys, src_comp, msg_id, pkt_buf,
+                                        payload_offset, payload_len,
+                                        recv.addrs[pkt_num], now_us):
+                    self.dups[src] += 1
+                    continue
+                self.packets[src] += 1
+            # forward to solo
+            if solo_port is not None:
+                self.send.add(pkt_buf, pkt_len, (self.solo_address.ip, solo_port))
+        self.send.flush()
+
+    def report(self, msg):
+        msg.append("uplink: %d" % (self.packets_total - self._report_total, ))
+        self._report_total = self.packets_total
+        for src in self.sources:
+            count = self.packets[src] - self._report_packets.get(src, 0)
+            dups = self.dups[src] - self._report_dups.get(src, 0)
+            if dups > 0:
+                msg.append("(%d,%d):%d-%d" % (src >> 8, src & 0xff, count, dups))
+            elif count > 0:
+                msg.append("(%d,%d):%d" % (src >> 8, src & 0xff, count))
+            self._report_packets[src] = self.packets[src]
+            self._report_dups[src] = self.dups[src]
+        if self.corrupt > self._report_corrupt:
+            msg.append("(-1,-1):%d" % (self.corrupt - self._report_corrupt, ))
+            self._report_corrupt = self.corrupt
+
+    def metrics(self):
+        sources = { }
+        for src in self.sources:
+            sources[source_name(src)] = { "packets": self.packets[src],
+                                          "duplicates": self.dups[src] }
+        return { "packets": self.packets_total,
+                 "bytes": self.bytes_total,
+                 "corrupt": self.corrupt,
+                 "sources": sources }
+
+
+
+class Stations(object):
+    """keep a telem_stations.StationTracker up to date from the event loop
+
+    hostapd events are handled when they arrive; poll() runs on a timer,
+    sooner while some station is waiting for an IP address.
+    """
+
+    def __init__(self, loop, tracker):
+        self.loop = loop
+        self.tracker = tracker
+        self._poll_us = None
+        loop.add_reader(tracker.sock, self.handle)
+
+    def start(self, now_us):
+        self.tracker.attach(now_us)
+        self._schedule(now_us)
+
+    def handle(self, now_us):
+        # stations connecting or disconnecting
+        self.tracker.handle_events(now_us)
+        self._schedule(now_us)
+
+    def _schedule(self, now_us):
+        poll_us = now_us + long(self.tracker.timeout_s() * 1000000)
+        if self._poll_us is None or poll_us < self._poll_us:
+            self._poll_us = poll_us
+            self.loop.call_at(poll_us, self._poll)
+
+    def _poll(self, now_us):
+        if self._poll_us is None or now_us < self._poll_us:
+            return # superseded by an earlier poll
+        self._poll_us = None
+        # addresses for new stations, and check hostapd is still there
+        self.tracker.poll(now_us)
+        self._schedule(now_us)
+
+
+
+class Report(object):
+    """log packet counts and rates since the previous report"""
+
+    def __init__(self, logger, loop, downlink, account, uplink, fanout,
+                 batches):
+        self.logger = logger
+        self.loop = loop
+        self.downlink = downlink
+        self.account = account
+        self.uplink = uplink
+        self.fanout = fanout
+        # RecvBatch and SendBatch objects, for system call counts
+        self.batches = batches
+        self._packets = 0
+        self._syscalls = 0
+        self._time_us = loop.now_us
+
+    def syscalls(self):
+        return self.loop.select_calls + \
+               sum([batch.syscalls for batch in self.batches])
+
+    def handle(self, now_us):
+        msg = ["downlink:"]
+        self.account.report(msg)
+        self.downlink.validate.report(msg)
+        self.account.report_drops(msg)
+        self.uplink.report(msg)
+        # throughput and system call cost since the last report
+        packets = self.downlink.packets + self.uplink.packets_total
+        syscalls = self.syscalls()
+        if packets > self._packets:
+            msg.append("rate: %d pkt/s %0.2f syscalls/pkt" %
+                ((packets - self._packets) * 1000000 / (now_us - self._time_us),
+                 float(syscalls - self._syscalls) / (packets - self._packets)))
+        self._packets = packets
+        self._syscalls = syscalls
+        self._time_us = now_us
+        self.fanout.report(msg)
+        self.logger.info(" ".join(msg))
+
+
+
+class _NullSend(object):
+    """SendBatch that sends nothing, for timing the stages"""
+
+    def __init__(self):
+        self.packets = 0
+
+    def add(self, buf, length, addr):
+        self.packets += 1
+
+    def flush(self):
+        pass
+
+
+
+class _NullStations(object):
+    def __init__(self, num_gcs):
+        self.destinations = [("127.0.0.%d" % (i + 2, ), 14550)
+                             for i in range(num_gcs)]
+        self.destination_macs = ["02:00:00:00:00:%02x" % (i + 2, )
+                                 for i in range(num_gcs)]
+        self.version = 1
+
+
+
+class _NullProfiles(object):
+    def filter_for(self, mac, primary):
+        return None
+
+
+
+def bench(packets, batch=32, repeat=5):
+    """print the cost per packet of each downlink stage"""
+    import logging
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+
+    class Recv(object):
+        pass
+
+    # split the packets into receive batches, the way RecvBatch has them
+    batches = []
+    for start in range(0, len(packets), batch):
+        recv = Recv()
+        recv.bufs = packets[start:start + batch]
+        recv.lens = [len(pkt) for pkt in recv.bufs]
+        recv.addrs = [("10.1.1.10", 14550)] * len(recv.bufs)
+        batches.append(recv)
+
+    validate = Validate(logger, mavframe.FrameChecker())
+    validated = [validate.validate(recv, len(recv.bufs), 0) for recv in batches]
+    stages = [
+        ("validate", lambda: [validate.validate(recv, len(recv.bufs), 0)
+                              for recv in batches]),
+    ]
+    for name, stage in (("fanout", FanOut(_NullSend(), _NullStations(2),
+                                          _NullProfiles(),
+                                          [("127.0.0.1", 14560),
+                                           ("127.0.0.1", 14583)])),
+                        ("account", Account(logger)),
+                        ("solo", SoloAddress(logger, "10.1.1.10")),
+                        ("timesync", TimeSync(logger, False, -1))):
+        stages.append((name, lambda stage=stage:
+                       [stage.handle(pkts, 0) for pkts in validated]))
+    print "%d packets, batches of %d" % (len(packets), batch)
+    for name, func in stages:
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print "%-10s %8.3f usec/packet" % (name, best * 1000000 / len(packets))
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        packets = [pkt for (timestamp_us, pkt) in
+                   mavframe.tlog_packets(sys.argv[1])]
+    else:
+        import telem_bench
+        packets = telem_bench.synthetic_packets(telem_bench.SYNTHETIC_MIX, { })
+    bench(packets)
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+# Track the stations attached to the AP, for telemetry forwarding.
+#
+# Instead of walking hostapd's station list periodically, we ATTACH to the
+# hostapd control socket (like pair/hostapd_ctrl.py) and react to the
+# AP-STA-CONNECTED and AP-STA-DISCONNECTED events. The station list is only
+# walked (STA-FIRST/STA-NEXT) when we attach or re-attach.
+#
+# A station's IP addresses come from the ARP table. A station usually
+# associates before it has an address, so the ARP table is re-read, at most
+# every arp_interval_us, only while some station has no address yet (or when
+# asked to, e.g. when uplink telemetry arrives from an address we don't know).
+
+import os
+import socket
+
+# hostapd answers PING with PONG; if it does not, it has probably restarted
+# and forgotten we were attached.
+PING_INTERVAL_US = 5000000
+PING_TIMEOUT_US = 2000000
+
+# how often the ARP table may be re-read while waiting for an address
+ARP_INTERVAL_US = 100000
+
+
+
+class ArpIndex(object):
+    """IP addresses for each MAC, from the ARP table
+
+    The table is only read by refresh(), and is then indexed by MAC, so
+    lookups don't touch the file.
+
+    IP address  HW type  Flags  HW address         Mask  Device
+    10.1.1.123  0x1      0x2    00:e0:4c:15:0a:df  *     wlan0-ap
+    10.1.1.103  0x1      0x2    00:e0:4c:15:0a:df  *     wlan0-ap
+    10.1.1.160  0x1      0x2    00:1f:09:04:00:24  *     wlan0-ap
+    """
+
+    def __init__(self, file_name="/proc/net/arp", interval_us=ARP_INTERVAL_US):
+        self.file_name = file_name
+        self.interval_us = interval_us
+        self.reads = 0
+        self._index = { }
+        self._read_us = None
+
+    def refresh(self, now_us):
+        """re-read the ARP table, unless it was read less than interval_us ago
+
+        Returns True if the table was read.
+        """
+        if self._read_us is not None and \
+           (now_us - self._read_us) < self.interval_us:
+            return False
+        self._read_us = now_us
+        index = { }
+        try:
+            f = open(self.file_name)
+        except IOError:
+            return False
+        f.readline() # column headings
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            index.setdefault(fields[3].lower(), []).append(fields[0])
+        f.close()
+        self._index = index
+        self.reads += 1
+        return True
+
+    def ips(self, mac):
+        """list of IP addresses for MAC (as of the last refresh)"""
+        return self._index.get(mac, [])
+
+
+
+def _attach_reply(pkt):
+    """True if pkt is hostapd's response to ATTACH"""
+    return pkt.startswith("OK") or pkt.startswith("FAIL")
+
+
+
+def _sta_reply(pkt):
+    """True if pkt is hostapd's response to STA-FIRST or STA-NEXT
+
+    That is the station's MAC followed by its details, or nothing (or FAIL)
+    after the last station.
+    """
+    if pkt == "" or pkt.startswith("FAIL"):
+        return True
+    mac = pkt.split("\n", 1)[0]
+    return len(mac) == 17 and mac.count(":") == 5
+
+
+
+class StationTracker(object):
+    """stations attached to the AP, kept up to date from hostapd events
+
+    'stations' is a dictionary indexed by MAC; each entry is a list of that
+    station's IP addresses (empty if it does not have one yet).
+    'destinations' is a list of (ip, port) tuples, one per IP address of
+    every station, to send telemetry to. It is replaced (not modified) when
+    it changes, so it is safe to keep a reference to it while iterating.
+    'destination_macs' is the MAC for each entry in 'destinations', and
+    'version' changes whenever they do. Both are in the order the stations
+    connected, so the first is the "primary" station.
+
+    The caller selects on 'sock' and calls handle_events() when it is
+    readable, and calls poll() periodically (at least every
+    timeout_s() seconds).
+    """
+
+    def __init__(self, logger, ctrl_sock_name, local_name, arp_index,
+                 dest_port, exclude_ips=()):
+        self.logger = logger
+        self.ctrl_sock_name = ctrl_sock_name
+        self.arp_index = arp_index
+        self.dest_port = dest_port
+        self.exclude_ips = set(exclude_ips)
+        self.stations = { }
+        self.destinations = []
+        self.destination_macs = []
+        self.version = 0
+        # macs in the order they connected
+        self._order = []
+        self.attached = False
+        self.events = 0
+        # macs that don't have an IP address yet
+        self._pending = set()
+        # addresses telemetry came from that were not stations when checked
+        self._unknown_ips = set()
+        # events received while waiting for a command response
+        self._queued = []
+        self._ping_us = None
+        self._ping_sent_us = None
+        # socket has to have a name for hostapd to send events to
+        try:
+            os.unlink(local_name)
+        except OSError:
+            pass # wasn't there, okay
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(local_name)
+
+    def _request(self, cmd, reply, timeout_s=1.0):
+        """send a command and return its response (None on timeout/error)
+
+        'reply' says whether a packet is the response to this command.
+        Events that arrive while waiting are queued for handle_events();
+        anything else (e.g. a PONG to an earlier PING, or the response to a
+        command that timed out) is stale and dropped.
+        """
+        self.sock.settimeout(timeout_s)
+        try:
+            self.sock.sendto(cmd, self.ctrl_sock_name)
+            while True:
+                pkt = self.sock.recv(4096)
+                if pkt.startswith("<"):
+                    self._queued.append(pkt)
+                elif reply(pkt):
+                    return pkt
+        except socket.error:
+            # control socket not there, or timeout
+            return None
+        finally:
+            self.sock.setblocking(0)
+
+    def attach(self, now_us):
+        """attach to hostapd and get the current list of stations
+
+        Returns True if attached.
+        """
+        self._ping_us = now_us + PING_INTERVAL_US
+        self._ping_sent_us = None
+        pkt = self._request("ATTACH", _attach_reply)
+        if pkt is None or not pkt.startswith("OK"):
+            if self.attached:
+                self.logger.info("stations: can't attach to hostapd")
+            self.attached = False
+            return False
+        self.attached = True
+        self.logger.info("stations: attached to hostapd")
+        # walk the station list once to pick up stations already there
+        macs = set()
+        pkt = self._request("STA-FIRST", _sta_reply)
+        while pkt and not pkt.startswith("FAIL"):
+            mac = pkt.splitlines()[0].lower()
+            macs.add(mac)
+            pkt = self._request("STA-NEXT %s" % (mac, ), _sta_reply)
+        for mac in self.stations.keys():
+            if mac not in macs:
+                self._remove(mac)
+        for mac in macs:
+            if mac not in self.stations:
+                self._add(mac)
+        self._resolve(now_us, force=True)
+        return True
+
+    def _add(self, mac):
+        self.stations[mac] = []
+        self._order.append(mac)
+        self._pending.add(mac)
+
+    def _remove(self, mac):
+        ips = self.stations.pop(mac)
+        self._order.remove(mac)
+        self._pending.discard(mac)
+        for ip in ips:
+            self.logger.info("removing %s", str((mac, ip)))
+        if ips:
+            self._update_destinations()
+
+    def _update_destinations(self):
+        destinations = []
+        destination_macs = []
+        for mac in self._order:
+            for ip in self.stations[mac]:
+                destinations.append((ip, self.dest_port))
+                destination_macs.append(mac)
+        self.destinations = destinations
+        self.destination_macs = destination_macs
+        self.version += 1
+
+    def _resolve(self, now_us, force=False):
+        """look up IP addresses for stations that don't have one
+
+        If 'force', all stations are looked up again (e.g. to pick up a second
+        address for a station that already has one).
+
+        Returns True if the ARP table was read.
+        """
+        if not self.arp_index.refresh(now_us):
+            return False
+        if force:
+            macs = self.stations.keys()
+        else:
+            macs = list(self._pending)
+        changed = False
+        for mac in macs:
+            old_ips = self.stations[mac]
+            ips = self.arp_index.ips(mac)
+            for ip in ips:
+                if ip in self.exclude_ips:
+                    continue # don't send telemetry back to solo!
+                if ip not in old_ips:
+                    self.logger.info("adding %s", str((mac, ip)))
+                    old_ips.append(ip)
+                    changed = True
+            # resolved once the ARP table has it, even if all its addresses
+            # are excluded (solo's own station); lookup() picks up addresses
+            # that appear later
+            if ips:
+                self._pending.discard(mac)
+        if changed:
+            self._update_destinations()
+        return True
+
+    def handle_events(self, now_us):
+        """process everything hostapd has sent us"""
+        while True:
+            if self._queued:
+                pkt = self._queued.pop(0)
+            else:
+                try:
+                    pkt = self.sock.recv(4096)
+                except socket.error:
+                    break # nothing more to read
+            self._event(pkt, now_us)
+
+    def _event(self, pkt, now_us):
+        if pkt.startswith("PONG"):
+            self._ping_sent_us = None
+            return
+        # e.g. "<3>AP-STA-CONNECTED 00:11:22:33:44:55"
+        fields = pkt.split()
+        if len(fields) < 2 or not fields[0].startswith("<"):
+            return
+        event = fields[0][fields[0].find(">") + 1:]
+        mac = fields[1].lower()
+        if event == "AP-STA-CONNECTED":
+            self.events += 1
+            if mac not in self.stations:
+                self._add(mac)
+            self._unknown_ips.clear()
+            self._resolve(now_us)
+        elif event == "AP-STA-DISCONNECTED":
+            self.events += 1
+            if mac in self.stations:
+                self._remove(mac)
+
+    def poll(self, now_us):
+        """resolve pending stations, and check that we are still attached"""
+        if self._pending:
+            self._resolve(now_us)
+        if self._ping_sent_us is not None:
+            if (now_us - self._ping_sent_us) > PING_TIMEOUT_US:
+                self.logger.info("stations: no response from hostapd")
+                self.attach(now_us)
+        elif now_us >= self._ping_us:
+            if not self.attached:
+                self.attach(now_us)
+            else:
+                self._ping_us = now_us + PING_INTERVAL_US
+                try:
+                    self.sock.sendto("PING", self.ctrl_sock_name)
+                    self._ping_sent_us = now_us
+                except socket.error:
+                    self.attach(now_us)
+
+    def lookup(self, ip, now_us):
+        """note that telemetry arrived from 'ip'
+
+        If it is not a known destination, re-check all stations' addresses
+        (rate limited by the ARP index). An address that is still unknown
+        after that is not checked again until another station connects.
+        """
+        if ip in self._unknown_ips or ip in self.exclude_ips:
+            return
+        for dest in self.destinations:
+            if dest[0] == ip:
+                return
+        if self._resolve(now_us, force=True):
+            for dest in self.destinations:
+                if dest[0] == ip:
+                    return
+            self._unknown_ips.add(ip)
+
+    def timeout_s(self):
+        """how long the caller may wait before calling poll() again"""
+        if self._pending:
+            return self.arp_index.interval_us / 1000000.0
+        return 1.0
+
+
+
+if __name__ == "__main__":
+    import logging
+    import tempfile
+
+    # a station whose only address is excluded is not pending, so poll()
+    # does not keep re-reading the ARP table for it
+    arp = tempfile.NamedTemporaryFile()
+    arp.write("IP address  HW type  Flags  HW address         Mask  Device\n"
+              "10.1.1.10   0x1      0x2    00:1f:09:04:00:24  *     wlan0-ap\n")
+    arp.flush()
+    local_name = tempfile.mktemp()
+    tracker = StationTracker(logging.getLogger("stations"), "/nonexistent",
+                             local_name, ArpIndex(arp.name), 14550,
+                             exclude_ips=("10.1.1.10", ))
+    tracker._add("00:1f:09:04:00:24")
+    tracker._resolve(0)
+    assert not tracker._pending
+    assert tracker.destinations == []
+    assert tracker.timeout_s() == 1.0
+    reads = tracker.arp_index.reads
+    for now_us in range(0, 10000000, 100000):
+        tracker._ping_us = now_us + PING_INTERVAL_US
+        tracker.poll(now_us)
+    assert tracker.arp_index.reads == reads
+    # a station not in the ARP table yet stays pending
+    tracker._add("00:e0:4c:15:0a:df")
+    tracker._resolve(20000000)
+    assert tracker._pending == set([ "00:e0:4c:15:0a:df" ])
+    # a late PONG, or a late response to an earlier command, is not taken as
+    # the response to the command being sent
+    hostapd_name = tempfile.mktemp()
+    hostapd = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    hostapd.bind(hostapd_name)
+    tracker.ctrl_sock_name = hostapd_name
+    for pkt in ("PONG\n", "<3>AP-STA-CONNECTED 00:11:22:33:44:55", "OK\n"):
+        hostapd.sendto(pkt, local_name)
+    assert tracker._request("ATTACH", _attach_reply) == "OK\n"
+    assert tracker._queued == [ "<3>AP-STA-CONNECTED 00:11:22:33:44:55" ]
+    for pkt in ("PONG\n", "OK\n", "00:11:22:33:44:55\nflags=[AUTH]\n"):
+        hostapd.sendto(pkt, local_name)
+    assert tracker._request("STA-FIRST", _sta_reply) == \
+        "00:11:22:33:44:55\nflags=[AUTH]\n"
+    hostapd.sendto("PONG\n", local_name)
+    assert tracker._request("STA-NEXT 00:11:22:33:44:55", _sta_reply,
+                            timeout_s=0.1) is None
+    hostapd.close()
+    os.unlink(hostapd_name)
+    os.unlink(local_name)
+    print "ok"
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Compare app_frame.FrameReader with the recv(1)-per-byte reader it replaced
+# in app_server.py (system calls per request, throughput).
+#
+#   app_frame_bench.py [requests data_len]
+#
+# Run with flightcode/python on PYTHONPATH.
+
+import socket
+import struct
+import sys
+import threading
+import time
+from app_frame import FrameReader, pack_frame
+
+
+
+def _legacy_get_request(sock, counts):
+    """get_request() as app_server.py had it: one recv per byte"""
+    pkt = ""
+    while len(pkt) < 4:
+        b = sock.recv(1)
+        counts[0] += 1
+        if not b:
+            return None
+        pkt += b
+    (pkt_len, ) = struct.unpack("!I", pkt)
+    while len(pkt) < pkt_len:
+        b = sock.recv(1)
+        counts[0] += 1
+        if not b:
+            return None
+        pkt += b
+    return pkt
+
+
+
+def bench(num_requests, data_len):
+    """print syscalls per request and throughput, old and new readers"""
+    frame = pack_frame("x" * data_len)
+    print "%d requests of %d bytes" % (num_requests, len(frame))
+    for name in ("recv(1)", "FrameReader"):
+        rx, tx = socket.socketpair()
+        def send():
+            for i in range(num_requests):
+                tx.sendall(frame)
+            tx.close()
+        sender = threading.Thread(target=send)
+        start = time.time()
+        sender.start()
+        frames = 0
+        if name == "FrameReader":
+            reader = FrameReader(rx)
+            while reader.read_frame() is not None:
+                frames += 1
+            syscalls = reader.syscalls
+        else:
+            counts = [0]
+            while _legacy_get_request(rx, counts) is not None:
+                frames += 1
+            syscalls = counts[0]
+        elapsed = time.time() - start
+        sender.join()
+        rx.close()
+        assert frames == num_requests
+        print "%-12s %10.2f syscalls/request %10.3f MB/s" % \
+            (name, float(syscalls) / frames,
+             len(frame) * frames / elapsed / 1000000)
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        bench(int(sys.argv[1]), int(sys.argv[2]))
+    else:
+        bench(10000, 16)
+        bench(20, 16384)
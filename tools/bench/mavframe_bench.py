@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Per-packet MAVLink header decode and count cost on a recorded tlog: the
+# ord() decoder telem_ctrl had originally, mavframe's V1_HEADER struct, and
+# mavframe.FrameChecker (v1/v2 framing and checksum).
+#
+#   mavframe_bench.py file.tlog
+#
+# Run with net/usr/bin on PYTHONPATH; checksums are verified if pymavlink is
+# installed.
+
+import sys
+import time
+from mavframe import *
+
+
+
+def _bench_ord(packets):
+    """header decode and counting as telem_ctrl did it originally"""
+    packets_down = { }
+    for pkt in packets:
+        pkt_len = len(pkt)
+        if pkt_len < 8:
+            continue
+        magic = ord(pkt[0])
+        length = ord(pkt[1])
+        if magic != 254 or length != (pkt_len - 8):
+            continue
+        sequence = ord(pkt[2])
+        src_sys = ord(pkt[3])
+        src_comp = ord(pkt[4])
+        msg_id = ord(pkt[5])
+        src = (src_sys, src_comp)
+        if src not in packets_down:
+            packets_down[src] = 1
+        else:
+            packets_down[src] += 1
+    return packets_down
+
+
+
+def _bench_struct(packets):
+    """header decode and counting using V1_HEADER and a per-source array"""
+    packets_down = source_counters()
+    unpack_from = V1_HEADER.unpack_from
+    for pkt in packets:
+        pkt_len = len(pkt)
+        if pkt_len < 8:
+            continue
+        magic, length, sequence, src_sys, src_comp, msg_id = unpack_from(pkt)
+        if magic != 254 or length != (pkt_len - 8):
+            continue
+        packets_down[(src_sys << 8) | src_comp] += 1
+    return packets_down
+
+
+
+def _bench_check(packets, crc_extras):
+    """v1/v2 framing and checksum check, and counting per source"""
+    packets_down = source_counters()
+    check = FrameChecker(crc_extras).check
+    for pkt in packets:
+        result, sequence, src_sys, src_comp, msg_id, payload_offset, \
+            payload_len = check(pkt, len(pkt))
+        if result != FRAME_OK:
+            continue
+        packets_down[(src_sys << 8) | src_comp] += 1
+    return packets_down
+
+
+
+def bench(file_name, repeat=10):
+    """print per-packet header decode cost before and after, using a tlog"""
+    try:
+        from pymavlink import mavutil
+        crc_extras = crc_extra_table(mavutil.mavlink)
+    except ImportError:
+        print "pymavlink not found; checksums not verified"
+        crc_extras = None
+    packets = [pkt for (timestamp_us, pkt) in tlog_packets(file_name)]
+    if not packets:
+        print "no packets in %s" % (file_name, )
+        return
+    # the original code received strings, the new code works on the receive
+    # buffer
+    packets_str = [str(pkt) for pkt in packets]
+    print "%d packets" % (len(packets), )
+    check = lambda pkts: _bench_check(pkts, crc_extras)
+    for name, func, pkts in (("ord", _bench_ord, packets_str),
+                             ("struct", _bench_struct, packets),
+                             ("check", check, packets)):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            func(pkts)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print "%-8s %8.3f usec/packet" % (name, best * 1000000 / len(pkts))
+
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "usage: mavframe_bench.py file.tlog"
+        sys.exit(1)
+    bench(sys.argv[1])
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# Time slip.py's SlipDevice against the byte-at-a-time read() and write() it
+# replaced, kept here as _LegacySlipDevice.
+#
+#   slip_bench.py [packets]
+#
+# Run with flightcode/python and net/usr/bin on PYTHONPATH.
+
+import random
+import sys
+import time
+from slip import SlipDevice
+
+
+
+class _LegacySlipDevice(SlipDevice):
+    """read() and write() as they were, one byte at a time (for bench())"""
+
+    def sync(self):
+        while self.ser.read() != self.END:
+            pass
+        self.insync = True
+        return True
+
+    def read(self):
+        pkt = []
+
+        if not self.insync:
+            if(self.sync() == False):
+                return pkt;
+
+        while True:
+            b = self.ser.read()
+            if b == self.END:
+                if len(pkt) > 0:
+                    return pkt
+            elif b == self.ESC:
+                b = self.ser.read()
+                if b == self.ESC_END:
+                    pkt.append(self.END)
+                elif b == self.ESC_ESC:
+                    pkt.append(self.ESC)
+                else:
+                    pkt.append(b)
+            else:
+                pkt.append(b)
+
+    def write(self, pkt):
+        slip_bytes = [self.END]
+        for b in pkt:
+            if b == self.END:
+                slip_bytes.append(self.ESC)
+                slip_bytes.append(self.ESC_END)
+            elif b == self.ESC:
+                slip_bytes.append(self.ESC)
+                slip_bytes.append(self.ESC_ESC)
+            else:
+                slip_bytes.append(b)
+
+        slip_bytes.append(self.END)
+        self.ser.write("".join(slip_bytes))
+
+
+
+class _BufferSerial:
+    """enough of serial.Serial for bench(): reads come from 'data', and the
+    serial buffer has up to 'fifo' bytes at a time"""
+
+    def __init__(self, data, fifo=64):
+        self.data = data
+        self.fifo = fifo
+        self.index = 0
+        self.reads = 0
+        self.written = []
+
+    def inWaiting(self):
+        return min(self.fifo, len(self.data) - self.index)
+
+    def read(self, size=1):
+        self.reads += 1
+        dat = self.data[self.index:self.index + size]
+        self.index += len(dat)
+        return dat
+
+    def write(self, dat):
+        self.written.append(dat)
+
+
+
+def bench(num_pkts, fifo):
+    """print reads per packet and time per packet, old and new"""
+    # RC-sized packets, with some bytes that need escaping
+    pkts = []
+    for i in range(100):
+        pkt = "".join([chr(random.choice([0xc0, 0xdb] + range(256)))
+                       for j in range(random.randint(1, 40))])
+        pkts.append(pkt)
+    enc = SlipDevice(_BufferSerial(""))
+    for pkt in pkts:
+        enc.write(pkt)
+    stream = "".join(enc.ser.written)
+    data = stream * (num_pkts / len(pkts))
+    num_pkts = len(pkts) * (num_pkts / len(pkts))
+    print "%d packets, serial buffer %d bytes" % (num_pkts, fifo)
+    for cls in (_LegacySlipDevice, SlipDevice):
+        ser = _BufferSerial(data, fifo)
+        dev = cls(ser)
+        start = time.time()
+        for i in range(num_pkts):
+            pkt = dev.read()
+            assert "".join(pkt) == pkts[i % len(pkts)]
+        read_us = (time.time() - start) * 1000000 / num_pkts
+        start = time.time()
+        for i in range(num_pkts):
+            dev.write(pkts[i % len(pkts)])
+        write_us = (time.time() - start) * 1000000 / num_pkts
+        assert "".join(ser.written) == data
+        print "%-18s %6.2f reads/packet  read %6.2f usec  write %6.2f usec" % \
+            (cls.__name__, float(ser.reads) / num_pkts, read_us, write_us)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        num_pkts = int(sys.argv[1])
+    else:
+        num_pkts = 20000
+    bench(num_pkts, 64)
+    bench(num_pkts, 4096)
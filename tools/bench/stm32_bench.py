@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+# Time stm32.py's receiver (SLIP decoding, dispatch, counts, and log checks)
+# against the one it replaced, kept here as _LegacyStm32.
+#
+#   stm32_bench.py [packets]
+#
+# Run where stm32.py runs (it reads /etc/sololink.conf when imported), or
+# with flightcode/old, flightcode/python and net/usr/bin on PYTHONPATH.
+
+import datetime
+import os
+import random
+import struct
+import sys
+import clock
+import slip_codec
+import stm32
+from stm32_defs import *
+
+
+
+class _LegacyStm32(stm32.stm32):
+    """dispatch() and the counts as they were, with an if/elif on the packet
+    ID, dict counts, and the time checked for every packet (for bench())"""
+
+    # the names there were (anything else raised IndexError)
+    _typeNames = stm32.pktIdToTypeName[:11]
+
+    def __init__(self, port, logPipe):
+        stm32.stm32.__init__(self, port, logPipe)
+        self._msgInCounts = {}
+        self._logProgressInterval = datetime.timedelta(seconds=30)
+        self._logProgressLast = None
+        self._logJunkInterval = datetime.timedelta(seconds=5)
+        self._logJunkLast = None
+        self._pktTimeDsmLast = None
+
+    def logProgress(self, msgInType, msgOutType=None):
+        if msgInType is not None:
+            if msgInType not in self._msgInCounts:
+                self._msgInCounts[msgInType] = 0
+            self._msgInCounts[msgInType] += 1
+        now = datetime.datetime.now()
+        if (self._logProgressInterval is not None) and \
+           ((self._logProgressLast is None) or \
+            ((now - self._logProgressLast) >= self._logProgressInterval)):
+            stm32.logger.info("messages in:  %s", str(self._msgInCounts))
+            self._logProgressLast = now
+
+    def logJunk(self, junkType):
+        now = datetime.datetime.now()
+        if junkType not in self._junkCounts:
+            self._junkCounts[junkType] = 0
+        self._junkCounts[junkType] += 1
+        if (self._logJunkInterval is not None) and \
+           ((self._logJunkLast is None) or \
+            ((now - self._logJunkLast) >= self._logJunkInterval)):
+            stm32.logger.info("junk: stm32 %s, slip %s",
+                        str(self._junkCounts), str(self._slip.counts))
+            self._logJunkLast = now
+
+    def dispatch(self, pktTime, pkt):
+        if self.packetLogger:
+            self.packetLogger.log_packet(pktTime, "".join(pkt))
+        pktId = ord(pkt[0])
+        try:
+            typeName = self._typeNames[pktId]
+        except:
+            stm32.logger.info("stm32.receiver: %s",
+                              [hex(ord(c)) for c in pkt])
+            typeName = "UNKNOWN"
+        if pktId == PKT_ID_NOP:
+            self.logJunk(typeName)
+        elif pktId == PKT_ID_DSM:
+            self.rc.handle(pktTime, pkt[1:])
+            if self._pktTimeDsmLast is not None:
+                delta = pktTime - self._pktTimeDsmLast
+                self._stats.update(delta.total_seconds() * 1000000)
+            self._pktTimeDsmLast = pktTime
+        elif pktId == PKT_ID_CAL:
+            pass
+        elif pktId == PKT_ID_SYSINFO:
+            self.sysinfo.handle(pktTime, pkt[1:])
+        elif pktId == PKT_ID_MAVLINK:
+            self.mavlink.handle(pktTime, pkt[1:])
+        elif pktId == PKT_ID_PAIR_CONFIRM:
+            self.pairCnf.handle(pktTime, pkt[1:])
+        elif pktId == PKT_ID_SHUTDOWN_REQUEST:
+            self.handleShutdown(pktTime, pkt[1:])
+        else:
+            self.logJunk(typeName)
+        self.logProgress(typeName, None)
+
+
+
+class _BufferPort():
+    """a port for bench(): reads come from 'data', up to 'fifo' bytes at a
+    time (like the serial port's buffer)"""
+
+    def __init__(self, data, fifo=64):
+        self._data = data
+        self._fifo = fifo
+        self._index = 0
+
+    def inWaiting(self):
+        return min(self._fifo, len(self._data) - self._index)
+
+    def read(self, size=1):
+        b = self._data[self._index:self._index + size]
+        self._index += len(b)
+        return b
+
+    def write(self, c):
+        pass
+
+
+
+class _NullHandler():
+    def handle(self, pktTime, pkt):
+        pass
+
+
+
+def bench(numPkts, fifo=64):
+    """print the receiver's time per packet (decoding, dispatch, counts, and
+    log checks; the handlers do nothing), old and new"""
+    # don't take the real ports or capture file, in case stm32.py is running
+    stm32.mavDestPort = stm32.sysDestPort = 0
+    stm32.pairReqDestPort = stm32.pairResDestPort = 0
+    stm32.stm32CaptureFile = ""
+    # Mostly RC, plus what else the STM32 sends: for every 50 RC packets
+    # (one second), a sysinfo and a few MAVLink packets
+    pkts = []
+    for i in range(50):
+        channels = [ random.randint(1000, 2000) for c in range(8) ]
+        pkts.append(chr(PKT_ID_DSM) + struct.pack("<8H", *channels))
+        if (i % 10) == 0:
+            mav = os.urandom(random.randint(20, 60))
+            pkts.append(chr(PKT_ID_MAVLINK) + mav)
+    pkts.append(chr(PKT_ID_SYSINFO) + os.urandom(14) + "v1.0.0")
+    stream = "".join([slip_codec.encode(pkt) for pkt in pkts])
+    data = stream * (numPkts / len(pkts))
+    numPkts = len(pkts) * (numPkts / len(pkts))
+    print "%d packets, serial buffer %d bytes" % (numPkts, fifo)
+    null = _NullHandler()
+    for cls in (_LegacyStm32, stm32.stm32):
+        s = cls(_BufferPort(data, fifo), "")
+        s.rc = s.mavlink = s.sysinfo = s.pairCnf = null
+        s._handlers[PKT_ID_SYSINFO] = null.handle
+        s._handlers[PKT_ID_MAVLINK] = null.handle
+        s._handlers[PKT_ID_PAIR_CONFIRM] = null.handle
+        start_us = clock.gettime_us(clock.CLOCK_MONOTONIC)
+        now_us = start_us
+        while s.receive(now_us):
+            now_us += 1000
+            # what the loop does each time it wakes up
+            if cls is stm32.stm32:
+                s.logProgress(now_us)
+        elapsed_us = clock.gettime_us(clock.CLOCK_MONOTONIC) - start_us
+        print "%-12s %6.2f usec/packet" % \
+            (cls.__name__, float(elapsed_us) / numPkts)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        bench(int(sys.argv[1]))
+    else:
+        bench(100000)